@@ -0,0 +1,287 @@
+import os
+import re
+import math
+import time
+import threading
+from collections import OrderedDict
+import JsonEncoder
+import Metrics
+
+# Probes and scrapes are always admitted, so an overloaded worker is not restarted for being slow to answer them.
+EXEMPT_PATHS = {"/healthz", "/readyz", "/metrics"}
+
+def routeKey(method, rule):
+    """
+    Names a route the same way for the threaded and the asyncio service,
+    e.g. "POST /ratings/{rating_id}/values" for the Flask rule "/ratings/<string:rating_id>/values".
+    """
+    path = re.sub(r"<(?:[^:<>]+:)?([^<>]+)>", r"{\1}", rule)
+    return f"{method} {path}"
+
+def parseRouteRates(value):
+    """
+    Reads per route rate limits written as "GET /books=20:40,POST /ratings/{rating_id}/values=5:10",
+    where each route is given its requests per second and burst. A rate of 0 exempts the route.
+
+    Returns:
+        dict: The (rate, burst) tuple of each route.
+
+    Raises:
+        ValueError: If an entry is not a route followed by a rate and an optional burst, naming the entry.
+    """
+    rates = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        route, separator, limit = item.rpartition("=")
+        rate, _, burst = limit.partition(":")
+        try:
+            if not separator:
+                raise ValueError("no =rate")
+            if not route.strip():
+                raise ValueError("no route")
+            rate = float(rate)
+            burst = float(burst) if burst else max(rate, 1)
+            if not rate >= 0 or not burst >= 1:
+                raise ValueError("the rate must be 0 or more and the burst 1 or more")
+        except ValueError as error:
+            raise ValueError(f"invalid ADMISSION_ROUTE_RATES entry {item.strip()!r}: {error}") from None
+        rates[route.strip()] = (rate, burst)
+    return rates
+
+class TokenBucket:
+    """
+    This class represents a token bucket refilled with rate tokens per second up
+    to burst tokens. It is not thread-safe, Admission holds its lock around it.
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """
+        Takes a token.
+
+        Returns:
+            float: 0 if a token was taken, else the seconds until one is available.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class Admission:
+    """
+    This class represents the admission control in front of the routes. Each
+    client gets a token bucket per route, so a client flooding a route is answered
+    429 without slowing down the others. Each route has a cap on the requests it
+    handles at once, and the routes calling Google Books share a smaller one, so a
+    burst on one route cannot take every worker thread. Requests over a cap are
+    answered 503 at once instead of waiting in the queue. Both answers carry
+    Retry-After. The limits are per process.
+    """
+    def __init__(self, rate=0, burst=None, route_rates=None, max_inflight=0, google_books_max_inflight=0,
+                 google_books_routes=(), retry_after=1, client_header=None, max_clients=100000):
+        """
+        Initializes a new Admission object.
+
+        Args:
+            rate (float): Requests per second a client may make to a route, 0 for no limit.
+            burst (float): Requests a client may make at once to a route, defaults to twice the rate.
+            route_rates (dict): The (rate, burst) tuples of routes with their own limit, see parseRouteRates.
+            max_inflight (int): Requests a route handles at once, 0 for no limit.
+            google_books_max_inflight (int): Requests the routes calling Google Books handle at once, 0 for no limit.
+            google_books_routes (iterable): The routes calling Google Books, see routeKey.
+            retry_after (int): The Retry-After seconds of requests over a concurrency cap.
+            client_header (str): The header identifying the client, such as X-Forwarded-For
+                behind a proxy, None for the address of the connection.
+            max_clients (int): The number of token buckets kept, the least recently used are dropped.
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate * 2, 1)
+        self.route_rates = route_rates or {}
+        self.max_inflight = max_inflight
+        self.google_books_max_inflight = google_books_max_inflight
+        self.google_books_routes = set(google_books_routes)
+        self.retry_after = retry_after
+        self.client_header = client_header
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+        self.inflight = {}
+        self.google_books_inflight = 0
+        self.admitted = 0
+        self.limited = 0
+        self.shed = 0
+
+    @classmethod
+    def fromEnvironment(cls, google_books_routes=()):
+        """
+        Creates an Admission configured from the ADMISSION_* environment variables.
+        """
+        env = os.environ
+        return cls(
+            rate=float(env.get("ADMISSION_RATE", 0)),
+            burst=float(env["ADMISSION_BURST"]) if env.get("ADMISSION_BURST") else None,
+            route_rates=parseRouteRates(env.get("ADMISSION_ROUTE_RATES")),
+            max_inflight=int(env.get("ADMISSION_MAX_INFLIGHT", 0)),
+            google_books_max_inflight=int(env.get("ADMISSION_GOOGLE_BOOKS_MAX_INFLIGHT", 0)),
+            google_books_routes=google_books_routes,
+            retry_after=int(env.get("ADMISSION_RETRY_AFTER", 1)),
+            client_header=env.get("ADMISSION_CLIENT_HEADER") or None
+        )
+
+    def enabled(self):
+        return bool(self.rate or self.route_rates or self.max_inflight or self.google_books_max_inflight)
+
+    def client(self, headers, address):
+        """
+        Identifies the client of a request.
+        """
+        if self.client_header:
+            value = headers.get(self.client_header)
+            if value:
+                # A proxy appends the address it saw, the first one is the original client.
+                return value.split(",")[0].strip()
+        return address or "unknown"
+
+    def _limit(self, client, route, now):
+        """
+        Takes a token from the bucket of a client and route. Must be called with the lock held.
+
+        Returns:
+            float: 0 if the request is within the limit, else the seconds until it would be.
+        """
+        rate, burst = self.route_rates.get(route, (self.rate, self.burst))
+        if not rate:
+            return 0
+        key = (client, route)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, burst, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take(now)
+
+    def admit(self, client, route):
+        """
+        Decides whether a request is handled. An admitted request must be released once handled.
+
+        Args:
+            client (str): The client of the request, see client.
+            route (str): The route of the request, see routeKey.
+
+        Returns:
+            tuple: A tuple containing (bool, status, retry_after).
+                - bool: True if the request is admitted, False otherwise.
+                - status (int): 429 if the client is over its rate limit, 503 if the route is over its
+                    concurrency cap, None if admitted.
+                - retry_after (int): The seconds the client should wait before retrying, None if admitted.
+        """
+        google_books = route in self.google_books_routes
+        with self.lock:
+            wait = self._limit(client, route, time.monotonic())
+            if wait:
+                self.limited += 1
+                reason = "rate"
+            elif self.max_inflight and self.inflight.get(route, 0) >= self.max_inflight:
+                self.shed += 1
+                reason = "concurrency"
+            elif google_books and self.google_books_max_inflight and \
+                    self.google_books_inflight >= self.google_books_max_inflight:
+                self.shed += 1
+                reason = "googleBooks"
+            else:
+                self.inflight[route] = self.inflight.get(route, 0) + 1
+                if google_books:
+                    self.google_books_inflight += 1
+                self.admitted += 1
+                return True, None, None
+        Metrics.admission_rejections.inc(route=route, reason=reason)
+        if reason == "rate":
+            return False, 429, max(math.ceil(wait), 1)
+        return False, 503, self.retry_after
+
+    def release(self, route):
+        with self.lock:
+            self.inflight[route] -= 1
+            if route in self.google_books_routes:
+                self.google_books_inflight -= 1
+
+    def info(self):
+        """
+        Retrieves the state of the admission control.
+
+        Returns:
+            dict: The requests in flight by route, the requests admitted, rate limited and shed, and the buckets kept.
+        """
+        with self.lock:
+            return {
+                "inflight": {route: number for route, number in self.inflight.items() if number},
+                "googleBooksInflight": self.google_books_inflight,
+                "admitted": self.admitted,
+                "rateLimited": self.limited,
+                "shed": self.shed,
+                "clients": len(self.buckets)
+            }
+
+def rejection(status, retry_after):
+    """
+    Builds the body and headers of a rejected request.
+    """
+    error = "Too Many Requests" if status == 429 else "Service Unavailable"
+    return JsonEncoder.dumps({"error": error}) + b"\n", {"Retry-After": str(retry_after)}
+
+def instrumentApp(app, admission):
+    """
+    Puts the admission control in front of every route of a Flask app.
+    """
+    from flask import g, request, Response
+
+    @app.before_request
+    def admitRequest():
+        if request.url_rule is None or request.path in EXEMPT_PATHS:
+            return None
+        route = routeKey(request.method, request.url_rule.rule)
+        admitted, status, retry_after = admission.admit(admission.client(request.headers, request.remote_addr), route)
+        if not admitted:
+            body, headers = rejection(status, retry_after)
+            return Response(body, status=status, headers=headers, mimetype="application/json")
+        g.admitted_route = route
+        return None
+
+    # Teardown runs once the response is sent, after the last chunk of a streamed response.
+    @app.teardown_request
+    def releaseRequest(error):
+        route = g.pop("admitted_route", None)
+        if route is not None:
+            admission.release(route)
+
+def middleware(admission):
+    """
+    Builds the aiohttp middleware putting the admission control in front of every route, see instrumentApp.
+    """
+    from aiohttp import web
+
+    @web.middleware
+    async def admit(request, handler):
+        resource = request.match_info.route.resource
+        if resource is None or request.path in EXEMPT_PATHS:
+            return await handler(request)
+        route = routeKey(request.method, resource.canonical)
+        admitted, status, retry_after = admission.admit(admission.client(request.headers, request.remote), route)
+        if not admitted:
+            body, headers = rejection(status, retry_after)
+            return web.Response(body=body, status=status, headers=headers, content_type="application/json")
+        try:
+            return await handler(request)
+        finally:
+            admission.release(route)
+
+    return admit
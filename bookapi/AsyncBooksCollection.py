@@ -0,0 +1,296 @@
+import logging
+import pymongo
+from pymongo import UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from bson.objectid import ObjectId
+import Database
+import AsyncCatalogStats
+from BooksCollection import BOOK_FIELDS, BOOK_INDEXES, DUPLICATE_ISBN_PIPELINE, HIDDEN_FIELDS, STAT_PROJECTION, duplicateIsbnError
+from BooksCollection import tokenize, searchTokens, searchQuery, rankBooks
+
+logger = logging.getLogger(__name__)
+
+class AsyncBooksCollection:
+    """
+    This class represents a collection of books for the asyncio service mode.
+    It mirrors BooksCollection method for method, with every database call awaited.
+    """
+    def __init__(self, database=None):
+        """
+        Initializes a new AsyncBooksCollection object.
+
+        Args:
+            database (Database): The database holding the books, defaults to the shared database.
+        """
+        self.database = database or Database.database
+        self.stats = AsyncCatalogStats.AsyncCatalogStats(self.database)
+
+    @property
+    def collection(self):
+        return self.database.asyncCollection("books")
+
+    async def ensureIndexes(self):
+        """
+        Creates the indexes the collection relies on, see BooksCollection.ensureIndexes.
+        """
+        if "ISBN_unique" not in await self.collection.index_information():
+            duplicates = await (await self.collection.aggregate(DUPLICATE_ISBN_PIPELINE, allowDiskUse=True)).to_list()
+            if duplicates:
+                raise duplicateIsbnError(duplicates)
+        await self.collection.create_indexes(BOOK_INDEXES)
+        logger.info("indexes ensured")
+
+    async def insertBook(self, book):
+        """
+        Inserts a new book into the collection.
+
+        Returns:
+            str: The ID of the inserted book as a string, or None if a duplicate ISBN is found.
+        """
+        book["searchTokens"] = searchTokens(book)
+        try:
+            result = await self.collection.insert_one(book)
+        except DuplicateKeyError:
+            logger.info("book already inserted")
+            return None
+
+        book_id = str(result.inserted_id)
+        logger.info('inserted book: %s with ID: %s', book["title"], book_id)
+        await self.stats.count(added=[book])
+        return book_id
+
+    async def insertBooks(self, books):
+        """
+        Inserts many books with a single unordered insert_many.
+
+        Returns:
+            list: The ID of each inserted book as a string, or None where the insert failed.
+        """
+        if not books:
+            return []
+        for book in books:
+            book["searchTokens"] = searchTokens(book)
+        failed = set()
+        try:
+            await self.collection.insert_many(books, ordered=False)
+        except BulkWriteError as error:
+            failed = {write_error["index"] for write_error in error.details["writeErrors"]}
+        logger.info('inserted %s of %s books', len(books) - len(failed), len(books))
+        await self.stats.count(added=[book for index, book in enumerate(books) if index not in failed])
+        return [None if index in failed else str(book["_id"]) for index, book in enumerate(books)]
+
+    async def isbnExists(self, isbn):
+        """
+        Checks whether a book with the given ISBN is already in the collection, see BooksCollection.isbnExists.
+        """
+        return await self.collection.find_one({"ISBN": isbn}, {"_id": 1}) is not None
+
+    async def findExistingISBNs(self, isbns):
+        """
+        Finds which of the given ISBNs already belong to a book in the collection.
+
+        Returns:
+            set: The ISBNs already in the collection.
+        """
+        cursor = self.collection.find({"ISBN": {"$in": list(isbns)}}, {"ISBN": 1, "_id": 0})
+        return {book["ISBN"] async for book in cursor}
+
+    async def deleteBook(self, id):
+        """
+        Deletes a book from the collection by its ID.
+
+        Returns:
+            bool: True if the book is deleted, False otherwise.
+        """
+        book = await self.collection.find_one_and_delete({"_id": ObjectId(id)}, projection=STAT_PROJECTION)
+        if book:
+            logger.info('deleted book with ID: %s', id)
+            await self.stats.count(removed=[book])
+            return True
+        else:
+            logger.debug("book not in collection")
+            return False
+
+    async def deleteBooks(self, ids, session=None):
+        """
+        Deletes many books with a single unordered bulk_write, see BooksCollection.deleteBooks.
+
+        Returns:
+            list: The IDs of the deleted books.
+        """
+        cursor = self.collection.find({"_id": {"$in": [ObjectId(id) for id in ids]}}, STAT_PROJECTION, session=session)
+        books = [book async for book in cursor]
+        if books:
+            await self.collection.bulk_write([DeleteOne({"_id": book["_id"]}) for book in books], ordered=False, session=session)
+            await self.stats.count(removed=books, session=session)
+        logger.info('deleted %s of %s books', len(books), len(ids))
+        return [str(book["_id"]) for book in books]
+
+    async def updateBooks(self, ids, fields, session=None):
+        """
+        Sets the same fields on many books with a single unordered bulk_write, see BooksCollection.updateBooks.
+
+        Returns:
+            list: The IDs of the updated books.
+        """
+        cursor = self.collection.find(
+            {"_id": {"$in": [ObjectId(id) for id in ids]}}, {"title": 1, "authors": 1, **STAT_PROJECTION}, session=session
+        )
+        books = [book async for book in cursor]
+        updates = []
+        for book in books:
+            update = dict(fields)
+            if "title" in fields or "authors" in fields:
+                update["searchTokens"] = searchTokens({**book, **fields})
+            updates.append(UpdateOne({"_id": book["_id"]}, {"$set": update}))
+        if updates:
+            await self.collection.bulk_write(updates, ordered=False, session=session)
+            await self.stats.count(added=[{**book, **fields} for book in books], removed=books, session=session)
+        logger.info('updated %s of %s books', len(books), len(ids))
+        return [str(book["_id"]) for book in books]
+
+    async def findIds(self, query, limit=None, session=None):
+        """
+        Finds the IDs of the books matching a query.
+
+        Returns:
+            list: The IDs of the matching books.
+        """
+        cursor = self.collection.find(query, {"_id": 1}, session=session)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return [str(book["_id"]) async for book in cursor]
+
+    async def findBook(self, id):
+        """
+        Finds a book by its ID.
+
+        Returns:
+            tuple: A tuple containing (bool, book).
+        """
+        book = await self.collection.find_one({"_id": ObjectId(id)}, HIDDEN_FIELDS)
+        if book:
+            book["id"] = str(book.pop("_id"))
+            logger.debug('found book: %s with ID: %s', book["title"], id)
+            return True, book
+        else:
+            logger.debug("book not in collection")
+            return False, None
+
+    async def updateBook(self, id, book):
+        """
+        Updates a book's information.
+
+        Returns:
+            bool: True if the book is updated, False if it is not in the collection,
+                None if another book already has the ISBN.
+        """
+        if "title" in book and "authors" in book:
+            book = dict(book, searchTokens=searchTokens(book))
+        try:
+            before = await self.collection.find_one_and_update(
+                {"_id": ObjectId(id)}, {"$set": book}, return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            logger.info("ISBN already used by another book")
+            return None
+        if before and any(before.get(field) != value for field, value in book.items()):
+            logger.info('updated book with ID: %s', id)
+            await self.stats.count(added=[{**before, **book}], removed=[before])
+            return True
+        else:
+            logger.debug("book not in collection")
+            return False
+
+    def exportBooks(self, batch_size=1000):
+        """
+        Iterates over every book in _id order, see BooksCollection.exportBooks.
+        """
+        return self.collection.find({}, HIDDEN_FIELDS, batch_size=batch_size).sort("_id", pymongo.ASCENDING)
+
+    async def findBooks(self, query=None, limit=None, after=None, fields=None, batch_size=500):
+        """
+        Iterates over the books matching a query straight from the database cursor,
+        see BooksCollection.findBooks.
+
+        Returns:
+            async generator: The matching books.
+        """
+        pipeline = Database.listPipeline(query or {}, fields or BOOK_FIELDS, limit, after)
+        async for book in await self.collection.aggregate(pipeline, batchSize=batch_size):
+            yield book
+
+    async def findBooksByQueries(self, queries, batch_size=500):
+        """
+        Answers many queries with a single indexed find, see BooksCollection.findBooksByQueries.
+
+        Returns:
+            list: For each query, in order, the list of books matching it.
+        """
+        results = [[] for _ in queries]
+        if not queries:
+            return results
+        positions = {}
+        for position, query in enumerate(queries):
+            positions.setdefault(tuple(sorted(query.items())), []).append(position)
+        combined = [dict(query) for query in positions.keys()]
+        query = combined[0] if len(combined) == 1 else {"$or": combined}
+        async for book in self.collection.find(query, HIDDEN_FIELDS, batch_size=batch_size):
+            matches = [key for key in positions.keys() if all(book.get(field) == value for field, value in key)]
+            book["id"] = str(book.pop("_id"))
+            for key in matches:
+                for position in positions[key]:
+                    results[position].append(book)
+        return results
+
+    async def searchBooks(self, text, limit=20, candidates=1000):
+        """
+        Searches books by the words of their title and authors, see BooksCollection.searchBooks.
+
+        Returns:
+            list: The matching books, the most relevant first.
+        """
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        books = await self.collection.find(searchQuery(tokens), HIDDEN_FIELDS).limit(candidates).to_list()
+        for book in books:
+            book["id"] = str(book.pop("_id"))
+        return rankBooks(books, tokens, limit)
+
+    async def indexSearchTokens(self, batch_size=1000):
+        """
+        Computes the search tokens of books stored before search existed, see BooksCollection.indexSearchTokens.
+
+        Returns:
+            int: The number of books updated.
+        """
+        updated = 0
+        updates = []
+        async for book in self.collection.find({"searchTokens": {"$exists": False}}, {"title": 1, "authors": 1}):
+            updates.append(UpdateOne({"_id": book["_id"]}, {"$set": {"searchTokens": searchTokens(book)}}))
+            if len(updates) == batch_size:
+                updated += (await self.collection.bulk_write(updates, ordered=False)).modified_count
+                updates = []
+        if updates:
+            updated += (await self.collection.bulk_write(updates, ordered=False)).modified_count
+        logger.info('indexed search tokens of %s books', updated)
+        return updated
+
+    async def retrieveAllBooks(self):
+        """
+        Retrieves all books currently in the collection.
+
+        Returns:
+            list: A list of books.
+        """
+        return [book async for book in self.findBooks()]
+
+    async def retrieveBooksByParameter(self, args):
+        """
+        Retrieves books based on specified parameters.
+
+        Returns:
+            list: A list of books matching the given parameters.
+        """
+        return [book async for book in self.findBooks(dict(args))]
@@ -0,0 +1,60 @@
+import logging
+from pymongo import ReplaceOne, DeleteMany
+import Database
+from CatalogStats import STAT_KINDS, REBUILD_PIPELINE, RATING_GENRE_PIPELINE, bookCounts, counterUpdates, statDocuments, formatStats
+
+logger = logging.getLogger(__name__)
+
+class AsyncCatalogStats:
+    """
+    This class represents the catalog statistics for the asyncio service mode.
+    It mirrors CatalogStats method for method, with every database call awaited.
+    """
+    def __init__(self, database=None):
+        """
+        Initializes a new AsyncCatalogStats object.
+
+        Args:
+            database (Database): The database holding the catalog, defaults to the shared database.
+        """
+        self.database = database or Database.database
+
+    @property
+    def collection(self):
+        return self.database.asyncCollection("stats")
+
+    async def count(self, added=(), removed=(), ratings=None, session=None):
+        """
+        Applies the changes of a write to the counters, see CatalogStats.count.
+        """
+        updates = counterUpdates(bookCounts(added, removed), ratings)
+        if updates:
+            await self.collection.bulk_write(updates, ordered=False, session=session)
+
+    async def retrieve(self, kinds=None):
+        """
+        Retrieves the statistics, see CatalogStats.retrieve.
+        """
+        query = {"kind": {"$in": [STAT_KINDS[name] for name in kinds]}} if kinds else {}
+        return formatStats([document async for document in self.collection.find(query)], kinds)
+
+    async def rebuild(self):
+        """
+        Recomputes every counter from the catalog, see CatalogStats.rebuild.
+        """
+        books = self.database.asyncCollection("books")
+        facets = await (await books.aggregate(REBUILD_PIPELINE)).next()
+        documents = statDocuments(facets)
+        await (await books.aggregate(RATING_GENRE_PIPELINE)).to_list()
+        writes = [ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents]
+        writes.append(DeleteMany({"_id": {"$nin": [document["_id"] for document in documents]}}))
+        await self.collection.bulk_write(writes, ordered=False)
+        logger.info('rebuilt %s catalog statistics', len(documents))
+        return {"counters": len(documents)}
+
+    async def buildIfMissing(self):
+        """
+        Builds the statistics of a catalog which has none yet, see CatalogStats.buildIfMissing.
+        """
+        if await self.collection.find_one({}, {"_id": 1}) is None:
+            await self.rebuild()
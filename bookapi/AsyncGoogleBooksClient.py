@@ -0,0 +1,90 @@
+import os
+import time
+import asyncio
+import aiohttp
+import Metrics
+import Profiling
+from GoogleBooksClient import GoogleBooksClient
+
+class AsyncGoogleBooksClient(GoogleBooksClient):
+    """
+    This class represents a client for the Google Books volumes API for the
+    asyncio service mode. It shares the caching of GoogleBooksClient and sends
+    its requests through a pooled aiohttp session, so a slow Google Books
+    response never blocks the event loop, and runs its on-disk store calls in
+    the default executor.
+    """
+    def __init__(self, **kwargs):
+        """
+        Initializes a new AsyncGoogleBooksClient object, see GoogleBooksClient.
+        """
+        super().__init__(**kwargs)
+        self.http = None
+
+    def _connect(self):
+        """
+        Opens the on-disk store for the current process.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self._openStore()
+            self.pid = os.getpid()
+
+    async def _offload(self, function, *args):
+        """
+        Runs a call which may open, read or write the on-disk store in the default
+        executor, so sqlite never blocks the event loop. Without a store it runs inline.
+        """
+        if self.cache_path is None:
+            return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def lookup(self, isbn):
+        """
+        Retrieves the volume information of a book by its ISBN.
+
+        Args:
+            isbn (str): The ISBN of the book.
+
+        Returns:
+            dict: The volumeInfo of the first matching volume, or None if Google Books has no volume.
+
+        Raises:
+            aiohttp.ClientError: If Google Books could not be reached.
+            asyncio.TimeoutError: If Google Books did not answer in time.
+        """
+        await self._offload(self._connect)
+        found, volume = await self._offload(self._cached, isbn)
+        if found:
+            return volume
+
+        if self.http is None:
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(sock_connect=self.timeout[0], sock_read=self.timeout[1])
+            )
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            async with self.http.get(self.base_url, params={"q": f"isbn:{isbn}"}) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            elapsed = time.perf_counter() - started
+            Metrics.google_books_duration.observe(elapsed, outcome="error")
+            Metrics.google_books_errors.inc(error=type(error).__name__)
+            Profiling.slow_operations.record("googleBooks", "lookup", elapsed, lambda: f"isbn:{isbn} failed: {error!r}")
+            raise
+        elapsed = time.perf_counter() - started
+        Metrics.google_books_duration.observe(elapsed, outcome="ok")
+        Profiling.slow_operations.record("googleBooks", "lookup", elapsed, lambda: f"isbn:{isbn}")
+        return await self._offload(self._store, isbn, data)
+
+    async def close(self):
+        """
+        Closes the connections to Google Books.
+        """
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
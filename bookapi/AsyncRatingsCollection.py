@@ -0,0 +1,271 @@
+import logging
+import time
+import pymongo
+from pymongo import ReturnDocument, UpdateOne, DeleteOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from bson.objectid import ObjectId
+import Database
+import AsyncCatalogStats
+from RatingsCollection import RATING_FIELDS, RATING_INDEXES, HIDDEN_FIELDS, genreTotals, MIGRATION_UPDATE, TOP_MIN_COUNT, TOP_SIZE, valueUpdate, topChangedBy
+
+logger = logging.getLogger(__name__)
+
+class AsyncRatingsCollection:
+    """
+    This class represents a collection of ratings for the asyncio service mode.
+    It mirrors RatingsCollection method for method, with every database call awaited,
+    and shares its storage model and leaderboard document.
+    """
+    def __init__(self, database=None):
+        """
+        Initializes a new AsyncRatingsCollection object.
+
+        Args:
+            database (Database): The database holding the ratings, defaults to the shared database.
+        """
+        self.database = database or Database.database
+        self.stats = AsyncCatalogStats.AsyncCatalogStats(self.database)
+
+    @property
+    def collection(self):
+        return self.database.asyncCollection("ratings")
+
+    @property
+    def leaderboard(self):
+        return self.database.asyncCollection("leaderboard")
+
+    async def ensureIndexes(self):
+        """
+        Creates the indexes supporting the ratings queries, see RatingsCollection.ensureIndexes.
+        """
+        await self.collection.create_indexes(RATING_INDEXES)
+        logger.info("indexes ensured")
+
+    async def insertRating(self, rating):
+        """
+        Inserts a new rating into the collection.
+
+        Returns:
+            str: The ID of the inserted rating as a string, or None if it already exists.
+        """
+        try:
+            result = await self.collection.insert_one(rating)
+        except DuplicateKeyError:
+            logger.info("rating already inserted")
+            return None
+
+        rating_id = str(result.inserted_id)
+        logger.info('inserted rating: %s with ID: %s', rating["title"], rating_id)
+        return rating_id
+
+    async def insertRatings(self, ratings):
+        """
+        Inserts many ratings with a single unordered insert_many.
+
+        Returns:
+            list: The ID of each inserted rating as a string, or None where the insert failed.
+        """
+        if not ratings:
+            return []
+        failed = set()
+        try:
+            await self.collection.insert_many(ratings, ordered=False)
+        except BulkWriteError as error:
+            failed = {write_error["index"] for write_error in error.details["writeErrors"]}
+        logger.info('inserted %s of %s ratings', len(ratings) - len(failed), len(ratings))
+        await self.stats.count(ratings=genreTotals(rating for index, rating in enumerate(ratings) if index not in failed))
+        return [None if index in failed else str(rating["_id"]) for index, rating in enumerate(ratings)]
+
+    async def deleteRating(self, id):
+        """
+        Deletes a rating from the collection by its ID.
+
+        Returns:
+            bool: True if the rating was deleted, False otherwise.
+        """
+        rating = await self.collection.find_one_and_delete({"_id": ObjectId(id)}, projection={"genre": 1, "count": 1, "sum": 1})
+        if rating:
+            logger.info('deleted rating with ID: %s', id)
+            await self.stats.count(ratings=genreTotals([rating], -1))
+            await self.updateTop(id)
+            return True
+        else:
+            logger.debug("rating not in collection")
+            return False
+
+    async def deleteRatings(self, ids, session=None):
+        """
+        Deletes many ratings with a single unordered bulk_write, see RatingsCollection.deleteRatings.
+        """
+        if ids:
+            cursor = self.collection.find(
+                {"_id": {"$in": [ObjectId(id) for id in ids]}}, {"genre": 1, "count": 1, "sum": 1}, session=session
+            )
+            ratings = [rating async for rating in cursor]
+            result = await self.collection.bulk_write([DeleteOne({"_id": ObjectId(id)}) for id in ids], ordered=False, session=session)
+            await self.stats.count(ratings=genreTotals(ratings, -1), session=session)
+            logger.info('deleted %s ratings', result.deleted_count)
+
+    async def renameRatings(self, ids, title, session=None):
+        """
+        Sets the title of many ratings after their books were renamed.
+        """
+        if ids:
+            updates = [UpdateOne({"_id": ObjectId(id)}, {"$set": {"title": title}}) for id in ids]
+            await self.collection.bulk_write(updates, ordered=False, session=session)
+
+    async def changeGenre(self, ids, genre, session=None):
+        """
+        Sets the genre of many ratings after their books moved to another genre, see RatingsCollection.changeGenre.
+        """
+        query = {"_id": {"$in": [ObjectId(id) for id in ids]}, "genre": {"$ne": genre}}
+        ratings = [rating async for rating in self.collection.find(query, {"genre": 1, "count": 1, "sum": 1}, session=session)]
+        if not ratings:
+            return
+        await self.collection.update_many({"_id": {"$in": [rating["_id"] for rating in ratings]}}, {"$set": {"genre": genre}}, session=session)
+        totals = genreTotals(ratings, -1)
+        totals[genre] = genreTotals([{**rating, "genre": genre} for rating in ratings])[genre]
+        await self.stats.count(ratings=totals, session=session)
+
+    async def findRating(self, id):
+        """
+        Finds a rating by its ID.
+
+        Returns:
+            tuple: A tuple containing (bool, rating).
+        """
+        rating = await self.collection.find_one({"_id": ObjectId(id)}, HIDDEN_FIELDS)
+        if rating:
+            rating["id"] = str(rating.pop("_id"))
+            logger.debug('found rating: %s with ID: %s', rating["title"], id)
+            return True, rating
+        else:
+            logger.debug("rating not in collection")
+            return False, None
+
+    async def updateRating(self, id, value):
+        """
+        Updates a rating's value (adds a new value) in a single atomic update,
+        see RatingsCollection.updateRating.
+
+        Returns:
+            tuple: A tuple containing (bool, float).
+        """
+        rating = await self.collection.find_one_and_update(
+            {"_id": ObjectId(id)},
+            valueUpdate(value),
+            projection={"title": 1, "average": 1, "count": 1, "genre": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not rating:
+            logger.debug("rating not in collection")
+            return False, None
+        await self.stats.count(ratings={rating.get("genre"): (1, int(value))})
+
+        logger.info('updated rating: %s with ID: %s', rating["title"], id)
+        await self.updateTop(id, rating)
+        return True, rating["average"]
+
+    async def migrateRatings(self):
+        """
+        Converts ratings still storing a "values" list to the histogram model,
+        see RatingsCollection.migrateRatings.
+
+        Returns:
+            int: The number of migrated ratings.
+        """
+        result = await self.collection.update_many({"values": {"$exists": True}}, MIGRATION_UPDATE)
+        logger.info('migrated %s ratings', result.modified_count)
+        return result.modified_count
+
+    def exportRatings(self, batch_size=1000):
+        """
+        Iterates over every rating in _id order, see RatingsCollection.exportRatings.
+        """
+        return self.collection.find({}, {"title": 0, "genre": 0}, batch_size=batch_size).sort("_id", pymongo.ASCENDING)
+
+    async def findRatings(self, limit=None, after=None, fields=None, batch_size=500):
+        """
+        Iterates over the ratings straight from the database cursor, see RatingsCollection.findRatings.
+
+        Returns:
+            async generator: The ratings.
+        """
+        pipeline = Database.listPipeline({}, fields or RATING_FIELDS, limit, after)
+        async for rating in await self.collection.aggregate(pipeline, batchSize=batch_size):
+            yield rating
+
+    async def retrieveAllRatings(self):
+        """
+        Retrieves all ratings in the collection.
+
+        Returns:
+            list: A list of all the ratings.
+        """
+        return [rating async for rating in self.findRatings()]
+
+    async def refreshTop(self):
+        """
+        Recomputes the leaderboard document, see RatingsCollection.refreshTop.
+
+        Returns:
+            list: The top ratings.
+        """
+        computed_at = time.time()
+        eligible = {"count": {"$gte": TOP_MIN_COUNT}}
+        highest = await self.collection.find(eligible, {"average": 1}).sort("average", pymongo.DESCENDING).limit(TOP_SIZE).to_list()
+        top_ratings = []
+        threshold = None
+        if highest:
+            threshold = highest[-1]["average"]
+            top_ratings = await self.collection.find(
+                {"count": {"$gte": TOP_MIN_COUNT}, "average": {"$gte": threshold}}, HIDDEN_FIELDS
+            ).sort("average", pymongo.DESCENDING).to_list()
+            for rating in top_ratings:
+                rating["id"] = str(rating.pop("_id"))
+
+        try:
+            await self.leaderboard.update_one(
+                {"_id": "top", "computedAt": {"$lt": computed_at}},
+                {"$set": {
+                    "ratings": top_ratings,
+                    "ids": [rating["id"] for rating in top_ratings],
+                    "threshold": threshold,
+                    "full": len(highest) == TOP_SIZE,
+                    "computedAt": computed_at
+                }},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            logger.debug("newer leaderboard already stored")
+        return top_ratings
+
+    async def updateTop(self, id, rating=None):
+        """
+        Refreshes the leaderboard if a rating write can change it, see topChangedBy.
+        """
+        board = await self.leaderboard.find_one({"_id": "top"}, {"ids": 1, "threshold": 1, "full": 1})
+        if topChangedBy(board, id, rating):
+            await self.refreshTop()
+
+    async def updateTopFor(self, ids):
+        """
+        Refreshes the leaderboard if it holds any of the given ratings, see RatingsCollection.updateTopFor.
+        """
+        if not ids:
+            return
+        board = await self.leaderboard.find_one({"_id": "top"}, {"ids": 1})
+        if board is None or not set(board["ids"]).isdisjoint(ids):
+            await self.refreshTop()
+
+    async def retrieveTop(self):
+        """
+        Retrieves the top three rated ratings from the leaderboard document.
+
+        Returns:
+            list: A list of ratings with the top 3 averages in descending order.
+        """
+        board = await self.leaderboard.find_one({"_id": "top"}, {"ratings": 1})
+        if board is None:
+            return await self.refreshTop()
+        return board["ratings"]
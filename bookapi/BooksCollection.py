@@ -1,19 +1,168 @@
+import re
+import time
+import datetime
+import logging
 import pymongo
+from pymongo import UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from bson.objectid import ObjectId
+import Database
+import CatalogStats
+
+logger = logging.getLogger(__name__)
+
+BOOK_FIELDS = ["title", "ISBN", "genre", "authors", "publisher", "publishedDate"]
+
+BOOK_INDEXES = [
+    pymongo.IndexModel([("ISBN", pymongo.ASCENDING)], unique=True, name="ISBN_unique"),
+    pymongo.IndexModel([("title", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], name="title"),
+    pymongo.IndexModel([("genre", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], name="genre"),
+    pymongo.IndexModel([("authors", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], name="authors"),
+    pymongo.IndexModel([("publisher", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], name="publisher"),
+    pymongo.IndexModel([("publishedDate", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)], name="publishedDate"),
+    pymongo.IndexModel([("searchTokens", pymongo.ASCENDING)], name="searchTokens"),
+    pymongo.IndexModel(
+        [("enrichment", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+        name="enrichment_pending",
+        partialFilterExpression={"enrichment": "pending"}
+    ),
+]
+# The ISBNs held by more than one book, the unique ISBN index cannot be built while any exist.
+DUPLICATE_ISBN_PIPELINE = [
+    {"$group": {"_id": "$ISBN", "count": {"$sum": 1}}},
+    {"$match": {"count": {"$gt": 1}}},
+    {"$sort": {"_id": 1}},
+]
+# searchTokens is an internal field, never part of a response.
+HIDDEN_FIELDS = {"searchTokens": 0, "enrichmentLease": 0}
+# The book fields the catalog statistics count, see CatalogStats.
+STAT_PROJECTION = {field: 1 for field in CatalogStats.STAT_FIELDS.values()}
+
+def duplicateIsbnError(duplicates):
+    """
+    Builds the error raised when the unique ISBN index cannot be built, naming the duplicated ISBNs.
+
+    Args:
+        duplicates (list): The documents of DUPLICATE_ISBN_PIPELINE.
+    """
+    listed = ", ".join(f'{duplicate["_id"]} ({duplicate["count"]} books)' for duplicate in duplicates[:10])
+    more = f" and {len(duplicates) - 10} more" if len(duplicates) > 10 else ""
+    return ValueError(
+        f"cannot build the unique ISBN index, {len(duplicates)} ISBNs are held by more than one book: "
+        f"{listed}{more}. Delete or fix the duplicate books and restart the service."
+    )
+
+def tokenize(text):
+    """
+    Splits text into lowercase word tokens, in order and without repeats.
+    """
+    return list(dict.fromkeys(re.findall(r"\w+", text.lower()))) if isinstance(text, str) else []
+
+def searchTokens(book):
+    """
+    Computes the tokens a book is found by in GET /books/search, from its title and authors.
+    """
+    authors = book.get("authors")
+    return list(dict.fromkeys(tokenize(book.get("title")) + (tokenize(authors) if authors != "missing" else [])))
+
+def searchQuery(tokens):
+    """
+    Builds the query for books holding every token, the last one as a prefix so
+    partially typed words match. An anchored regex on the lowercase tokens is
+    answered from the multikey searchTokens index like a range query.
+    """
+    *words, prefix = tokens
+    query = {"searchTokens": {"$regex": "^" + re.escape(prefix)}}
+    if words:
+        query = {"$and": [{"searchTokens": {"$all": words}}, query]}
+    return query
+
+def rankBooks(books, tokens, limit):
+    """
+    Orders search candidates by relevance: whole-word title matches count the most,
+    then whole-word author matches and prefix matches, with a bonus for titles
+    starting with the searched text.
+
+    Returns:
+        list: At most limit books, the most relevant first.
+    """
+    phrase = " ".join(tokens)
+    last = len(tokens) - 1
+    ranked = []
+    for book in books:
+        title = tokenize(book.get("title"))
+        authors = tokenize(book.get("authors"))
+        score = 0
+        for index, token in enumerate(tokens):
+            if token in title:
+                score += 4
+            elif index == last and any(word.startswith(token) for word in title):
+                score += 2
+            if token in authors:
+                score += 3
+            elif index == last and any(word.startswith(token) for word in authors):
+                score += 1
+        if " ".join(title).startswith(phrase):
+            score += 2
+        ranked.append((-score, book.get("title") or "", book))
+    ranked.sort(key=lambda entry: entry[:2])
+    return [book for score, title, book in ranked[:limit]]
 
 class BooksCollection:
     """
     This class represents a collection of books. It provides methods
-    to insert, delete, find, update, retrieve all books, retrieve books
-    based on parameters, and retrieve a list of all ISBNs in the collection.
+    to insert, delete, find, update, retrieve all books and retrieve books
+    based on parameters.
     """
-    def __init__(self):
+    def __init__(self, database=None):
         """
         Initializes a new BooksCollection object.
+
+        Args:
+            database (Database): The database holding the books, defaults to the shared database.
+        """
+        self.database = database or Database.database
+        self.stats = CatalogStats.CatalogStats(self.database)
+        self.listeners = []
+
+    @property
+    def collection(self):
+        return self.database.collection("books")
+
+    def addListener(self, listener):
         """
-        self.client = pymongo.MongoClient("mongodb://mongo:27017/")
-        self.db = self.client["library"]
-        self.collection = self.db["books"]
+        Registers a function called after every write to the collection.
+
+        Args:
+            listener (callable): Called with the event ("insert", "update" or "delete")
+                and the list of the IDs of the written books.
+        """
+        self.listeners.append(listener)
+
+    def notify(self, event, ids):
+        """
+        Calls the registered listeners for a write.
+        """
+        for listener in self.listeners:
+            listener(event, ids)
+
+    def ensureIndexes(self):
+        """
+        Creates the indexes the collection relies on. The ISBN index is unique so
+        duplicate inserts are rejected by the database, and every filterable book
+        field gets a secondary index for GET /books queries. The secondary indexes
+        end with _id so filtered pages come back in _id order without a sort.
+        Safe to call repeatedly, existing indexes are left untouched.
+
+        Raises:
+            ValueError: If the ISBN index is missing and books share an ISBN, so it cannot be built.
+        """
+        if "ISBN_unique" not in self.collection.index_information():
+            duplicates = list(self.collection.aggregate(DUPLICATE_ISBN_PIPELINE, allowDiskUse=True))
+            if duplicates:
+                raise duplicateIsbnError(duplicates)
+        self.collection.create_indexes(BOOK_INDEXES)
+        logger.info("indexes ensured")
     
     def insertBook(self, book):
         """
@@ -26,15 +175,71 @@ class BooksCollection:
         Returns:
             str: The ID of the inserted book as a string, or None if a duplicate ISBN is found.
         """
-        if self.collection.find_one({"ISBN": book["ISBN"]}):
-            print("BookCollection: book already inserted")
+        book["searchTokens"] = searchTokens(book)
+        try:
+            result = self.collection.insert_one(book)
+        except DuplicateKeyError:
+            logger.info("book already inserted")
             return None
-        
-        result = self.collection.insert_one(book)
+
         book_id = str(result.inserted_id)
-        print(f'BooksCollection: inserted book: {book["title"]} with ID: {book_id}')
+        logger.info('inserted book: %s with ID: %s', book["title"], book_id)
+        self.stats.count(added=[book])
+        self.notify("insert", [book_id])
         return book_id
     
+    def insertBooks(self, books):
+        """
+        Inserts many books with a single unordered insert_many, so one duplicate
+        ISBN does not stop the rest of the batch.
+
+        Args:
+            books (list): A list of book dictionaries, see insertBook.
+
+        Returns:
+            list: The ID of each inserted book as a string, or None where the insert failed,
+                in the order of the given books.
+        """
+        if not books:
+            return []
+        for book in books:
+            book["searchTokens"] = searchTokens(book)
+        failed = set()
+        try:
+            self.collection.insert_many(books, ordered=False)
+        except BulkWriteError as error:
+            failed = {write_error["index"] for write_error in error.details["writeErrors"]}
+        logger.info('inserted %s of %s books', len(books) - len(failed), len(books))
+        ids = [None if index in failed else str(book["_id"]) for index, book in enumerate(books)]
+        self.stats.count(added=[book for index, book in enumerate(books) if index not in failed])
+        self.notify("insert", [id for id in ids if id is not None])
+        return ids
+
+    def isbnExists(self, isbn):
+        """
+        Checks on the unique ISBN index whether a book with the given ISBN is already in the collection.
+
+        Args:
+            isbn (str): The ISBN of the book.
+
+        Returns:
+            bool: True if the ISBN is taken, False otherwise.
+        """
+        return self.collection.find_one({"ISBN": isbn}, {"_id": 1}) is not None
+
+    def findExistingISBNs(self, isbns):
+        """
+        Finds which of the given ISBNs already belong to a book in the collection.
+
+        Args:
+            isbns (list): A list of ISBNs.
+
+        Returns:
+            set: The ISBNs already in the collection.
+        """
+        books = self.collection.find({"ISBN": {"$in": list(isbns)}}, {"ISBN": 1, "_id": 0})
+        return {book["ISBN"] for book in books}
+
     def deleteBook(self, id):
         """
         Deletes a book from the collection by its ID.
@@ -45,14 +250,153 @@ class BooksCollection:
         Returns:
             bool: True if the book is deleted, False otherwise.
         """
-        result = self.collection.delete_one({"_id": ObjectId(id)})
-        if result.deleted_count > 0:
-            print(f'BooksCollection: deleted book with ID: {id}')
+        book = self.collection.find_one_and_delete({"_id": ObjectId(id)}, projection=STAT_PROJECTION)
+        if book:
+            logger.info('deleted book with ID: %s', id)
+            self.stats.count(removed=[book])
+            self.notify("delete", [id])
             return True
         else:
-            print("BooksCollection: book not in collection")
+            logger.debug("book not in collection")
             return False
         
+    def deleteBooks(self, ids, session=None):
+        """
+        Deletes many books with a single unordered bulk_write. Listeners are not
+        notified here, the caller notifies them once the surrounding transaction
+        has committed, so no reader caches a book the transaction may still keep.
+
+        Args:
+            ids (list): The IDs of the books to delete.
+            session (ClientSession): The session of the surrounding transaction, if any.
+
+        Returns:
+            list: The IDs of the deleted books, the others were not in the collection.
+        """
+        books = list(self.collection.find(
+            {"_id": {"$in": [ObjectId(id) for id in ids]}}, STAT_PROJECTION, session=session
+        ))
+        if books:
+            self.collection.bulk_write([DeleteOne({"_id": book["_id"]}) for book in books], ordered=False, session=session)
+            self.stats.count(removed=books, session=session)
+        logger.info('deleted %s of %s books', len(books), len(ids))
+        return [str(book["_id"]) for book in books]
+
+    def updateBooks(self, ids, fields, session=None):
+        """
+        Sets the same fields on many books with a single unordered bulk_write,
+        keeping their search tokens in line. Listeners are not notified, see deleteBooks.
+
+        Args:
+            ids (list): The IDs of the books to update.
+            fields (dict): The book fields to set and their values.
+            session (ClientSession): The session of the surrounding transaction, if any.
+
+        Returns:
+            list: The IDs of the updated books, the others were not in the collection.
+        """
+        books = list(self.collection.find(
+            {"_id": {"$in": [ObjectId(id) for id in ids]}}, {"title": 1, "authors": 1, **STAT_PROJECTION}, session=session
+        ))
+        updates = []
+        for book in books:
+            update = dict(fields)
+            if "title" in fields or "authors" in fields:
+                update["searchTokens"] = searchTokens({**book, **fields})
+            updates.append(UpdateOne({"_id": book["_id"]}, {"$set": update}))
+        if updates:
+            self.collection.bulk_write(updates, ordered=False, session=session)
+            self.stats.count(added=[{**book, **fields} for book in books], removed=books, session=session)
+        logger.info('updated %s of %s books', len(books), len(ids))
+        return [str(book["_id"]) for book in books]
+
+    def findIds(self, query, limit=None, session=None):
+        """
+        Finds the IDs of the books matching a query.
+
+        Args:
+            query (dict): The query.
+            limit (int): The maximum number of IDs to retrieve, None for no limit.
+            session (ClientSession): The session of the surrounding transaction, if any.
+
+        Returns:
+            list: The IDs of the matching books.
+        """
+        cursor = self.collection.find(query, {"_id": 1}, session=session)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return [str(book["_id"]) for book in cursor]
+
+    def finishEnrichment(self, id, fields, state=None):
+        """
+        Stores the result of the background enrichment of a book, see Enricher.
+        Only a book still pending is written.
+
+        Args:
+            id (str): The ID of the book.
+            fields (dict): The authors, publisher and publishedDate found, None to keep the current ones.
+            state (str): None once the book is enriched, else its final enrichment state, "notFound" or "failed".
+
+        Returns:
+            bool: True if the book was written, False if it is gone or no longer pending.
+        """
+        query = {"_id": ObjectId(id), "enrichment": "pending"}
+        book = self.collection.find_one(query, {"title": 1, **STAT_PROJECTION})
+        if not book:
+            return False
+        update = {"$set": dict(fields, searchTokens=searchTokens({**book, **fields})) if fields else {}}
+        update["$unset"] = {"enrichmentLease": ""}
+        if state is None:
+            update["$unset"]["enrichment"] = ""
+        else:
+            update["$set"]["enrichment"] = state
+        result = self.collection.update_one(query, update)
+        if result.modified_count == 0:
+            return False
+        logger.info('finished enrichment of book with ID: %s', id)
+        if fields:
+            self.stats.count(added=[{**book, **fields}], removed=[book])
+        self.notify("update", [id])
+        return True
+
+    def claimPendingEnrichment(self, older_than, lease, limit=1000):
+        """
+        Claims books waiting for their background enrichment which no process holds
+        a lease on. Each book is claimed with an atomic find_one_and_update setting its
+        "enrichmentLease", so of the processes sweeping at once only one gets it.
+
+        Args:
+            older_than (float): Only claim books inserted before this UNIX time.
+            lease (float): Seconds the claim lasts, after which another process may claim the book.
+            limit (int): The maximum number of books to claim.
+
+        Returns:
+            list: The claimed books, with their ISBN.
+        """
+        before = ObjectId.from_datetime(datetime.datetime.fromtimestamp(older_than, datetime.timezone.utc))
+        now = time.time()
+        query = {"enrichment": "pending", "_id": {"$lt": before}, "enrichmentLease": {"$not": {"$gte": now}}}
+        books = []
+        while len(books) < limit:
+            book = self.collection.find_one_and_update(
+                query, {"$set": {"enrichmentLease": now + lease}}, {"ISBN": 1}, sort=[("_id", pymongo.ASCENDING)]
+            )
+            if book is None:
+                break
+            books.append(book)
+        return books
+
+    def renewEnrichmentLease(self, id, lease):
+        """
+        Extends the claim of this process on a book still pending, see claimPendingEnrichment.
+
+        Args:
+            id (str): The ID of the book.
+            lease (float): Seconds from now the claim lasts.
+        """
+        self.collection.update_one({"_id": ObjectId(id), "enrichment": "pending"},
+                                   {"$set": {"enrichmentLease": time.time() + lease}})
+
     def findBook(self, id):
         """
         Finds a book by its ID.
@@ -65,14 +409,14 @@ class BooksCollection:
                 - bool: True if the book is found, False otherwise.
                 - book (dict): The book if found, None otherwise.
         """
-        book = self.collection.find_one({"_id": ObjectId(id)})
+        book = self.collection.find_one({"_id": ObjectId(id)}, HIDDEN_FIELDS)
         if book:
             book["id"] = str(book["_id"])
             del book["_id"]
-            print(f'BooksCollection: found book: {book["title"]} with ID: {id}')
+            logger.debug('found book: %s with ID: %s', book["title"], id)
             return True, book
         else:
-            print("BooksCollection: book not in collection")
+            logger.debug("book not in collection")
             return False, None
         
     def updateBook(self, id, book):
@@ -84,16 +428,128 @@ class BooksCollection:
             book (dict): A dictionary containing the updated book information.
 
         Returns:
-            bool: True if the book is updated, False otherwise.
+            bool: True if the book is updated, False if it is not in the collection,
+                None if another book already has the ISBN.
         """
-        result = self.collection.update_one({"_id": ObjectId(id)}, {"$set": book})
-        if result.modified_count > 0:
-            print(f'BooksCollection: updated book with ID: {id}')
+        if "title" in book and "authors" in book:
+            book = dict(book, searchTokens=searchTokens(book))
+        try:
+            before = self.collection.find_one_and_update(
+                {"_id": ObjectId(id)}, {"$set": book}, return_document=ReturnDocument.BEFORE
+            )
+        except DuplicateKeyError:
+            logger.info("ISBN already used by another book")
+            return None
+        # Like update_one's modified count: a write setting every field to its current value changes nothing.
+        if before and any(before.get(field) != value for field, value in book.items()):
+            logger.info('updated book with ID: %s', id)
+            self.stats.count(added=[{**before, **book}], removed=[before])
+            self.notify("update", [id])
             return True
         else:
-            print("BooksCollection: book not in collection")
+            logger.debug("book not in collection")
             return False
     
+    def exportBooks(self, batch_size=1000):
+        """
+        Iterates over every book in _id order, see CatalogDump.exportRecords.
+
+        Returns:
+            Cursor: The books.
+        """
+        return self.collection.find({}, HIDDEN_FIELDS, batch_size=batch_size).sort("_id", pymongo.ASCENDING)
+
+    def findBooks(self, query=None, limit=None, after=None, fields=None, batch_size=500):
+        """
+        Iterates over the books matching a query straight from the database cursor.
+        When a limit or an after cursor is given the books come in _id order, so
+        passing the ID of the last book of a page as after retrieves the next page.
+
+        Args:
+            query (dict): A dictionary where keys represent search fields and values represent a parameter.
+            limit (int): The maximum number of books to retrieve, None for no limit.
+            after (str): Only retrieve books with an ID greater than this one.
+            fields (list): The book fields to retrieve, None for all of them. "id" is always retrieved.
+            batch_size (int): The number of books fetched from the database per round trip.
+
+        Returns:
+            generator: The matching books.
+        """
+        pipeline = Database.listPipeline(query or {}, fields or BOOK_FIELDS, limit, after)
+        yield from self.collection.aggregate(pipeline, batchSize=batch_size)
+
+    def findBooksByQueries(self, queries, batch_size=500):
+        """
+        Answers many queries with a single indexed find. The queries are combined
+        with $or, so each one can use its own index, and every returned book is
+        matched back against each query. A book matching several queries is read once.
+
+        Args:
+            queries (list): Dictionaries where keys represent search fields and values represent a parameter.
+            batch_size (int): The number of books fetched from the database per round trip.
+
+        Returns:
+            list: For each query, in order, the list of books matching it.
+        """
+        results = [[] for _ in queries]
+        if not queries:
+            return results
+        positions = {}
+        for position, query in enumerate(queries):
+            positions.setdefault(tuple(sorted(query.items())), []).append(position)
+        combined = [dict(query) for query in positions.keys()]
+        query = combined[0] if len(combined) == 1 else {"$or": combined}
+        for book in self.collection.find(query, HIDDEN_FIELDS, batch_size=batch_size):
+            matches = [key for key in positions.keys() if all(book.get(field) == value for field, value in key)]
+            book["id"] = str(book.pop("_id"))
+            for key in matches:
+                for position in positions[key]:
+                    results[position].append(book)
+        return results
+
+    def searchBooks(self, text, limit=20, candidates=1000):
+        """
+        Searches books by the words of their title and authors, case-insensitively.
+        Every word must match, the last one as a prefix for autocomplete. Candidates
+        are read through the searchTokens index, so the cost depends on the number
+        of matching books rather than on the size of the catalog.
+
+        Args:
+            text (str): The searched text.
+            limit (int): The maximum number of books to retrieve.
+            candidates (int): The maximum number of matching books ranked.
+
+        Returns:
+            list: The matching books, the most relevant first.
+        """
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        books = list(self.collection.find(searchQuery(tokens), HIDDEN_FIELDS).limit(candidates))
+        for book in books:
+            book["id"] = str(book.pop("_id"))
+        return rankBooks(books, tokens, limit)
+
+    def indexSearchTokens(self, batch_size=1000):
+        """
+        Computes the search tokens of books stored before search existed.
+
+        Returns:
+            int: The number of books updated.
+        """
+        updated = 0
+        books = self.collection.find({"searchTokens": {"$exists": False}}, {"title": 1, "authors": 1})
+        updates = []
+        for book in books:
+            updates.append(UpdateOne({"_id": book["_id"]}, {"$set": {"searchTokens": searchTokens(book)}}))
+            if len(updates) == batch_size:
+                updated += self.collection.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if updates:
+            updated += self.collection.bulk_write(updates, ordered=False).modified_count
+        logger.info('indexed search tokens of %s books', updated)
+        return updated
+
     def retrieveAllBooks(self):
         """
         Retrieves all books currently in the collection.
@@ -101,11 +557,7 @@ class BooksCollection:
         Returns:
             list: A list of books.
         """
-        books = list(self.collection.find())
-        for book in books:
-            book["id"] = str(book["_id"])
-            del book["_id"]
-        return books
+        return list(self.findBooks())
     
     def retrieveBooksByParameter(self, args):
         """
@@ -117,19 +569,5 @@ class BooksCollection:
         Returns:
             list: A list of books matching the given parameters.
         """
-        query = {key: value for key, value in args.items()}
-        books = list(self.collection.find(query))
-        for book in books:
-            book["id"] = str(book["_id"])
-            del book["_id"]
-        return books
-    
-    def retrieveISBNList(self):
-        """
-        Retrieves all the books ISBNs.
+        return list(self.findBooks({key: value for key, value in args.items()}))
 
-        Returns:
-            list: A list of all the books ISBNs.
-        """
-        books = self.collection.find({}, {"ISBN": 1})
-        return [book["ISBN"] for book in books]
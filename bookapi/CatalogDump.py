@@ -0,0 +1,267 @@
+import zlib
+from bson.objectid import ObjectId
+import JsonEncoder
+import Validation
+
+# A dump is gzip compressed NDJSON with one record per book: the book fields,
+# its "id" and its "rating" without the title and genre copied from the book.
+BOOK_FIELDS = ["title", "ISBN", "genre", "authors", "publisher", "publishedDate"]
+ENRICHMENT_STATES = ["pending", "notFound", "failed"]
+STARS = ["1", "2", "3", "4", "5"]
+GZIP_MAGIC = b"\x1f\x8b"
+
+def record(book, rating):
+    """
+    Builds the dump record of a book and its rating, which is None if the book has none.
+    """
+    book["id"] = str(book.pop("_id"))
+    if rating is not None:
+        del rating["_id"]
+    book["rating"] = rating
+    return book
+
+def exportRecords(books, ratings):
+    """
+    Joins books with their ratings by merging the two cursors, both in _id order,
+    so neither collection is held in memory. Ratings without a book are left out.
+
+    Args:
+        books (iterable): The books in _id order, see BooksCollection.exportBooks.
+        ratings (iterable): The ratings in _id order, see RatingsCollection.exportRatings.
+
+    Returns:
+        generator: The dump records.
+    """
+    ratings = iter(ratings)
+    rating = next(ratings, None)
+    for book in books:
+        while rating is not None and rating["_id"] < book["_id"]:
+            rating = next(ratings, None)
+        if rating is not None and rating["_id"] == book["_id"]:
+            yield record(book, rating)
+            rating = next(ratings, None)
+        else:
+            yield record(book, None)
+
+async def exportRecordsAsync(books, ratings):
+    """
+    Joins books with their ratings from async cursors, see exportRecords.
+    """
+    rating = await anext(ratings, None)
+    async for book in books:
+        while rating is not None and rating["_id"] < book["_id"]:
+            rating = await anext(ratings, None)
+        if rating is not None and rating["_id"] == book["_id"]:
+            yield record(book, rating)
+            rating = await anext(ratings, None)
+        else:
+            yield record(book, None)
+
+class GzipEncoder:
+    """
+    This class represents an incremental gzip compressor for streamed responses.
+    """
+    def __init__(self, level=6):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def feed(self, chunk):
+        return self.compressor.compress(chunk)
+
+    def finish(self):
+        return self.compressor.flush()
+
+def gzipChunks(chunks, level=6):
+    """
+    Compresses a stream of chunks as a single gzip member.
+
+    Returns:
+        generator: The compressed chunks, empty ones left out.
+    """
+    encoder = GzipEncoder(level)
+    for chunk in chunks:
+        compressed = encoder.feed(chunk)
+        if compressed:
+            yield compressed
+    yield encoder.finish()
+
+class LineDecoder:
+    """
+    This class represents an incremental reader of NDJSON uploaded in chunks of
+    any size, gzip compressed or not, which it detects from the first bytes.
+    """
+    def __init__(self):
+        self.decompressor = None
+        self.started = False
+        self.buffer = b""
+
+    def feed(self, chunk):
+        """
+        Decodes the next chunk of the upload.
+
+        Returns:
+            list: The lines completed by the chunk.
+
+        Raises:
+            zlib.error: If the upload is not valid gzip data.
+        """
+        if not self.started:
+            self.buffer += chunk
+            if len(self.buffer) < len(GZIP_MAGIC):
+                return []
+            self.started = True
+            chunk, self.buffer = self.buffer, b""
+            if chunk.startswith(GZIP_MAGIC):
+                self.decompressor = zlib.decompressobj(31)
+        if self.decompressor is not None:
+            chunk = self.decompressor.decompress(chunk)
+            # A dump made of several concatenated gzip members is read as one.
+            while self.decompressor.eof and self.decompressor.unused_data:
+                rest = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(31)
+                chunk += self.decompressor.decompress(rest)
+        lines = (self.buffer + chunk).split(b"\n")
+        self.buffer = lines.pop()
+        return lines
+
+    def finish(self):
+        """
+        Returns the last line of the upload.
+
+        Raises:
+            zlib.error: If the gzip data is truncated.
+        """
+        if self.decompressor is not None:
+            self.buffer += self.decompressor.flush()
+            if not self.decompressor.eof:
+                raise zlib.error("truncated gzip data")
+        lines = [self.buffer] if self.buffer else []
+        self.buffer = b""
+        return lines
+
+def ratingDocument(book, rating):
+    """
+    Builds the rating document of an imported book. The count, sum and average
+    are recomputed from the histogram.
+
+    Returns:
+        dict: The rating document, None if the rating is invalid.
+    """
+    counts = (rating or {}).get("counts", {})
+    if not isinstance(counts, dict) or [star for star in counts if star not in STARS] != []:
+        return None
+    counts = {star: counts.get(star, 0) for star in STARS}
+    if [number for number in counts.values() if type(number) is not int or number < 0] != []:
+        return None
+    count = sum(counts.values())
+    total = sum(int(star) * number for star, number in counts.items())
+    return {
+        "_id": book["_id"],
+        "title": book["title"],
+        "genre": book["genre"],
+        "counts": counts,
+        "count": count,
+        "sum": total,
+        "average": round(total / count, 2) if count else 0
+    }
+
+def parseRecord(line):
+    """
+    Reads a dump record.
+
+    Args:
+        line (bytes): One line of the dump.
+
+    Returns:
+        tuple: A tuple containing (bool, value).
+            - bool: True if the record is valid, False otherwise.
+            - value: The book and rating documents to insert as a tuple if valid, else the reason it is not.
+    """
+    try:
+        data = JsonEncoder.loads(line)
+    except ValueError:
+        return False, "invalid JSON"
+    if not isinstance(data, dict):
+        return False, "not an object"
+    id = data.get("id")
+    if id is not None and not (isinstance(id, str) and ObjectId.is_valid(id)):
+        return False, "invalid id"
+    if not isinstance(data.get("title"), str) or not Validation.isValidISBN(data.get("ISBN")):
+        return False, "invalid title or ISBN"
+    if data.get("genre") not in Validation.supported_genre_list:
+        return False, "unsupported genre"
+    book = {"_id": ObjectId(id) if id else ObjectId()}
+    for field in BOOK_FIELDS:
+        value = data.get(field)
+        book[field] = value if isinstance(value, str) and value else "missing"
+    if data.get("enrichment") in ENRICHMENT_STATES:
+        book["enrichment"] = data["enrichment"]
+    rating = ratingDocument(book, data.get("rating"))
+    if rating is None:
+        return False, "invalid rating"
+    return True, (book, rating)
+
+class Importer:
+    """
+    This class represents the import of a dump: it parses records into batches
+    and keeps the report of the import. The caller writes each batch, see main.import_batch.
+    """
+    def __init__(self, batch_size=1000, max_errors=100):
+        """
+        Initializes a new Importer object.
+
+        Args:
+            batch_size (int): The number of records written at once.
+            max_errors (int): The number of invalid records reported by line.
+        """
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.batch = []
+        self.line = 0
+        self.imported = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = []
+
+    def add(self, line):
+        """
+        Parses the next line of the dump.
+
+        Returns:
+            list: A full batch of (book, rating) tuples to write, None if the batch is not full yet.
+        """
+        self.line += 1
+        if not line.strip():
+            return None
+        valid, value = parseRecord(line)
+        if not valid:
+            self.invalid += 1
+            if len(self.errors) < self.max_errors:
+                self.errors.append({"line": self.line, "error": value})
+            return None
+        self.batch.append(value)
+        if len(self.batch) < self.batch_size:
+            return None
+        batch, self.batch = self.batch, []
+        return batch
+
+    def finish(self):
+        """
+        Returns the last batch, None if it is empty.
+        """
+        batch, self.batch = self.batch, []
+        return batch or None
+
+    def count(self, batch, imported):
+        """
+        Records how many books of a written batch were imported, the others were already in the catalog.
+        """
+        self.imported += imported
+        self.duplicates += len(batch) - imported
+
+    def report(self):
+        return {
+            "imported": self.imported,
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+            "errors": self.errors
+        }
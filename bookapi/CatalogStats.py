@@ -0,0 +1,233 @@
+import json
+import logging
+import argparse
+from collections import Counter
+from pymongo import UpdateOne, ReplaceOne, DeleteMany
+import Database
+
+logger = logging.getLogger(__name__)
+
+# Book fields counted by the statistics, by the name of the statistic.
+STAT_FIELDS = {"genre": "genre", "year": "publishedDate", "publisher": "publisher"}
+STAT_KINDS = {"genres": "genre", "years": "year", "publishers": "publisher"}
+UNKNOWN = "unknown"
+
+# Counts every statistic from the whole catalog in one pass, see CatalogStats.rebuild.
+# Years are grouped by full date and reduced in Python by statKey, so they are
+# derived exactly like on the write paths.
+REBUILD_PIPELINE = [
+    {"$facet": {
+        "genre": [{"$group": {"_id": "$genre", "books": {"$sum": 1}}}],
+        "year": [{"$group": {"_id": "$publishedDate", "books": {"$sum": 1}}}],
+        "publisher": [{"$group": {"_id": "$publisher", "books": {"$sum": 1}}}],
+        "ratings": [
+            {"$lookup": {"from": "ratings", "localField": "_id", "foreignField": "_id", "as": "rating"}},
+            {"$unwind": "$rating"},
+            {"$group": {"_id": "$genre", "ratings": {"$sum": "$rating.count"}, "ratingSum": {"$sum": "$rating.sum"}}}
+        ]
+    }}
+]
+
+# Copies the genre of every book onto its rating, so rating writes know which genre they count for.
+RATING_GENRE_PIPELINE = [
+    {"$project": {"genre": 1}},
+    {"$merge": {"into": "ratings", "on": "_id", "whenMatched": "merge", "whenNotMatched": "discard"}}
+]
+
+def statKey(kind, value):
+    """
+    Computes the key a book is counted under for a statistic.
+
+    Args:
+        kind (str): "genre", "year" or "publisher".
+        value (str): The value of the book field of the statistic.
+
+    Returns:
+        str: The key, the four digit year for "year", "unknown" for a missing value.
+    """
+    if not isinstance(value, str) or value in ("", "missing"):
+        return UNKNOWN
+    if kind == "year":
+        return value[:4] if value[:4].isdigit() else UNKNOWN
+    return value
+
+def statId(kind, key):
+    return f"{kind}:{key}"
+
+def bookCounts(added=(), removed=()):
+    """
+    Computes the net change of the book counters for books added and removed.
+    An updated book is removed with its old fields and added with its new ones.
+
+    Returns:
+        Counter: The change of each counter by (kind, key), without the unchanged ones.
+    """
+    counts = Counter()
+    for sign, books in ((1, added), (-1, removed)):
+        for book in books:
+            for kind, field in STAT_FIELDS.items():
+                counts[(kind, statKey(kind, book.get(field)))] += sign
+    return Counter({key: number for key, number in counts.items() if number})
+
+def counterUpdates(books=None, ratings=None):
+    """
+    Builds the upserts applying counter changes.
+
+    Args:
+        books (Counter): The change of the book counters by (kind, key), see bookCounts.
+        ratings (dict): The change of the number and sum of rating values by genre, as (count, sum) tuples.
+
+    Returns:
+        list: The UpdateOne requests.
+    """
+    updates = []
+    for (kind, key), number in (books or {}).items():
+        updates.append(UpdateOne(
+            {"_id": statId(kind, key)},
+            {"$inc": {"books": number}, "$setOnInsert": {"kind": kind, "key": key}},
+            upsert=True
+        ))
+    for genre, (count, total) in (ratings or {}).items():
+        if count or total:
+            key = statKey("genre", genre)
+            updates.append(UpdateOne(
+                {"_id": statId("genre", key)},
+                {"$inc": {"ratings": count, "ratingSum": total}, "$setOnInsert": {"kind": "genre", "key": key}},
+                upsert=True
+            ))
+    return updates
+
+def statDocuments(facets):
+    """
+    Builds the statistics documents from the result of REBUILD_PIPELINE.
+    """
+    documents = {}
+    def document(kind, key):
+        id = statId(kind, key)
+        if id not in documents:
+            documents[id] = {"_id": id, "kind": kind, "key": key, "books": 0}
+        return documents[id]
+    for kind in STAT_FIELDS:
+        for group in facets[kind]:
+            document(kind, statKey(kind, group["_id"]))["books"] += group["books"]
+    for group in facets["ratings"]:
+        entry = document("genre", statKey("genre", group["_id"]))
+        entry["ratings"] = entry.get("ratings", 0) + group["ratings"]
+        entry["ratingSum"] = entry.get("ratingSum", 0) + group["ratingSum"]
+    return list(documents.values())
+
+def formatStats(documents, kinds=None):
+    """
+    Builds the GET /stats response from the statistics documents.
+
+    Args:
+        documents (iterable): The statistics documents.
+        kinds (list): The statistics to include, by response name, None for all of them.
+
+    Returns:
+        dict: The number of books by key of every statistic, and for genres the
+            number of rating values and their average.
+    """
+    stats = {name: {} for name in (kinds or STAT_KINDS)}
+    names = {kind: name for name, kind in STAT_KINDS.items()}
+    for document in documents:
+        name = names.get(document["kind"])
+        if name not in stats or document.get("books", 0) <= 0:
+            continue
+        if document["kind"] == "genre":
+            count = document.get("ratings", 0)
+            stats[name][document["key"]] = {
+                "books": document["books"],
+                "ratings": count,
+                "averageRating": round(document.get("ratingSum", 0) / count, 2) if count else 0
+            }
+        else:
+            stats[name][document["key"]] = document["books"]
+    return stats
+
+class CatalogStats:
+    """
+    This class represents the catalog statistics: the number of books per genre,
+    per year of publication and per publisher, and the number and average of the
+    rating values per genre. Each counter is a small document of the stats
+    collection, incremented on the write paths of BooksCollection and
+    RatingsCollection, so reading the statistics does not depend on the size of
+    the catalog. rebuild recomputes every counter from the catalog to reconcile drift.
+    """
+    def __init__(self, database=None):
+        """
+        Initializes a new CatalogStats object.
+
+        Args:
+            database (Database): The database holding the catalog, defaults to the shared database.
+        """
+        self.database = database or Database.database
+
+    @property
+    def collection(self):
+        return self.database.collection("stats")
+
+    def count(self, added=(), removed=(), ratings=None, session=None):
+        """
+        Applies the changes of a write to the counters.
+
+        Args:
+            added (iterable): The books added, or the new fields of updated books.
+            removed (iterable): The books removed, or the old fields of updated books.
+            ratings (dict): The change of the number and sum of rating values by genre, as (count, sum) tuples.
+            session (ClientSession): The session of the surrounding transaction, if any.
+        """
+        updates = counterUpdates(bookCounts(added, removed), ratings)
+        if updates:
+            self.collection.bulk_write(updates, ordered=False, session=session)
+
+    def retrieve(self, kinds=None):
+        """
+        Retrieves the statistics.
+
+        Args:
+            kinds (list): The statistics to retrieve, "genres", "years" or "publishers", None for all of them.
+
+        Returns:
+            dict: The statistics, see formatStats.
+        """
+        query = {"kind": {"$in": [STAT_KINDS[name] for name in kinds]}} if kinds else {}
+        return formatStats(self.collection.find(query), kinds)
+
+    def rebuild(self):
+        """
+        Recomputes every counter from the catalog with a single $facet aggregation,
+        and copies the genre of every book onto its rating. Writes made while the
+        rebuild runs may be counted twice or not at all, so run it when the catalog is quiet.
+
+        Returns:
+            dict: The number of counters written.
+        """
+        books = self.database.collection("books")
+        facets = next(books.aggregate(REBUILD_PIPELINE))
+        documents = statDocuments(facets)
+        books.aggregate(RATING_GENRE_PIPELINE)
+        writes = [ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents]
+        writes.append(DeleteMany({"_id": {"$nin": [document["_id"] for document in documents]}}))
+        self.collection.bulk_write(writes, ordered=False)
+        logger.info('rebuilt %s catalog statistics', len(documents))
+        return {"counters": len(documents)}
+
+    def buildIfMissing(self):
+        """
+        Builds the statistics of a catalog which has none yet, such as on the first
+        start of a version keeping them. Safe to call repeatedly.
+        """
+        if self.collection.find_one({}, {"_id": 1}) is None:
+            self.rebuild()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintains the catalog statistics served by GET /stats.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild", help="recompute every statistic from the catalog")
+    commands.add_parser("show", help="print the statistics")
+    args = parser.parse_args()
+
+    stats = CatalogStats()
+    result = stats.rebuild() if args.command == "rebuild" else stats.retrieve()
+    print(json.dumps(result, indent=2))
@@ -0,0 +1,172 @@
+import os
+import time
+import logging
+import threading
+from bson import json_util
+from pymongo.errors import PyMongoError, OperationFailure
+import Database
+
+logger = logging.getLogger(__name__)
+
+EVENTS = {"insert": "insert", "update": "update", "replace": "update", "delete": "delete"}
+# Server error codes meaning the stored resume token can no longer be used.
+RESUME_FAILED_CODES = {260, 280, 286}
+NOT_A_REPLICA_SET = 40573
+
+class ChangeWatcher:
+    """
+    This class represents a background thread tailing the change stream of the
+    library database, so writes made by any replica of the service reach the
+    in-process caches of this one within moments. Each change is passed to the
+    listener of its collection like a local write is, see BooksCollection.addListener.
+    Change streams need MongoDB to run as a replica set, a single node one is enough.
+    """
+    def __init__(self, listeners, reset, database=None, token_path=None, retry_interval=2, save_interval=1):
+        """
+        Initializes a new ChangeWatcher object.
+
+        Args:
+            listeners (dict): The listener of each watched collection by name, called
+                with the event ("insert", "update" or "delete") and the list of written IDs.
+            reset (callable): Called when changes may have been missed, to drop every cached entry.
+            database (Database): The database to watch, defaults to the shared database.
+            token_path (str): File keeping the resume token across restarts, None to keep it in memory only.
+            retry_interval (float): Seconds to wait before reopening a failed change stream.
+            save_interval (float): Seconds between writes of the resume token file.
+        """
+        self.listeners = listeners
+        self.reset = reset
+        self.database = database or Database.database
+        self.token_path = token_path
+        self.retry_interval = retry_interval
+        self.save_interval = save_interval
+        self.token = self._loadToken()
+        self.saved_token = self.token
+        self.saved_at = 0
+        self.changes = 0
+        self.resets = 0
+        self.connected = False
+        self.stopping = threading.Event()
+        self.thread = None
+
+    @classmethod
+    def fromEnvironment(cls, listeners, reset):
+        """
+        Creates a ChangeWatcher configured from the CHANGE_STREAM_* environment variables.
+        """
+        return cls(
+            listeners, reset,
+            token_path=os.environ.get("CHANGE_STREAM_TOKEN_PATH") or None,
+            retry_interval=float(os.environ.get("CHANGE_STREAM_RETRY_INTERVAL", 2))
+        )
+
+    def _loadToken(self):
+        if not self.token_path:
+            return None
+        try:
+            with open(self.token_path, "r") as file:
+                return json_util.loads(file.read())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning('ignoring unreadable resume token in %s', self.token_path)
+            return None
+
+    def _saveToken(self, force=False):
+        """
+        Writes the resume token to its file, at most once per save_interval unless forced.
+        The file is replaced atomically so a crash never leaves a partial token.
+        """
+        if not self.token_path or self.token is None or self.token == self.saved_token:
+            return
+        if not force and time.monotonic() - self.saved_at < self.save_interval:
+            return
+        temporary_path = f"{self.token_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            file.write(json_util.dumps(self.token))
+        os.replace(temporary_path, self.token_path)
+        self.saved_token = self.token
+        self.saved_at = time.monotonic()
+
+    def _pipeline(self):
+        return [{"$match": {
+            "ns.coll": {"$in": list(self.listeners.keys())},
+            "operationType": {"$in": list(EVENTS.keys())}
+        }}]
+
+    def dispatch(self, change):
+        """
+        Passes one change stream event to the listener of its collection.
+        """
+        listener = self.listeners.get(change["ns"]["coll"])
+        if listener is not None:
+            listener(EVENTS[change["operationType"]], [str(change["documentKey"]["_id"])])
+        self.changes += 1
+
+    def watchOnce(self):
+        """
+        Opens the change stream, resuming after the last seen change, and dispatches
+        changes until the stream fails or the watcher is stopped.
+        """
+        database = self.database.client[self.database.name]
+        with database.watch(self._pipeline(), resume_after=self.token, max_await_time_ms=1000) as stream:
+            if not self.connected:
+                logger.info('watching changes to %s', ", ".join(self.listeners.keys()))
+            self.connected = True
+            while not self.stopping.is_set() and stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    self.dispatch(change)
+                self.token = stream.resume_token
+                self._saveToken()
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.watchOnce()
+            except OperationFailure as error:
+                self.connected = False
+                if error.code in RESUME_FAILED_CODES:
+                    # The token fell off the oplog: changes were missed, so nothing cached can be trusted.
+                    logger.warning('change stream cannot resume, dropping cached entries: %s', error)
+                    self.token = None
+                    self.resets += 1
+                    self.reset()
+                elif error.code == NOT_A_REPLICA_SET:
+                    logger.error('change streams need MongoDB to run as a replica set: %s', error)
+                else:
+                    logger.warning('change stream failed: %s', error)
+                self.stopping.wait(self.retry_interval)
+            except PyMongoError as error:
+                self.connected = False
+                logger.warning('change stream interrupted: %s', error)
+                self.stopping.wait(self.retry_interval)
+        self._saveToken(force=True)
+
+    def start(self):
+        """
+        Starts the watcher thread of the current process.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="change-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Stops the watcher thread and stores the last resume token.
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def info(self):
+        """
+        Retrieves the state of the watcher.
+
+        Returns:
+            dict: Whether the stream is open, the number of changes dispatched and of cache resets.
+        """
+        return {"connected": self.connected, "changes": self.changes, "resets": self.resets}
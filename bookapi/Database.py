@@ -0,0 +1,244 @@
+import logging
+import os
+import threading
+import pymongo
+from pymongo.write_concern import WriteConcern
+from bson.objectid import ObjectId
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+def listPipeline(query, fields, limit=None, after=None):
+    """
+    Builds the aggregation pipeline of a list read. The database renames _id to a
+    string id in its projection, so documents need no reshaping in Python. When a
+    limit or an after cursor is given the documents come in _id order; the $match,
+    $sort and $limit stages run on the indexes as they would for a find.
+
+    Args:
+        query (dict): The filter of the documents.
+        fields (list): The fields to return. "id" is always returned.
+        limit (int): The maximum number of documents, None for no limit.
+        after (str): Only return documents with an ID greater than this one.
+
+    Returns:
+        list: The pipeline stages.
+    """
+    query = dict(query)
+    if after is not None:
+        query["_id"] = {"$gt": ObjectId(after)}
+    pipeline = [{"$match": query}]
+    if limit is not None or after is not None:
+        pipeline.append({"$sort": {"_id": pymongo.ASCENDING}})
+    if limit is not None:
+        pipeline.append({"$limit": limit})
+    projection = {field: 1 for field in fields if field != "id"}
+    projection.update({"_id": 0, "id": {"$toString": "$_id"}})
+    pipeline.append({"$project": projection})
+    return pipeline
+
+class Database:
+    """
+    This class represents the connection to the library database shared by all
+    the collections of a process. The MongoClient and its connection pool are
+    created lazily on first use and recreated in a forked child process.
+    """
+    def __init__(self, uri="mongodb://mongo:27017/", name="library", max_pool_size=100, min_pool_size=0,
+                 connect_timeout_ms=5000, server_selection_timeout_ms=5000, socket_timeout_ms=None,
+                 write_concern="1", write_timeout_ms=None):
+        """
+        Initializes a new Database object. No connection is opened until the client is first used.
+
+        Args:
+            uri (str): The MongoDB connection string.
+            name (str): The name of the database.
+            max_pool_size (int): The maximum number of connections kept per server.
+            min_pool_size (int): The number of connections kept open per server even when idle.
+            connect_timeout_ms (int): Milliseconds to wait for a connection to open.
+            server_selection_timeout_ms (int): Milliseconds to wait for a usable server.
+            socket_timeout_ms (int): Milliseconds to wait for a reply to a command, None for no limit.
+            write_concern (str): The write concern "w" value, a number of nodes or "majority".
+            write_timeout_ms (int): Milliseconds to wait for the write concern, None for no limit.
+        """
+        self.uri = uri
+        self.name = name
+        self.options = {
+            "maxPoolSize": max_pool_size,
+            "minPoolSize": min_pool_size,
+            "connectTimeoutMS": connect_timeout_ms,
+            "serverSelectionTimeoutMS": server_selection_timeout_ms,
+            "socketTimeoutMS": socket_timeout_ms
+        }
+        w = int(write_concern) if write_concern.isdigit() else write_concern
+        self.write_concern = WriteConcern(w=w, wtimeout=write_timeout_ms)
+        self.lock = threading.Lock()
+        self.pid = None
+        self._client = None
+        self._async_client = None
+        self.transactions = None
+        self.ready = False
+
+    @classmethod
+    def fromEnvironment(cls):
+        """
+        Creates a Database configured from the MONGO_* environment variables.
+
+        Returns:
+            Database: The configured database.
+        """
+        env = os.environ
+        optional_int = lambda name: int(env[name]) if env.get(name) else None
+        return cls(
+            uri=env.get("MONGO_URI", "mongodb://mongo:27017/"),
+            name=env.get("MONGO_DB", "library"),
+            max_pool_size=int(env.get("MONGO_MAX_POOL_SIZE", 100)),
+            min_pool_size=int(env.get("MONGO_MIN_POOL_SIZE", 0)),
+            connect_timeout_ms=int(env.get("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+            server_selection_timeout_ms=int(env.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+            socket_timeout_ms=optional_int("MONGO_SOCKET_TIMEOUT_MS"),
+            write_concern=env.get("MONGO_WRITE_CONCERN", "1"),
+            write_timeout_ms=optional_int("MONGO_WRITE_TIMEOUT_MS")
+        )
+
+    @property
+    def client(self):
+        """
+        The MongoClient of the current process, created on first use.
+        """
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self._client = pymongo.MongoClient(self.uri, **self.options)
+                    self.pid = os.getpid()
+                    self.ready = False
+        return self._client
+
+    def collection(self, name):
+        """
+        Retrieves a collection of the database with the configured write concern.
+
+        Args:
+            name (str): The name of the collection.
+
+        Returns:
+            Collection: The collection.
+        """
+        return self.client[self.name].get_collection(name, write_concern=self.write_concern)
+
+    @property
+    def asyncClient(self):
+        """
+        The AsyncMongoClient used by the asyncio service mode, created on first use
+        with the same settings as the client.
+        """
+        if self._async_client is None:
+            self._async_client = pymongo.AsyncMongoClient(self.uri, **self.options)
+        return self._async_client
+
+    def asyncCollection(self, name):
+        """
+        Retrieves a collection of the database for the asyncio service mode.
+
+        Args:
+            name (str): The name of the collection.
+
+        Returns:
+            AsyncCollection: The collection.
+        """
+        return self.asyncClient[self.name].get_collection(name, write_concern=self.write_concern)
+
+    def supportsTransactions(self):
+        """
+        Checks whether the database runs as a replica set or behind mongos, which
+        multi-document transactions need. The answer is kept per process.
+        """
+        if self.transactions is None or self.transactions[0] != os.getpid():
+            hello = self.client.admin.command("hello")
+            self.transactions = (os.getpid(), "setName" in hello or hello.get("msg") == "isdbgrid")
+        return self.transactions[1]
+
+    def withTransaction(self, callback):
+        """
+        Runs writes to several collections in one transaction when the database
+        supports them, retrying the transaction on transient errors. On a standalone
+        server the writes run without a transaction.
+
+        Args:
+            callback (callable): Called with the session to pass to every write, None without a transaction.
+
+        Returns:
+            The value returned by the callback.
+        """
+        if not self.supportsTransactions():
+            return callback(None)
+        with self.client.start_session() as session:
+            return session.with_transaction(callback)
+
+    async def asyncWithTransaction(self, callback):
+        """
+        Runs writes in one transaction for the asyncio service mode, see withTransaction.
+
+        Args:
+            callback (coroutine function): Called with the session, None without a transaction.
+        """
+        if self.transactions is None or self.transactions[0] != os.getpid():
+            hello = await self.asyncClient.admin.command("hello")
+            self.transactions = (os.getpid(), "setName" in hello or hello.get("msg") == "isdbgrid")
+        if not self.transactions[1]:
+            return await callback(None)
+        async with self.asyncClient.start_session() as session:
+            return await session.with_transaction(callback)
+
+    def reset(self):
+        """
+        Drops the client of the current process so the next use creates a new one.
+        """
+        with self.lock:
+            if self._client is not None and self.pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self.pid = None
+            self.transactions = None
+            self.ready = False
+
+    def ping(self):
+        """
+        Checks that the database answers.
+
+        Returns:
+            bool: True if the database answered, False otherwise.
+        """
+        try:
+            self.client.admin.command("ping")
+            return True
+        except pymongo.errors.PyMongoError:
+            return False
+
+    def isReady(self):
+        """
+        Checks that the current process finished its warmup and the database answers.
+
+        Returns:
+            bool: True if the process can serve traffic, False otherwise.
+        """
+        return self.ready and self.pid == os.getpid() and self.ping()
+
+    def warmup(self, connections, steps=()):
+        """
+        Prepares the process to serve traffic: opens connections to the database
+        with concurrent pings so the first requests do not pay for them, then runs
+        the given setup steps and marks the database as ready.
+
+        Args:
+            connections (int): The number of connections to open.
+            steps (iterable): Callables run once the connections are open, such as index creation.
+        """
+        connections = max(connections, 1)
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            list(executor.map(lambda _: self.client.admin.command("ping"), range(connections)))
+        for step in steps:
+            step()
+        self.ready = True
+        logger.info('warmed up with %s connections', connections)
+
+database = Database.fromEnvironment()
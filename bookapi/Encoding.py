@@ -0,0 +1,177 @@
+import os
+import zlib
+from dataclasses import is_dataclass
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPE = "application/msgpack"
+# Response types worth compressing, the others such as the gzip export are already compact.
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson", MSGPACK_MIMETYPE, "text/plain"}
+CODINGS = ["gzip", "deflate"]
+# zlib window bits of each content coding: a gzip member, or a zlib stream for deflate.
+WBITS = {"gzip": 31, "deflate": 15}
+
+def msgpackDefault(value):
+    if is_dataclass(value):
+        # A shallow copy of the slots, the nested counts are packed as they are.
+        return {name: getattr(value, name) for name in value.__slots__}
+    raise TypeError(f"Object of type {type(value).__name__} is not MessagePack serializable")
+
+def packb(value):
+    """
+    Encodes a value, which may hold Records, as MessagePack.
+
+    Returns:
+        bytes: The encoded value.
+    """
+    return msgpack.packb(value, default=msgpackDefault)
+
+def packStream(documents, batch_size=500):
+    """
+    Encodes documents as a sequence of MessagePack documents, yielding one chunk
+    per batch of documents. Clients read it with msgpack.Unpacker.
+
+    Returns:
+        generator: The encoded chunks.
+    """
+    packer = msgpack.Packer(default=msgpackDefault)
+    batch = []
+    for document in documents:
+        batch.append(packer.pack(document))
+        if len(batch) == batch_size:
+            yield b"".join(batch)
+            batch = []
+    if batch:
+        yield b"".join(batch)
+
+def prefersMsgpack(accept):
+    """
+    Checks whether a client asks for MessagePack rather than JSON.
+
+    Args:
+        accept (MIMEAccept): The parsed Accept header of the request.
+
+    Returns:
+        bool: True if MessagePack is installed and preferred by the client, False otherwise.
+    """
+    return msgpack is not None and accept.best_match(["application/json", MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+
+def compress(data, coding, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+    return compressor.compress(data) + compressor.flush()
+
+def compressChunks(chunks, coding, level=6):
+    """
+    Compresses a streamed response as it is produced.
+
+    Returns:
+        generator: The compressed chunks, empty ones left out.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+class Compression:
+    """
+    This class represents the compression of responses for clients sending
+    Accept-Encoding. Bodies smaller than min_size are sent as they are, since
+    compressing them costs more time than it saves. Streamed responses are always
+    compressed, chunk by chunk, as their size is not known in advance.
+    """
+    def __init__(self, enabled=True, min_size=1024, level=6):
+        """
+        Initializes a new Compression object.
+
+        Args:
+            enabled (bool): Whether responses are compressed.
+            min_size (int): The smallest body compressed, in bytes.
+            level (int): The zlib compression level, 1 for the fastest to 9 for the smallest.
+        """
+        self.enabled = enabled
+        self.min_size = min_size
+        self.level = level
+
+    @classmethod
+    def fromEnvironment(cls):
+        """
+        Creates a Compression configured from the COMPRESSION* environment variables.
+        """
+        return cls(
+            enabled=os.environ.get("COMPRESSION") != "0",
+            min_size=int(os.environ.get("COMPRESSION_MIN_SIZE", 1024)),
+            level=int(os.environ.get("COMPRESSION_LEVEL", 6))
+        )
+
+    def coding(self, accept_encodings):
+        """
+        Chooses the content coding of a response.
+
+        Args:
+            accept_encodings (Accept): The parsed Accept-Encoding header of the request.
+
+        Returns:
+            str: "gzip" or "deflate", None if the client accepts neither.
+        """
+        return accept_encodings.best_match(CODINGS)
+
+def instrumentApp(app, compression):
+    """
+    Compresses the responses of a Flask app for clients accepting it.
+    """
+    from flask import request
+
+    @app.after_request
+    def compressResponse(response):
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+        response.vary.add("Accept-Encoding")
+        if msgpack is not None:
+            response.vary.add("Accept")
+        if response.status_code in (204, 304) or response.direct_passthrough or "Content-Encoding" in response.headers:
+            return response
+        coding = compression.coding(request.accept_encodings)
+        if coding is None:
+            return response
+        if response.is_streamed:
+            response.response = compressChunks(response.response, coding, compression.level)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < compression.min_size:
+                return response
+            response.set_data(compress(data, coding, compression.level))
+        response.headers["Content-Encoding"] = coding
+        # The compressed body is a different representation of the same resource.
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+def middleware(compression):
+    """
+    Builds the aiohttp middleware compressing the responses of the asyncio service,
+    see instrumentApp. Streamed responses enable compression themselves before they start.
+    """
+    from aiohttp import web
+
+    @web.middleware
+    async def compressResponse(request, handler):
+        response = await handler(request)
+        if isinstance(response, web.Response) and not response.prepared and response.body is not None \
+                and response.content_type in COMPRESSIBLE_MIMETYPES and len(response.body) >= compression.min_size:
+            response.headers.add("Vary", "Accept-Encoding")
+            response.enable_compression()
+            # The compressed body is a different representation of the same resource.
+            accepted = request.headers.get("Accept-Encoding", "").lower()
+            etag = response.headers.get("ETag")
+            if etag is not None and not etag.startswith("W/") and any(coding in accepted for coding in CODINGS):
+                response.headers["ETag"] = "W/" + etag
+        return response
+
+    return compressResponse
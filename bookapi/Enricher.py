@@ -0,0 +1,361 @@
+import os
+import time
+import heapq
+import random
+import logging
+import threading
+import requests
+from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError
+import Metrics
+
+logger = logging.getLogger(__name__)
+
+class CircuitBreaker:
+    """
+    This class represents a circuit breaker around a remote API. After
+    failure_threshold consecutive failures the circuit opens and calls are refused
+    for reset_timeout seconds. A single trial call is then let through, which
+    closes the circuit if it succeeds and opens it again if it fails.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        """
+        Initializes a new CircuitBreaker object.
+
+        Args:
+            failure_threshold (int): Consecutive failures which open the circuit.
+            reset_timeout (float): Seconds the circuit stays open before a trial call.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.opens = 0
+
+    def allow(self):
+        """
+        Checks whether a call may be made now.
+
+        Returns:
+            float: 0 if the call may be made, else the seconds until the next trial call.
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            wait = self.opened_at + self.reset_timeout - time.monotonic()
+            if wait > 0 or self.trial:
+                return max(wait, 0.1)
+            self.trial = True
+            return 0
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial:
+                    self.opens += 1
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+    def endTrial(self):
+        """
+        Ends the trial call, if any, however it ended, so a trial call failing with an
+        unexpected error lets the next call be the trial instead of keeping the circuit half-open.
+        """
+        with self.lock:
+            self.trial = False
+
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if self.trial or time.monotonic() >= self.opened_at + self.reset_timeout else "open"
+
+class Enricher:
+    """
+    This class represents the background enrichment of books inserted with
+    "enrichment": "pending". A pool of worker threads looks up the volume
+    information of each book and fills in its authors, publisher and publishedDate.
+    Failed lookups are retried with exponential backoff, and a circuit breaker
+    stops calling the remote API while it keeps failing. Pending books are kept in
+    the database, so books queued by a process which stopped are picked up again by
+    the periodic sweep. Every worker process sweeps, and each book is claimed by a
+    single one of them for lease seconds, see BooksCollection.claimPendingEnrichment.
+    """
+    def __init__(self, books, lookup, apply, workers=4, max_attempts=5, backoff=1, max_backoff=300,
+                 sweep_interval=60, lease=600, breaker=None):
+        """
+        Initializes a new Enricher object.
+
+        Args:
+            books (BooksCollection): The books to enrich.
+            lookup (callable): Called with an ISBN, returns the volume information or None
+                if there is none. Raises requests.exceptions.RequestException on failure.
+            apply (callable): Called with an empty book and the volume information, returns the book fields to set.
+            workers (int): The number of worker threads.
+            max_attempts (int): Lookups of a book before it is marked "failed".
+            backoff (float): Seconds before the first retry, doubled on every further retry.
+            max_backoff (float): The longest wait between two retries.
+            sweep_interval (float): Seconds between sweeps for pending books no process is enriching.
+            lease (float): Seconds a process keeps the books it swept or retries before another process may sweep them.
+            breaker (CircuitBreaker): The circuit breaker around lookup.
+        """
+        self.books = books
+        self.lookup = lookup
+        self.apply = apply
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sweep_interval = sweep_interval
+        self.lease = lease
+        self.breaker = breaker or CircuitBreaker()
+        self.condition = threading.Condition()
+        self.heap = []
+        self.queued = set()
+        self.sequence = 0
+        self.stopping = threading.Event()
+        self.threads = []
+        self.enriched = 0
+        self.not_found = 0
+        self.failed = 0
+        self.retries = 0
+        self.last_lag = None
+
+    @classmethod
+    def fromEnvironment(cls, books, lookup, apply):
+        """
+        Creates an Enricher configured from the ENRICHMENT_* environment variables.
+        """
+        env = os.environ
+        return cls(
+            books, lookup, apply,
+            workers=int(env.get("ENRICHMENT_BACKGROUND_WORKERS", 4)),
+            max_attempts=int(env.get("ENRICHMENT_MAX_ATTEMPTS", 5)),
+            backoff=float(env.get("ENRICHMENT_BACKOFF", 1)),
+            max_backoff=float(env.get("ENRICHMENT_MAX_BACKOFF", 300)),
+            sweep_interval=float(env.get("ENRICHMENT_SWEEP_INTERVAL", 60)),
+            lease=float(env.get("ENRICHMENT_LEASE", 600)),
+            breaker=CircuitBreaker(
+                int(env.get("ENRICHMENT_BREAKER_FAILURES", 5)),
+                float(env.get("ENRICHMENT_BREAKER_RESET", 30))
+            )
+        )
+
+    def _schedule(self, ready_at, id, isbn, attempt):
+        with self.condition:
+            self.sequence += 1
+            heapq.heappush(self.heap, (ready_at, self.sequence, id, isbn, attempt))
+            self.condition.notify()
+
+    def _delay(self, attempt):
+        return min(self.backoff * 2 ** attempt, self.max_backoff) * random.uniform(0.5, 1)
+
+    def _retry(self, id, isbn, attempt):
+        """
+        Schedules the next attempt of a book with exponential backoff.
+
+        Returns:
+            float: The seconds until the next attempt.
+        """
+        delay = self._delay(attempt)
+        with self.condition:
+            self.retries += 1
+        self._schedule(time.monotonic() + delay, id, isbn, attempt + 1)
+        return delay
+
+    def enqueue(self, id, isbn):
+        """
+        Queues a pending book for enrichment.
+
+        Args:
+            id (str): The ID of the book.
+            isbn (str): The ISBN of the book.
+        """
+        with self.condition:
+            if id in self.queued:
+                return
+            self.queued.add(id)
+        self._schedule(time.monotonic(), id, isbn, 0)
+
+    def _take(self):
+        """
+        Waits for the next book whose lookup is due.
+
+        Returns:
+            tuple: The ID, ISBN and attempt number of the book, or None once the enricher is stopping.
+        """
+        with self.condition:
+            while not self.stopping.is_set():
+                if self.heap:
+                    delay = self.heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        ready_at, sequence, id, isbn, attempt = heapq.heappop(self.heap)
+                        return id, isbn, attempt
+                    self.condition.wait(delay)
+                else:
+                    self.condition.wait()
+            return None
+
+    def _finish(self, id, state):
+        """
+        Ends the enrichment of a book which has no volume information ("notFound") or could not be looked up ("failed").
+        """
+        self.books.finishEnrichment(id, None, state)
+        with self.condition:
+            self.queued.discard(id)
+            if state == "failed":
+                self.failed += 1
+            else:
+                self.not_found += 1
+
+    def process(self, id, isbn, attempt):
+        """
+        Enriches one book, scheduling a retry if the lookup fails.
+        """
+        wait = self.breaker.allow()
+        if wait:
+            # The circuit is open: try again once it lets a call through, without using an attempt.
+            self._schedule(time.monotonic() + wait, id, isbn, attempt)
+            return
+        try:
+            volume = self.lookup(isbn)
+            self.breaker.success()
+        except requests.exceptions.RequestException as error:
+            self.breaker.failure()
+            if attempt + 1 >= self.max_attempts:
+                logger.warning('giving up enrichment of book %s after %s attempts: %s', id, attempt + 1, error)
+                Metrics.enrichment_results.inc(outcome="failed")
+                self._finish(id, "failed")
+                return
+            Metrics.enrichment_results.inc(outcome="retry")
+            delay = self._retry(id, isbn, attempt)
+            # The book stays claimed by this process until its retry is over.
+            self.books.renewEnrichmentLease(id, delay + self.lease)
+            return
+        finally:
+            self.breaker.endTrial()
+        if volume is None:
+            Metrics.enrichment_results.inc(outcome="notFound")
+            self._finish(id, "notFound")
+            return
+        self.books.finishEnrichment(id, self.apply({}, volume))
+        lag = time.time() - ObjectId(id).generation_time.timestamp()
+        Metrics.enrichment_lag.observe(lag)
+        Metrics.enrichment_results.inc(outcome="enriched")
+        with self.condition:
+            self.queued.discard(id)
+            self.enriched += 1
+            self.last_lag = lag
+
+    def work(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+            try:
+                self.process(*item)
+            except PyMongoError as error:
+                logger.warning('enrichment of book %s failed to be stored, retrying: %s', item[0], error)
+                self._retry(*item)
+            except Exception:
+                # An unexpected error must not end the worker thread, the book is retried like a failed lookup.
+                logger.exception('enrichment of book %s failed, retrying', item[0])
+                self._retry(*item)
+
+    def sweep(self):
+        """
+        Claims and queues the pending books inserted more than sweep_interval seconds
+        ago which no process holds a lease on, such as the books of a process which
+        stopped before enriching them.
+
+        Returns:
+            int: The number of books queued.
+        """
+        older_than = time.time() - self.sweep_interval
+        queued = 0
+        for book in self.books.claimPendingEnrichment(older_than, self.lease):
+            if str(book["_id"]) not in self.queued:
+                self.enqueue(str(book["_id"]), book["ISBN"])
+                queued += 1
+        return queued
+
+    def sweeper(self):
+        while not self.stopping.wait(self.sweep_interval):
+            try:
+                queued = self.sweep()
+                if queued:
+                    logger.info('queued %s pending books for enrichment', queued)
+            except PyMongoError as error:
+                logger.warning('enrichment sweep failed: %s', error)
+            except Exception:
+                logger.exception('enrichment sweep failed')
+
+    def start(self):
+        """
+        Starts the worker threads and the sweep thread of the current process.
+        """
+        if self.threads and all(thread.is_alive() for thread in self.threads):
+            return
+        self.stopping.clear()
+        self.threads = [threading.Thread(target=self.work, name=f"enrichment-{index}", daemon=True)
+                        for index in range(self.workers)]
+        self.threads.append(threading.Thread(target=self.sweeper, name="enrichment-sweep", daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=5):
+        """
+        Stops the threads. Books still queued stay pending in the database for the next sweep.
+        """
+        self.stopping.set()
+        with self.condition:
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def info(self):
+        """
+        Retrieves the state of the enrichment.
+
+        Returns:
+            dict: The queue depth, the books enriched and failed, the retries,
+                the lag of the last enriched book in seconds and the circuit state.
+        """
+        with self.condition:
+            depth = len(self.heap)
+            overdue = max(0, time.monotonic() - self.heap[0][0]) if self.heap else 0
+            return {
+                "queueDepth": depth,
+                "oldestDueSeconds": round(overdue, 3),
+                "enriched": self.enriched,
+                "notFound": self.not_found,
+                "failed": self.failed,
+                "retries": self.retries,
+                "lastLagSeconds": round(self.last_lag, 3) if self.last_lag is not None else None,
+                "circuit": self.breaker.state(),
+                "circuitOpens": self.breaker.opens
+            }
+
+    def metrics(self):
+        """
+        Exposes the queue depth and the circuit state on /metrics.
+        """
+        info = self.info()
+        return [
+            "# TYPE enrichment_queue_depth gauge",
+            f"enrichment_queue_depth {info['queueDepth']}",
+            "# TYPE enrichment_oldest_due_seconds gauge",
+            f"enrichment_oldest_due_seconds {info['oldestDueSeconds']}",
+            "# TYPE enrichment_circuit_open gauge",
+            f"enrichment_circuit_open {0 if info['circuit'] == 'closed' else 1}"
+        ]
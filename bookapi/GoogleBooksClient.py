@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from LRUCache import LRUCache
+import Metrics
+import Profiling
+
+class GoogleBooksClient:
+    """
+    This class represents a client for the Google Books volumes API. It keeps a
+    pooled session with connect/read timeouts and caches volume information by
+    ISBN, including ISBNs Google Books has no volume for, in memory and optionally
+    in a local sqlite store shared by restarts and worker processes.
+    """
+    def __init__(self, base_url="https://www.googleapis.com/books/v1/volumes", connect_timeout=3.05,
+                 read_timeout=10, pool_size=10, cache_size=10000, cache_ttl=86400, negative_ttl=3600,
+                 cache_path=None):
+        """
+        Initializes a new GoogleBooksClient object.
+
+        Args:
+            base_url (str): The URL of the volumes API.
+            connect_timeout (float): Seconds to wait for a connection to Google Books.
+            read_timeout (float): Seconds to wait for a response from Google Books.
+            pool_size (int): The number of connections kept alive to Google Books.
+            cache_size (int): The maximum number of ISBNs kept in the memory cache.
+            cache_ttl (float): Seconds volume information stays cached.
+            negative_ttl (float): Seconds an ISBN with no volume stays cached.
+            cache_path (str): Path of the on-disk cache, None to cache in memory only.
+        """
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.cache = LRUCache(cache_size, cache_ttl)
+        self.cache_ttl = cache_ttl
+        self.negative_ttl = negative_ttl
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.pid = None
+        self.session = None
+        self.store = None
+        self.disk_hits = 0
+        self.requests = 0
+
+    @classmethod
+    def fromEnvironment(cls):
+        """
+        Creates a GoogleBooksClient configured from the GOOGLE_BOOKS_* environment variables.
+
+        Returns:
+            GoogleBooksClient: The configured client.
+        """
+        env = os.environ
+        return cls(
+            base_url=env.get("GOOGLE_BOOKS_URL", "https://www.googleapis.com/books/v1/volumes"),
+            connect_timeout=float(env.get("GOOGLE_BOOKS_CONNECT_TIMEOUT", 3.05)),
+            read_timeout=float(env.get("GOOGLE_BOOKS_READ_TIMEOUT", 10)),
+            pool_size=int(env.get("GOOGLE_BOOKS_POOL_SIZE", 10)),
+            cache_size=int(env.get("GOOGLE_BOOKS_CACHE_SIZE", 10000)),
+            cache_ttl=float(env.get("GOOGLE_BOOKS_CACHE_TTL", 86400)),
+            negative_ttl=float(env.get("GOOGLE_BOOKS_NEGATIVE_TTL", 3600)),
+            cache_path=env.get("GOOGLE_BOOKS_CACHE_PATH") or None
+        )
+
+    def _connect(self):
+        """
+        Opens the session and the on-disk store for the current process. Both are
+        reopened after a fork so worker processes never share sockets or sqlite handles.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self.session = session
+            self._openStore()
+            self.pid = os.getpid()
+
+    def _openStore(self):
+        """
+        Opens the on-disk store, if one is configured.
+        """
+        if self.cache_path:
+            self.store = sqlite3.connect(self.cache_path, timeout=5, check_same_thread=False)
+            self.store.execute("PRAGMA journal_mode=WAL")
+            self.store.execute(
+                "CREATE TABLE IF NOT EXISTS volumes (isbn TEXT PRIMARY KEY, volume TEXT, expires REAL)"
+            )
+            self.store.commit()
+
+    def _readStore(self, isbn):
+        """
+        Finds an unexpired volume in the on-disk store.
+
+        Returns:
+            tuple: A tuple containing (bool, volume).
+                - bool: True if the ISBN was found, False otherwise.
+                - volume (dict): The volume information, None for ISBNs with no volume.
+        """
+        if self.store is None:
+            return False, None
+        with self.lock:
+            row = self.store.execute(
+                "SELECT volume, expires FROM volumes WHERE isbn = ?", (isbn,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return False, None
+        return True, json.loads(row[0])
+
+    def _writeStore(self, isbn, volume, ttl):
+        """
+        Stores a volume in the on-disk store.
+        """
+        if self.store is None:
+            return
+        with self.lock:
+            self.store.execute(
+                "INSERT OR REPLACE INTO volumes (isbn, volume, expires) VALUES (?, ?, ?)",
+                (isbn, json.dumps(volume), time.time() + ttl)
+            )
+            self.store.commit()
+
+    def lookup(self, isbn):
+        """
+        Retrieves the volume information of a book by its ISBN.
+
+        Args:
+            isbn (str): The ISBN of the book.
+
+        Returns:
+            dict: The volumeInfo of the first matching volume, or None if Google Books has no volume.
+
+        Raises:
+            requests.exceptions.RequestException: If Google Books could not be reached.
+        """
+        self._connect()
+        found, volume = self._cached(isbn)
+        if found:
+            return volume
+
+        self.requests += 1
+        started = time.perf_counter()
+        try:
+            response = self.session.get(self.base_url, params={"q": f"isbn:{isbn}"}, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as error:
+            elapsed = time.perf_counter() - started
+            Metrics.google_books_duration.observe(elapsed, outcome="error")
+            Metrics.google_books_errors.inc(error=type(error).__name__)
+            Profiling.slow_operations.record("googleBooks", "lookup", elapsed, lambda: f"isbn:{isbn} failed: {error!r}")
+            raise
+        elapsed = time.perf_counter() - started
+        Metrics.google_books_duration.observe(elapsed, outcome="ok")
+        Profiling.slow_operations.record("googleBooks", "lookup", elapsed, lambda: f"isbn:{isbn}")
+        return self._store(isbn, response.json())
+
+    def _cached(self, isbn):
+        """
+        Finds a volume in the memory cache, then in the on-disk store.
+
+        Returns:
+            tuple: A tuple containing (bool, volume), see _readStore.
+        """
+        found, volume = self.cache.get(isbn)
+        if found:
+            return True, volume
+        found, volume = self._readStore(isbn)
+        if found:
+            self.disk_hits += 1
+            self.cache.set(isbn, volume, None if volume else self.negative_ttl)
+        return found, volume
+
+    def _store(self, isbn, data):
+        """
+        Extracts the volume information from a volumes API response and caches it.
+
+        Returns:
+            dict: The volumeInfo of the first matching volume, or None if there is none.
+        """
+        items = data.get("items")
+        volume = items[0].get("volumeInfo", {}) if items else None
+
+        ttl = self.cache_ttl if volume else self.negative_ttl
+        self.cache.set(isbn, volume, ttl)
+        self._writeStore(isbn, volume, ttl)
+        return volume
+
+    def cacheInfo(self):
+        """
+        Retrieves the cache counters of the client.
+
+        Returns:
+            dict: The memory cache counters plus on-disk hits and remote requests.
+        """
+        info = self.cache.info()
+        info["diskHits"] = self.disk_hits
+        info["requests"] = self.requests
+        info["persistent"] = self.cache_path is not None
+        return info
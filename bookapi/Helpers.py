@@ -0,0 +1,58 @@
+from bson.objectid import ObjectId
+from Validation import valid_ratings
+
+# Helpers shared by the threaded service in main.py and the asyncio service in async_main.py.
+# They build documents and responses only, so importing them opens no connection.
+
+def apply_metadata(book, volume_info):
+    """
+    Fills in a book's authors, publisher and publishedDate from Google Books volume information.
+    """
+    book["authors"] = 'and '.join(volume_info.get("authors") or [])
+    book["publisher"] = volume_info.get("publisher")
+    book["publishedDate"] = volume_info.get("publishedDate")
+
+    if book["authors"] == "": book["authors"] = "missing"
+    if not book["publisher"]: book["publisher"] = "missing"
+    if not book["publishedDate"]: book["publishedDate"] = "missing"
+    return book
+
+def new_rating(book, id):
+    """
+    Builds the empty rating document of a newly inserted book.
+    """
+    return {
+        "counts": {str(star): 0 for star in valid_ratings},
+        "count": 0,
+        "sum": 0,
+        "average": 0,
+        "title": book["title"],
+        "genre": book["genre"],
+        "_id": ObjectId(id)
+    }
+
+def next_page_headers(documents, limit):
+    """
+    Builds the X-Next-After header pointing to the page after a full page of documents.
+    """
+    if limit is not None and len(documents) == limit:
+        return {"X-Next-After": documents[-1]["id"]}
+    return {}
+
+def bulk_outcomes(selection, invalid, written):
+    """
+    Builds the per book outcomes of a DELETE or PATCH /books request, in the order
+    of the requested IDs, or of the written books for a filter.
+    """
+    if "filter" in selection:
+        return [{"ID": id} for id in written]
+    written = set(written)
+    outcomes = []
+    for id in selection["ids"]:
+        if id in invalid:
+            outcomes.append({"ID": id, "error": "Unprocessable Content"})
+        elif id in written:
+            outcomes.append({"ID": id})
+        else:
+            outcomes.append({"ID": id, "error": "Not Found"})
+    return outcomes
@@ -0,0 +1,358 @@
+import os
+import sys
+import csv
+import gzip
+import json
+import mmap
+import logging
+import time
+import random
+import struct
+import argparse
+import tempfile
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"ISBNIDX1"
+HEADER = struct.Struct("<8sQQQ")   # magic, slot count, record count, offset of the records
+SLOT = struct.Struct("<QQ")        # ISBN + 1 (0 marks an empty slot), record offset
+LENGTH = struct.Struct("<I")
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+ISBN_KEYS = ["ISBN", "isbn", "isbn13", "isbn_13", "isbn10", "isbn_10"]
+AUTHORS_KEYS = ["authors", "author"]
+PUBLISHER_KEYS = ["publisher", "publishers"]
+DATE_KEYS = ["publishedDate", "published_date", "publish_date", "date"]
+
+def normalizeISBN(value):
+    """
+    Converts an ISBN-10 or ISBN-13, with or without hyphens, to the 13 digit form used by the service.
+
+    Returns:
+        str: The ISBN-13, or None if the value is not an ISBN.
+    """
+    if value is None:
+        return None
+    isbn = str(value).replace("-", "").replace(" ", "").upper()
+    # isdigit alone accepts digits such as "²" which int() cannot read.
+    if not isbn.isascii():
+        return None
+    if len(isbn) == 13 and isbn.isdigit():
+        return isbn
+    if len(isbn) == 10 and isbn[:9].isdigit() and (isbn[9].isdigit() or isbn[9] == "X"):
+        body = "978" + isbn[:9]
+        check = (10 - sum(int(digit) * (1 if index % 2 == 0 else 3) for index, digit in enumerate(body)) % 10) % 10
+        return body + str(check)
+    return None
+
+def slotOf(key, bits):
+    return ((key * HASH_MULTIPLIER) & 0xFFFFFFFFFFFFFFFF) >> (64 - bits)
+
+def first(record, keys):
+    for key in keys:
+        value = record.get(key)
+        if value not in (None, "", []):
+            return value
+    return None
+
+def volumeOf(record):
+    """
+    Builds the Google Books style volume information of a dump record.
+    """
+    authors = first(record, AUTHORS_KEYS)
+    if isinstance(authors, str):
+        authors = [author.strip() for author in authors.replace("|", ";").split(";") if author.strip()]
+    publisher = first(record, PUBLISHER_KEYS)
+    if isinstance(publisher, list):
+        publisher = publisher[0]
+    volume = {"authors": authors, "publisher": publisher, "publishedDate": first(record, DATE_KEYS)}
+    return {key: value for key, value in volume.items() if value}
+
+def readDump(path, format=None):
+    """
+    Iterates over the records of a catalog dump, CSV with a header row or NDJSON,
+    optionally gzip compressed. The format is taken from the file extension if not given.
+    """
+    name = path[:-3] if path.endswith(".gz") else path
+    format = format or ("csv" if name.endswith(".csv") else "ndjson")
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as file:
+        if format == "csv":
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+def build(dump_path, index_path, format=None):
+    """
+    Builds an index file from a catalog dump. The index is written next to its
+    destination and then renamed over it, so running services switch to the new
+    index on their next check without ever reading a partial file.
+
+    Args:
+        dump_path (str): The catalog dump.
+        index_path (str): The index file to create or replace.
+        format (str): "csv" or "ndjson", None to use the file extension.
+
+    Returns:
+        dict: The number of indexed records and of skipped records.
+    """
+    keys = array("Q")
+    offsets = array("Q")
+    skipped = 0
+    directory = os.path.dirname(os.path.abspath(index_path))
+    with tempfile.TemporaryFile(dir=directory) as data:
+        offset = 0
+        for record in readDump(dump_path, format):
+            isbn = normalizeISBN(first(record, ISBN_KEYS))
+            volume = volumeOf(record) if isbn else None
+            if not volume:
+                skipped += 1
+                continue
+            encoded = json.dumps(volume, separators=(",", ":")).encode()
+            data.write(LENGTH.pack(len(encoded)))
+            data.write(encoded)
+            keys.append(int(isbn) + 1)
+            offsets.append(offset)
+            offset += LENGTH.size + len(encoded)
+
+        bits = max(3, (2 * len(keys) - 1).bit_length())
+        slots = 1 << bits
+        table = array("Q", bytes(16 * slots))
+        records = 0
+        for key, record_offset in zip(keys, offsets):
+            slot = slotOf(key, bits)
+            while table[2 * slot] not in (0, key):
+                slot = (slot + 1) & (slots - 1)
+            if table[2 * slot] == 0:
+                records += 1
+            table[2 * slot] = key
+            table[2 * slot + 1] = record_offset
+        if sys.byteorder != "little":
+            table.byteswap()
+
+        descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=".isbn-index-")
+        try:
+            with os.fdopen(descriptor, "wb") as output:
+                output.write(HEADER.pack(MAGIC, slots, records, HEADER.size + SLOT.size * slots))
+                table.tofile(output)
+                data.seek(0)
+                while True:
+                    chunk = data.read(1 << 20)
+                    if not chunk:
+                        break
+                    output.write(chunk)
+            os.replace(temporary_path, index_path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+    return {"records": records, "skipped": skipped}
+
+class IsbnIndex:
+    """
+    This class represents a read-only ISBN to volume information index, built from a
+    catalog dump by build. The file is memory-mapped, so lookups read a single hash
+    table slot and record without loading the index, and forked worker processes
+    share its pages. A replaced file is picked up within check_interval seconds.
+    """
+    def __init__(self, path=None, check_interval=5):
+        """
+        Initializes a new IsbnIndex object. A missing file is treated as an empty index.
+
+        Args:
+            path (str): The index file, None for no index.
+            check_interval (float): Seconds between checks for a rebuilt index file.
+        """
+        self.path = path
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.map = None
+        self.bits = 0
+        self.records = 0
+        self.data_offset = 0
+        self.identity = None
+        self.checked = 0
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def fromEnvironment(cls):
+        """
+        Creates an IsbnIndex on the file in ISBN_INDEX_PATH, if set.
+        """
+        return cls(os.environ.get("ISBN_INDEX_PATH") or None,
+                   float(os.environ.get("ISBN_INDEX_CHECK_INTERVAL", 5)))
+
+    def _refresh(self):
+        """
+        Maps the index file again if it was replaced since it was last mapped. A file
+        which is not a complete index, such as a truncated copy, is logged and treated
+        as no index until it is replaced.
+        """
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return
+        with self.lock:
+            if now - self.checked < self.check_interval:
+                return
+            self.checked = now
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                self.map = None
+                self.identity = None
+                return
+            identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if identity == self.identity:
+                return
+            self.map = None
+            self.identity = identity
+            try:
+                with open(self.path, "rb") as file:
+                    mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as error:
+                logger.error('cannot map the ISBN index %s, looking up Google Books only: %s', self.path, error)
+                return
+            if not self.valid(mapped):
+                mapped.close()
+                logger.error('%s is not a complete ISBN index, looking up Google Books only', self.path)
+                return
+            magic, slots, records, data_offset = HEADER.unpack_from(mapped, 0)
+            self.bits = slots.bit_length() - 1
+            self.records = records
+            self.data_offset = data_offset
+            self.map = mapped
+
+    @staticmethod
+    def valid(mapped):
+        """
+        Checks that a mapped file holds an index header and a hash table no larger than the file.
+        """
+        if len(mapped) < HEADER.size:
+            return False
+        magic, slots, records, data_offset = HEADER.unpack_from(mapped, 0)
+        return magic == MAGIC and slots >= 1 and slots & (slots - 1) == 0 and records <= slots \
+            and data_offset == HEADER.size + SLOT.size * slots and data_offset <= len(mapped)
+
+    def lookup(self, isbn):
+        """
+        Finds the volume information of a book by its ISBN.
+
+        Args:
+            isbn (str): The ISBN-13 of the book.
+
+        Returns:
+            tuple: A tuple containing (bool, volume).
+                - bool: True if the ISBN is in the index, False otherwise.
+                - volume (dict): The volume information in the Google Books volumeInfo format if found, None otherwise.
+        """
+        if self.path is None:
+            return False, None
+        self._refresh()
+        mapped = self.map
+        if mapped is None or not (isbn.isascii() and isbn.isdigit()):
+            return False, None
+        key = int(isbn) + 1
+        mask = (1 << self.bits) - 1
+        slot = slotOf(key, self.bits)
+        # A table built by build always has an empty slot, a damaged one may not, so probing stops after every slot.
+        for _ in range(mask + 1):
+            stored, offset = SLOT.unpack_from(mapped, HEADER.size + SLOT.size * slot)
+            if stored == key:
+                start = self.data_offset + offset
+                try:
+                    length, = LENGTH.unpack_from(mapped, start)
+                    volume = json.loads(mapped[start + LENGTH.size:start + LENGTH.size + length])
+                except (struct.error, ValueError) as error:
+                    logger.error('corrupt record for %s in the ISBN index %s: %s', isbn, self.path, error)
+                    self.misses += 1
+                    return False, None
+                self.hits += 1
+                return True, volume
+            if stored == 0:
+                break
+            slot = (slot + 1) & mask
+        self.misses += 1
+        return False, None
+
+    def keys(self):
+        """
+        Iterates over the ISBNs in the index.
+        """
+        self._refresh()
+        mapped = self.map
+        if mapped is None:
+            return
+        for slot in range(1 << self.bits):
+            stored, offset = SLOT.unpack_from(mapped, HEADER.size + SLOT.size * slot)
+            if stored:
+                yield f"{stored - 1:013d}"
+
+    def info(self):
+        """
+        Retrieves the size and counters of the index.
+
+        Returns:
+            dict: The number of records, the file size in bytes, hits and misses.
+        """
+        if self.path is not None:
+            self._refresh()
+        mapped = self.map
+        return {
+            "path": self.path,
+            "records": self.records if mapped is not None else 0,
+            "bytes": len(mapped) if mapped is not None else 0,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+def benchmark(index, lookups=100000):
+    """
+    Measures the lookup speed of an index on ISBNs it holds and on ISBNs it does not.
+
+    Returns:
+        dict: Lookups per second and mean microseconds per lookup, for hits and misses.
+    """
+    present = list(index.keys())
+    rng = random.Random(0)
+    results = {}
+    samples = {
+        "hit": [rng.choice(present) for _ in range(lookups)] if present else [],
+        "miss": [f"{rng.randrange(10 ** 12):012d}0" for _ in range(lookups)]
+    }
+    for name, isbns in samples.items():
+        if not isbns:
+            continue
+        started = time.perf_counter()
+        for isbn in isbns:
+            index.lookup(isbn)
+        elapsed = time.perf_counter() - started
+        results[name] = {"lookupsPerSecond": round(len(isbns) / elapsed), "meanMicros": round(elapsed / len(isbns) * 1e6, 3)}
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds and inspects the offline ISBN index.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_command = commands.add_parser("build", help="build or refresh an index from a CSV or NDJSON dump")
+    build_command.add_argument("dump", help="catalog dump, .csv, .ndjson or .jsonl, optionally .gz")
+    build_command.add_argument("index", help="index file to write")
+    build_command.add_argument("--format", choices=["csv", "ndjson"], default=None)
+    stats_command = commands.add_parser("stats", help="report the size and lookup speed of an index")
+    stats_command.add_argument("index", help="index file to read")
+    stats_command.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        started = time.perf_counter()
+        result = build(args.dump, args.index, args.format)
+        result["seconds"] = round(time.perf_counter() - started, 3)
+        result["bytes"] = os.path.getsize(args.index)
+    else:
+        index = IsbnIndex(args.index)
+        result = index.info()
+        result["lookups"] = benchmark(index, args.lookups)
+    print(json.dumps(result, indent=2))
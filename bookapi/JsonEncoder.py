@@ -0,0 +1,58 @@
+import os
+import json
+from dataclasses import is_dataclass
+import Records
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODERS = ["orjson", "json"]
+
+def stdlibDefault(value):
+    if is_dataclass(value):
+        return Records.asDict(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def selectEncoder(name=None):
+    """
+    Selects the JSON encoder used for responses, from JSON_ENCODER by default.
+    orjson is used when installed unless JSON_ENCODER=json.
+
+    Returns:
+        str: The name of the selected encoder.
+    """
+    name = name or os.environ.get("JSON_ENCODER") or ("orjson" if orjson else "json")
+    if name not in ENCODERS:
+        raise ValueError(f"unknown JSON encoder {name!r}, expected one of {', '.join(ENCODERS)}")
+    if name == "orjson" and orjson is None:
+        raise ValueError("JSON_ENCODER=orjson but orjson is not installed")
+    global encoder
+    encoder = name
+    return name
+
+def dumps(value, sort_keys=False):
+    """
+    Encodes a value, which may hold Records, as UTF-8 JSON.
+
+    Returns:
+        bytes: The encoded value.
+    """
+    if encoder == "orjson":
+        if sort_keys:
+            # orjson writes dataclass fields in their declared order even with OPT_SORT_KEYS.
+            return orjson.dumps(value, default=stdlibDefault, option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATACLASS)
+        return orjson.dumps(value)
+    return json.dumps(value, default=stdlibDefault, sort_keys=sort_keys, separators=(",", ":")).encode()
+
+def loads(data):
+    """
+    Decodes UTF-8 JSON with orjson when it is installed, whatever the selected encoder.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+encoder = None
+selectEncoder()
@@ -0,0 +1,107 @@
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    This class represents a bounded, thread-safe cache with least recently used
+    eviction and a per-entry time to live. It keeps hit, miss and eviction counts
+    so the cache can be sized from real traffic.
+    """
+    def __init__(self, maxsize, ttl):
+        """
+        Initializes a new LRUCache object.
+
+        Args:
+            maxsize (int): The maximum number of entries kept in the cache.
+            ttl (float): The default number of seconds an entry stays valid.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Finds an entry in the cache and marks it as recently used.
+
+        Args:
+            key: The key of the entry.
+
+        Returns:
+            tuple: A tuple containing (bool, value).
+                - bool: True if a valid entry was found, False otherwise.
+                - value: The cached value if found, None otherwise.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores an entry in the cache, evicting the least recently used entries
+        when the cache is full.
+
+        Args:
+            key: The key of the entry.
+            value: The value to cache, None is a valid value.
+            ttl (float): The number of seconds the entry stays valid, defaults to the cache ttl.
+        """
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Removes an entry from the cache.
+
+        Args:
+            key: The key of the entry.
+
+        Returns:
+            bool: True if the entry was in the cache, False otherwise.
+        """
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def clear(self):
+        """
+        Removes all the entries from the cache.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def info(self):
+        """
+        Retrieves the cache counters.
+
+        Returns:
+            dict: The size, maxsize, hits, misses, evictions and hit ratio of the cache.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRatio": round(self.hits / lookups, 4) if lookups else 0
+            }
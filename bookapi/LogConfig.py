@@ -0,0 +1,47 @@
+import os
+import sys
+import queue
+import logging
+import logging.handlers
+
+listener = None
+configured_pid = None
+
+def configure():
+    """
+    Routes every log record through a queue to a background thread that writes it
+    to stdout, so request threads never block on console I/O. The level comes from
+    LOG_LEVEL (INFO by default, WARNING or above to silence per-operation logs).
+    Calling it again in a forked worker starts a listener thread for that process.
+    """
+    global listener, configured_pid
+    if configured_pid == os.getpid():
+        return
+    if listener is not None and configured_pid is not None:
+        try:
+            listener.stop()
+        except RuntimeError:
+            pass
+
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    configured_pid = os.getpid()
+
+def shutdown():
+    """
+    Writes out the queued records and stops the listener thread.
+    """
+    global listener, configured_pid
+    if listener is not None and configured_pid == os.getpid():
+        listener.stop()
+    listener = None
+    configured_pid = None
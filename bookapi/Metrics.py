@@ -0,0 +1,218 @@
+import time
+import threading
+from bisect import bisect_left
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+def formatLabels(names, values):
+    """
+    Formats label names and values as a Prometheus label set.
+    """
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """
+    This class represents a monotonically increasing counter with labels.
+    """
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        Adds an amount to the counter of the given label values.
+        """
+        key = tuple(labels[label] for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{formatLabels(self.labels, key)} {value}")
+        return lines
+
+class Histogram:
+    """
+    This class represents a histogram of observed values, such as latencies in
+    seconds, with cumulative buckets and labels.
+    """
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = list(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        Records a value in the histogram of the given label values.
+        """
+        key = tuple(labels[label] for label in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ("le",)
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{formatLabels(bucket_labels, key + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_sum{formatLabels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{formatLabels(self.labels, key)} {cumulative}")
+        return lines
+
+class Registry:
+    """
+    This class represents the metrics of a process, rendered in the Prometheus
+    text exposition format. Every worker process keeps its own registry.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        """
+        Creates and registers a Counter.
+        """
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Creates and registers a Histogram.
+        """
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def addCollector(self, collector):
+        """
+        Registers a function called on every render that returns extra exposition
+        lines, for values owned by other objects such as cache counters.
+        """
+        self.collectors.append(collector)
+
+    def render(self):
+        """
+        Renders every metric in the text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time spent handling HTTP requests.", ["method", "route"]
+)
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests handled.", ["method", "route", "status"]
+)
+mongo_command_duration = registry.histogram(
+    "mongo_command_duration_seconds", "Time spent in MongoDB commands.", ["command", "collection"]
+)
+mongo_command_failures = registry.counter(
+    "mongo_command_failures_total", "MongoDB commands that failed.", ["command", "collection"]
+)
+google_books_duration = registry.histogram(
+    "google_books_request_duration_seconds", "Time spent in Google Books requests.", ["outcome"]
+)
+google_books_errors = registry.counter(
+    "google_books_errors_total", "Google Books requests that failed.", ["error"]
+)
+enrichment_lag = registry.histogram(
+    "enrichment_lag_seconds", "Time from the insert of a book to the end of its background enrichment.",
+    buckets=[0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800]
+)
+enrichment_results = registry.counter(
+    "enrichment_results_total", "Background enrichment attempts by outcome.", ["outcome"]
+)
+slow_operations = registry.counter(
+    "slow_operations_total", "MongoDB commands and Google Books requests over SLOW_OPERATION_MS.", ["kind"]
+)
+admission_rejections = registry.counter(
+    "admission_rejections_total", "Requests refused by the admission control.", ["route", "reason"]
+)
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    This class represents a pymongo command listener recording the duration of
+    every MongoDB command by command name and collection.
+    """
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        with self.lock:
+            self.collections[(event.connection_id, event.request_id)] = (
+                collection if isinstance(collection, str) else ""
+            )
+
+    def _collection(self, event):
+        with self.lock:
+            return self.collections.pop((event.connection_id, event.request_id), "")
+
+    def succeeded(self, event):
+        mongo_command_duration.observe(
+            event.duration_micros / 1e6, command=event.command_name, collection=self._collection(event)
+        )
+
+    def failed(self, event):
+        collection = self._collection(event)
+        mongo_command_duration.observe(event.duration_micros / 1e6, command=event.command_name, collection=collection)
+        mongo_command_failures.inc(command=event.command_name, collection=collection)
+
+mongo_listener = None
+
+def instrumentMongo():
+    """
+    Registers the command listener for every MongoClient created afterwards.
+    """
+    global mongo_listener
+    if mongo_listener is None:
+        mongo_listener = MongoCommandMetrics()
+        monitoring.register(mongo_listener)
+
+def instrumentApp(app):
+    """
+    Records the latency and status of every request handled by a Flask app, by route.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def startTimer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def recordRequest(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            http_request_duration.observe(time.perf_counter() - started, method=request.method, route=route)
+            http_requests.inc(method=request.method, route=route, status=str(response.status_code))
+        return response
@@ -0,0 +1,378 @@
+import os
+import re
+import sys
+import time
+import types
+import pstats
+import marshal
+import logging
+import tempfile
+import threading
+import contextvars
+from pymongo import monitoring
+import JsonEncoder
+import Metrics
+
+logger = logging.getLogger(__name__)
+
+# The route of the request being handled, set by instrumentApp and the asyncio middleware.
+current_route = contextvars.ContextVar("current_route", default=None)
+
+# Command fields which hold values rather than the shape of the operation.
+VALUE_FIELDS = {"documents", "lsid", "$db", "$clusterTime", "txnNumber", "cursor", "$readPreference"}
+SHAPE_MAX_LENGTH = 1000
+
+def shape(value):
+    """
+    Replaces the values in a filter, pipeline or update with "?", keeping the
+    field names and operators, so operations differing only by their values log the same.
+    """
+    if isinstance(value, dict):
+        return {key: shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        items = [shape(item) for item in value if isinstance(item, (dict, list))]
+        return items if items else "?"
+    return "?"
+
+def commandShape(command_name, command):
+    """
+    Builds the shape of a MongoDB command, such as the filter of a find or the pipeline of an aggregate.
+
+    Returns:
+        str: The shape as JSON, cut at SHAPE_MAX_LENGTH characters.
+    """
+    fields = {key: shape(value) for key, value in command.items() if key != command_name and key not in VALUE_FIELDS}
+    text = JsonEncoder.dumps(fields).decode()
+    return text if len(text) <= SHAPE_MAX_LENGTH else text[:SHAPE_MAX_LENGTH] + "..."
+
+class SlowOperationLog:
+    """
+    This class represents the log of MongoDB commands and Google Books requests
+    slower than a threshold. Each entry names the route which issued the operation,
+    or the thread for background work, and the shape of the operation.
+    """
+    def __init__(self, threshold=None):
+        """
+        Initializes a new SlowOperationLog object.
+
+        Args:
+            threshold (float): Seconds past which an operation is logged, None to log nothing.
+        """
+        self.threshold = threshold
+
+    @classmethod
+    def fromEnvironment(cls):
+        """
+        Creates a SlowOperationLog with the threshold of SLOW_OPERATION_MS, disabled if unset.
+        """
+        threshold = os.environ.get("SLOW_OPERATION_MS")
+        return cls(float(threshold) / 1000 if threshold else None)
+
+    def enabled(self):
+        return self.threshold is not None
+
+    def record(self, kind, name, seconds, details):
+        """
+        Logs an operation if it is slower than the threshold.
+
+        Args:
+            kind (str): "mongo" or "googleBooks".
+            name (str): The command name or the request made.
+            seconds (float): The duration of the operation.
+            details (callable): Returns the shape of the operation, only called when it is logged.
+        """
+        if self.threshold is None or seconds < self.threshold:
+            return
+        origin = current_route.get() or f"thread {threading.current_thread().name}"
+        Metrics.slow_operations.inc(kind=kind)
+        logger.warning('slow %s %s took %.1f ms from %s: %s', kind, name, seconds * 1000, origin, details())
+
+slow_operations = SlowOperationLog.fromEnvironment()
+
+class SlowCommandListener(monitoring.CommandListener):
+    """
+    This class represents a pymongo command listener passing every command to the slow operation log.
+    """
+    def __init__(self, log):
+        self.log = log
+        self.commands = {}
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        with self.lock:
+            self.commands[(event.connection_id, event.request_id)] = (event.command, current_route.get())
+
+    def _finished(self, event):
+        with self.lock:
+            command, route = self.commands.pop((event.connection_id, event.request_id), (None, None))
+        if command is None:
+            return
+        # Listeners run in the context of the command, the route read when it started is restored for the log.
+        token = current_route.set(route)
+        try:
+            collection = command.get(event.command_name)
+            name = f"{event.command_name} {collection}" if isinstance(collection, str) else event.command_name
+            self.log.record("mongo", name, event.duration_micros / 1e6,
+                            lambda: commandShape(event.command_name, command))
+        finally:
+            current_route.reset(token)
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+command_listener = None
+
+def instrumentMongo():
+    """
+    Registers the slow command listener for every MongoClient created afterwards, if the log is enabled.
+    """
+    global command_listener
+    if command_listener is None and slow_operations.enabled():
+        command_listener = SlowCommandListener(slow_operations)
+        monitoring.register(command_listener)
+
+def codeKey(code):
+    return (code.co_filename, code.co_firstlineno, code.co_name)
+
+def builtinKey(function):
+    """
+    Names a built-in function the way cProfile does, e.g. "<built-in method builtins.sum>".
+    """
+    owner = getattr(function, "__self__", None)
+    if owner is None or isinstance(owner, types.ModuleType):
+        module = getattr(function, "__module__", None) or getattr(owner, "__name__", None) or "builtins"
+        return ("~", 0, f"<built-in method {module}.{function.__name__}>")
+    return ("~", 0, f"<method '{function.__name__}' of '{type(owner).__name__}' objects>")
+
+class ThreadProfile:
+    """
+    This class represents a deterministic profile of the calls made by a single
+    thread, collected with sys.setprofile. cProfile records every thread of the
+    process on Python 3.12 and later, so the profile of a request would include the
+    requests other worker threads handle at the same time. Its stats have the
+    cProfile layout, so pstats and snakeviz read its dumps. Calls made before it is
+    enabled are left out, and calls still running when it is disabled end then.
+    """
+    def __init__(self, timer=time.perf_counter):
+        self.timer = timer
+        # The running calls: [frame or built-in function, key, start time, time spent in subcalls].
+        self.stack = []
+        # The counters of each function: [primitive calls, calls, own time, cumulative time, callers].
+        self.functions = {}
+        self.running = {}
+        self.stats = {}
+
+    def enable(self):
+        """
+        Starts profiling the calling thread.
+
+        Raises:
+            ValueError: If another profiler, such as a debugger, traces the thread.
+        """
+        if sys.getprofile() is not None:
+            raise ValueError("another profiler is active")
+        sys.setprofile(self.dispatch)
+
+    def disable(self):
+        """
+        Stops profiling. Must be called by the thread which enabled the profile.
+        """
+        sys.setprofile(None)
+        now = self.timer()
+        while self.stack:
+            self._leave(self.stack[-1][0], now)
+
+    def dispatch(self, frame, event, argument):
+        now = self.timer()
+        if event == "call":
+            self._enter(frame, codeKey(frame.f_code), now)
+        elif event == "return":
+            self._leave(frame, now)
+        elif event == "c_call":
+            self._enter(argument, builtinKey(argument), now)
+        else:
+            self._leave(argument, now)
+
+    def _enter(self, token, key, now):
+        self.stack.append([token, key, now, 0.0])
+        self.running[key] = self.running.get(key, 0) + 1
+
+    def _leave(self, token, now):
+        # Returns from calls made before the profile was enabled are not on the stack.
+        if not self.stack or self.stack[-1][0] is not token:
+            return
+        _, key, started, subcalls = self.stack.pop()
+        elapsed = now - started
+        self.running[key] -= 1
+        # A recursive call adds its own time, its cumulative time is counted once by the outermost call.
+        primitive = self.running[key] == 0
+        function = self.functions.get(key)
+        if function is None:
+            function = self.functions[key] = [0, 0, 0.0, 0.0, {}]
+        function[0] += primitive
+        function[1] += 1
+        function[2] += elapsed - subcalls
+        function[3] += elapsed if primitive else 0
+        if self.stack:
+            caller = self.stack[-1]
+            caller[3] += elapsed
+            edge = function[4].get(caller[1])
+            if edge is None:
+                edge = function[4][caller[1]] = [0, 0, 0.0, 0.0]
+            edge[0] += 1
+            edge[1] += primitive
+            edge[2] += elapsed - subcalls
+            edge[3] += elapsed if primitive else 0
+
+    def create_stats(self):
+        """
+        Builds the stats in the layout of cProfile, read by pstats.Stats.
+        """
+        self.stats = {
+            key: (primitive, calls, own, cumulative, {caller: tuple(edge) for caller, edge in callers.items()})
+            for key, (primitive, calls, own, cumulative, callers) in self.functions.items()
+        }
+
+    def dump_stats(self, path):
+        self.create_stats()
+        with open(path, "wb") as file:
+            marshal.dump(self.stats, file)
+
+class RequestProfiler:
+    """
+    This class represents the on-demand CPU profiling of single requests. A request
+    carrying the X-Profile header is run under a ThreadProfile of the thread handling
+    it and its profile is written to a file of the profile directory, readable with
+    pstats or snakeviz. Only one request is profiled at a time in a process; the
+    others run unprofiled.
+    """
+    def __init__(self, directory, keep=100):
+        """
+        Initializes a new RequestProfiler object.
+
+        Args:
+            directory (str): The directory the profiles are written to.
+            keep (int): The number of profiles kept, the oldest are removed.
+        """
+        self.directory = directory
+        self.keep = keep
+        self.lock = threading.Lock()
+
+    @classmethod
+    def fromEnvironment(cls):
+        """
+        Creates a RequestProfiler writing to PROFILE_DIR, or None unless PROFILING is 1.
+        """
+        if os.environ.get("PROFILING") != "1":
+            return None
+        directory = os.environ.get("PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "book-service-profiles")
+        return cls(directory, int(os.environ.get("PROFILE_KEEP", 100)))
+
+    def start(self):
+        """
+        Starts profiling the current request.
+
+        Returns:
+            Profile: The running profile, None if another request is being profiled.
+        """
+        if not self.lock.acquire(blocking=False):
+            return None
+        profile = ThreadProfile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler, such as a debugger, is already active.
+            self.lock.release()
+            return None
+        return profile
+
+    def name(self, method, path):
+        return f"{int(time.time() * 1000)}-{method}-{re.sub(r'[^A-Za-z0-9]+', '_', path).strip('_')}.prof"
+
+    def finish(self, profile, name):
+        """
+        Stops profiling and writes the profile.
+
+        Returns:
+            str: The path of the profile file.
+        """
+        try:
+            profile.disable()
+        finally:
+            self.lock.release()
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path)
+        self._prune()
+        stats = pstats.Stats(path)
+        logger.info('profiled request in %s: %.1f ms in %s calls', path, stats.total_tt * 1000, stats.total_calls)
+        return path
+
+    def _prune(self):
+        profiles = sorted(name for name in os.listdir(self.directory) if name.endswith(".prof"))
+        for name in profiles[:-self.keep] if self.keep else []:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def path(self, name):
+        """
+        Finds a profile by its file name.
+
+        Returns:
+            str: The path of the profile, None if there is no such profile.
+        """
+        if os.path.basename(name) != name or not name.endswith(".prof"):
+            return None
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+def instrumentApp(app, profiler):
+    """
+    Sets the route of every request handled by a Flask app for the slow operation
+    log, and profiles the requests carrying X-Profile if a profiler is given.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def startRequest():
+        current_route.set(f"{request.method} {request.url_rule.rule if request.url_rule else request.path}")
+        if profiler is not None and request.headers.get("X-Profile"):
+            profile = profiler.start()
+            g.profile = (profile, profiler.name(request.method, request.path)) if profile else None
+
+    @app.after_request
+    def profileHeader(response):
+        if "profile" in g:
+            response.headers["X-Profile"] = g.profile[1] if g.profile else "busy"
+        return response
+
+    # Teardown runs after the last chunk of a streamed response, so the profile covers the whole response.
+    @app.teardown_request
+    def finishRequest(error):
+        current_route.set(None)
+        profile = g.pop("profile", None)
+        if profile is not None:
+            try:
+                profiler.finish(*profile)
+            except OSError as error:
+                # The response is already sent, a profile which cannot be written is only lost.
+                logger.warning('could not write profile %s to %s: %s', profile[1], profiler.directory, error)
+
+def middleware():
+    """
+    Builds the aiohttp middleware setting the route of every request for the slow operation log.
+    """
+    from aiohttp import web
+
+    @web.middleware
+    async def route(request, handler):
+        resource = request.match_info.route.resource
+        current_route.set(f"{request.method} {resource.canonical if resource is not None else request.path}")
+        return await handler(request)
+
+    return route
@@ -0,0 +1,276 @@
+import os
+import atexit
+import logging
+import threading
+from pymongo.errors import PyMongoError, BulkWriteError
+from RatingsCollection import failedIds
+
+logger = logging.getLogger(__name__)
+
+class RatingBuffer:
+    """
+    This class represents a write-behind buffer for rating values. Values posted
+    to the same rating are added up in memory and written every flush_interval
+    seconds, or as soon as flush_events values are waiting, as one bulk_write of
+    increments, see RatingsCollection.addValues. The buffer is flushed on shutdown.
+
+    Values still in the buffer are lost if the process dies without shutting down,
+    for at most flush_interval seconds or flush_events values. The average returned
+    to the client is computed from the rating totals read when the rating entered
+    the buffer plus the buffered values, so it can miss values another replica
+    wrote in the meantime. The stored histogram, count and sum are always exact,
+    since the increments of all replicas add up in the database.
+    """
+    def __init__(self, ratings, flush_interval=0.05, flush_events=500, max_pending=10000, full_timeout=1):
+        """
+        Initializes a new RatingBuffer object.
+
+        Args:
+            ratings (RatingsCollection): The ratings the values are written to.
+            flush_interval (float): Seconds between flushes.
+            flush_events (int): Number of buffered values which triggers a flush before the interval.
+            max_pending (int): Number of buffered values past which new values wait for a flush.
+            full_timeout (float): Seconds a value waits for room in a full buffer before it is written directly.
+        """
+        self.ratings = ratings
+        self.flush_interval = flush_interval
+        self.flush_events = flush_events
+        self.max_pending = max_pending
+        self.full_timeout = full_timeout
+        self.lock = threading.Condition()
+        self.pending = {}
+        self.flushing = {}
+        self.events = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.failures = 0
+        self.overflows = 0
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.registered = False
+
+    @classmethod
+    def fromEnvironment(cls, ratings):
+        """
+        Creates a RatingBuffer configured from the RATING_FLUSH_* and RATING_BUFFER_* environment variables.
+        """
+        return cls(
+            ratings,
+            flush_interval=float(os.environ.get("RATING_FLUSH_INTERVAL_MS", 50)) / 1000,
+            flush_events=int(os.environ.get("RATING_FLUSH_EVENTS", 500)),
+            max_pending=int(os.environ.get("RATING_BUFFER_MAX", 10000)),
+            full_timeout=float(os.environ.get("RATING_BUFFER_FULL_TIMEOUT", 1))
+        )
+
+    @staticmethod
+    def _totals(entry):
+        return {"count": entry["base"]["count"] + entry["count"], "sum": entry["base"]["sum"] + entry["sum"]}
+
+    def _entry(self, id):
+        """
+        Finds the buffer entry of a rating, creating it from the stored totals if needed.
+        Must be called with the lock held, which is released while the database is read.
+
+        Returns:
+            dict: The entry, None if the rating is not in the collection.
+        """
+        if id not in self.pending and id not in self.flushing:
+            self.lock.release()
+            try:
+                found, totals = self.ratings.findTotals(id)
+            finally:
+                self.lock.acquire()
+            if not found:
+                return None
+        if id not in self.pending:
+            # Values being flushed are not stored yet, so they are counted from the flushed entry.
+            base = self._totals(self.flushing[id]) if id in self.flushing else totals
+            self.pending[id] = {"base": base, "counts": {}, "count": 0, "sum": 0}
+        return self.pending[id]
+
+    def addValue(self, id, value):
+        """
+        Buffers a value of a rating. When the buffer is full, waits for a flush to make
+        room, and writes the value directly if none has after full_timeout seconds.
+
+        Args:
+            id (str): The ID of the rating.
+            value (int): The value to add.
+
+        Returns:
+            tuple: A tuple containing (bool, float).
+                - bool: True if the value was added, False if the rating is not in the collection.
+                - float: The new average rating including the buffered values, None if not added.
+        """
+        value = int(value)
+        with self.lock:
+            room = True
+            if self.events >= self.max_pending:
+                self.wake.set()
+                room = self.lock.wait_for(lambda: self.events < self.max_pending, self.full_timeout)
+            if room:
+                entry = self._entry(id)
+                if entry is None:
+                    return False, None
+                entry["counts"][value] = entry["counts"].get(value, 0) + 1
+                entry["count"] += 1
+                entry["sum"] += value
+                self.events += 1
+                totals = self._totals(entry)
+                if self.events >= self.flush_events:
+                    self.wake.set()
+            else:
+                self.overflows += 1
+        if not room:
+            logger.warning('rating buffer full, writing value of %s directly', id)
+            return self.ratings.updateRating(id, value)
+        # Cached responses of the rating are dropped so they are rebuilt with the buffered values.
+        self.ratings.notify("update", [id])
+        return True, round(totals["sum"] / totals["count"], 2)
+
+    def overlay(self, id, rating):
+        """
+        Adds the buffered values of a rating to the rating read from the database.
+
+        Args:
+            id (str): The ID of the rating.
+            rating (dict): The rating as returned by RatingsCollection.findRating.
+
+        Returns:
+            dict: The rating with its buffered values.
+        """
+        with self.lock:
+            # Values being flushed are not in the rating read yet, unless their write applied in between.
+            entries = [entry for entry in (self.flushing.get(id), self.pending.get(id)) if entry is not None]
+            if not entries:
+                return rating
+            counts = dict(rating["counts"])
+            count = rating["count"]
+            total = rating["sum"]
+            for entry in entries:
+                for star, number in entry["counts"].items():
+                    counts[str(star)] = counts.get(str(star), 0) + number
+                count += entry["count"]
+                total += entry["sum"]
+        return {**rating, "counts": counts, "count": count, "sum": total, "average": round(total / count, 2)}
+
+    def _stored(self, ids):
+        """
+        Drops the entries of ratings whose values were written from the entries being flushed.
+        """
+        with self.lock:
+            for id in ids:
+                self.flushing.pop(id, None)
+
+    def _restore(self, entries):
+        """
+        Puts entries whose write failed back in the buffer, ahead of the values buffered since.
+        Must be called with the lock held.
+        """
+        for id, entry in entries.items():
+            self.flushing.pop(id, None)
+            self.events += entry["count"]
+            newer = self.pending.get(id)
+            if newer is not None:
+                for star, number in newer["counts"].items():
+                    entry["counts"][star] = entry["counts"].get(star, 0) + number
+                entry["count"] += newer["count"]
+                entry["sum"] += newer["sum"]
+            self.pending[id] = entry
+
+    def flush(self):
+        """
+        Writes the buffered values. Values whose write did not apply are put back
+        in the buffer so the next flush retries them; values which were written are
+        never put back, even if updating the statistics afterwards failed.
+
+        Returns:
+            int: The number of values written.
+        """
+        with self.lock:
+            if not self.pending:
+                return 0
+            batch, self.pending = self.pending, {}
+            events, self.events = self.events, 0
+            self.flushing = dict(batch)
+            self.lock.notify_all()
+        try:
+            self.ratings.addValues({id: entry["counts"] for id, entry in batch.items()}, self._stored)
+        except BulkWriteError as error:
+            failed = failedIds(error, list(batch.keys()))
+            written = events - sum(batch[id]["count"] for id in failed)
+            with self.lock:
+                self._restore({id: entry for id, entry in batch.items() if id in failed})
+                self.failures += 1
+                self.flushes += 1
+                self.flushed += written
+            raise
+        except PyMongoError:
+            with self.lock:
+                self._restore(batch)
+                self.failures += 1
+            raise
+        finally:
+            with self.lock:
+                self.flushing = {}
+        with self.lock:
+            self.flushes += 1
+            self.flushed += events
+        return events
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except PyMongoError as error:
+                logger.warning('rating flush failed, retrying: %s', error)
+        while True:
+            try:
+                if not self.flush():
+                    return
+            except PyMongoError as error:
+                logger.error('rating flush failed on shutdown, values were lost: %s', error)
+                return
+
+    def start(self):
+        """
+        Starts the flush thread of the current process.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="rating-buffer", daemon=True)
+        self.thread.start()
+        if not self.registered:
+            atexit.register(self.stop)
+            self.registered = True
+
+    def stop(self, timeout=10):
+        """
+        Stops the flush thread after a last flush of the buffered values.
+        """
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def info(self):
+        """
+        Retrieves the state of the buffer.
+
+        Returns:
+            dict: The number of buffered values and ratings, flushes, values written, failed flushes and overflows.
+        """
+        with self.lock:
+            return {
+                "pendingValues": self.events,
+                "pendingRatings": len(self.pending),
+                "flushes": self.flushes,
+                "flushedValues": self.flushed,
+                "failures": self.failures,
+                "overflows": self.overflows
+            }
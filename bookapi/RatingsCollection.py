@@ -1,20 +1,185 @@
+import logging
+import time
 import pymongo
+from pymongo import ReturnDocument, UpdateOne, DeleteOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
 from bson.objectid import ObjectId
+import Database
+import CatalogStats
+
+logger = logging.getLogger(__name__)
+
+TOP_MIN_COUNT = 3
+TOP_SIZE = 3
+
+RATING_FIELDS = ["title", "counts", "count", "sum", "average"]
+# A rating keeps the genre of its book for the catalog statistics, it is never part of a response.
+HIDDEN_FIELDS = {"genre": 0}
+
+RATING_INDEXES = [
+    pymongo.IndexModel([("title", pymongo.ASCENDING)], name="title"),
+    pymongo.IndexModel(
+        [("average", pymongo.DESCENDING)],
+        name="top_average",
+        partialFilterExpression={"count": {"$gte": TOP_MIN_COUNT}}
+    ),
+]
+
+MIGRATION_UPDATE = [
+    {"$set": {
+        "counts": {
+            str(star): {"$size": {"$filter": {"input": "$values", "cond": {"$eq": ["$$this", star]}}}}
+            for star in range(1, 6)
+        },
+        "count": {"$size": "$values"},
+        "sum": {"$sum": "$values"}
+    }},
+    {"$set": {"average": {"$cond": [
+        {"$gt": ["$count", 0]},
+        {"$round": [{"$divide": ["$sum", "$count"]}, 2]},
+        0
+    ]}}},
+    {"$unset": "values"}
+]
+
+def incrementUpdate(counts):
+    """
+    Builds the pipeline update adding values to a rating: the histogram, count
+    and sum are incremented and the average recomputed from them.
+
+    Args:
+        counts (dict): The number of values to add per star.
+
+    Returns:
+        list: The update pipeline.
+    """
+    counts = {int(star): number for star, number in counts.items() if number}
+    increments = {
+        f"counts.{star}": {"$add": [{"$ifNull": [f"$counts.{star}", 0]}, number]}
+        for star, number in counts.items()
+    }
+    return [
+        {"$set": {
+            **increments,
+            "count": {"$add": [{"$ifNull": ["$count", 0]}, sum(counts.values())]},
+            "sum": {"$add": [{"$ifNull": ["$sum", 0]}, sum(star * number for star, number in counts.items())]}
+        }},
+        {"$set": {"average": {"$round": [{"$divide": ["$sum", "$count"]}, 2]}}}
+    ]
+
+def valueUpdate(value):
+    """
+    Builds the pipeline update adding a single value to a rating, see incrementUpdate.
+    """
+    return incrementUpdate({int(value): 1})
+
+def failedIds(error, ids):
+    """
+    Finds the writes of an unordered bulk_write which failed.
+
+    Args:
+        error (BulkWriteError): The error raised by the bulk_write.
+        ids (list): The IDs of the written documents, in the order of the writes.
+
+    Returns:
+        set: The IDs whose write failed, the others were applied.
+    """
+    return {ids[write_error["index"]] for write_error in error.details.get("writeErrors", [])}
+
+def genreTotals(ratings, sign=1):
+    """
+    Adds up the number and the sum of the values of ratings by genre, see CatalogStats.count.
+    """
+    totals = {}
+    for rating in ratings:
+        count, total = totals.get(rating.get("genre"), (0, 0))
+        totals[rating.get("genre")] = (count + sign * rating.get("count", 0), total + sign * rating.get("sum", 0))
+    return totals
+
+def anyEligible(ratings):
+    """
+    Checks whether any of the ratings has the TOP_MIN_COUNT values needed to be on the leaderboard.
+    """
+    return any(rating.get("count", 0) >= TOP_MIN_COUNT for rating in ratings)
+
+def topChangedBy(board, id, rating):
+    """
+    Checks whether a rating write can change the leaderboard: the rating is on
+    the leaderboard, or it is eligible and its average reaches the leaderboard
+    threshold, or fewer than TOP_SIZE ratings are eligible yet.
+
+    Args:
+        board (dict): The leaderboard document, None if there is none yet.
+        id (str): The ID of the written rating.
+        rating (dict): The rating after the write with its "count" and "average", None if it was deleted.
+
+    Returns:
+        bool: True if the leaderboard has to be refreshed, False otherwise.
+    """
+    if board is None or id in board["ids"]:
+        return True
+    if rating is None or rating["count"] < TOP_MIN_COUNT:
+        return False
+    return not board["full"] or rating["average"] >= board["threshold"]
 
 class RatingsCollection:
     """
     This class represents a collection of ratings. It provides methods
     to insert, delete, find, update, retrieve all, retrieve by parameter,
     and retrieve the top-rated ratings.
+
+    A rating stores a histogram of its values instead of the values themselves:
+    "counts" maps each star ("1" to "5") to the number of times it was given,
+    next to the total "count", the "sum" of the values and their "average".
+
+    The top ratings are materialized in a single leaderboard document that is
+    recomputed on the rating write path only when a write can change it.
     """
 
-    def __init__(self):
+    def __init__(self, database=None):
         """
         Initializes a new RatingsCollection object.
+
+        Args:
+            database (Database): The database holding the ratings, defaults to the shared database.
+        """
+        self.database = database or Database.database
+        self.stats = CatalogStats.CatalogStats(self.database)
+        self.listeners = []
+
+    @property
+    def collection(self):
+        return self.database.collection("ratings")
+
+    @property
+    def leaderboard(self):
+        return self.database.collection("leaderboard")
+
+    def addListener(self, listener):
+        """
+        Registers a function called after every write to the collection.
+
+        Args:
+            listener (callable): Called with the event ("insert", "update" or "delete")
+                and the list of the IDs of the written ratings.
+        """
+        self.listeners.append(listener)
+
+    def notify(self, event, ids):
+        """
+        Calls the registered listeners for a write.
+        """
+        for listener in self.listeners:
+            listener(event, ids)
+
+    def ensureIndexes(self):
+        """
+        Creates the indexes supporting the ratings queries: title lookups and
+        sorting the ratings eligible for the top ratings by average.
+        Safe to call repeatedly, existing indexes are left untouched.
         """
-        self.client = pymongo.MongoClient("mongodb://mongo:27017/")
-        self.db = self.client["library"]
-        self.collection = self.db["ratings"]
+        self.collection.create_indexes(RATING_INDEXES)
+        logger.info("indexes ensured")
     
     def insertRating(self, rating):
         """
@@ -22,20 +187,46 @@ class RatingsCollection:
 
         Args:
             rating (dict): A dictionary containing the rating information.
-                Expected keys: "id", "title", "values" (list of values), and "average".
+                Expected keys: "_id" (the ID of the rated book), "title", "counts", "count", "sum" and "average".
 
         Returns:
             str: The ID of the inserted rating as a string, or None if it already exists.
         """
-        if self.collection.find_one({"title": rating["title"]}):
-            print("RatingsCollection: rating already inserted")
+        try:
+            result = self.collection.insert_one(rating)
+        except DuplicateKeyError:
+            logger.info("rating already inserted")
             return None
-        
-        result = self.collection.insert_one(rating)
+
         rating_id = str(result.inserted_id)
-        print(f'RatingsCollection: inserted rating: {rating["title"]} with ID: {rating_id}')
+        logger.info('inserted rating: %s with ID: %s', rating["title"], rating_id)
+        self.notify("insert", [rating_id])
         return rating_id
     
+    def insertRatings(self, ratings):
+        """
+        Inserts many ratings with a single unordered insert_many.
+
+        Args:
+            ratings (list): A list of rating dictionaries, see insertRating.
+
+        Returns:
+            list: The ID of each inserted rating as a string, or None where the insert failed,
+                in the order of the given ratings.
+        """
+        if not ratings:
+            return []
+        failed = set()
+        try:
+            self.collection.insert_many(ratings, ordered=False)
+        except BulkWriteError as error:
+            failed = {write_error["index"] for write_error in error.details["writeErrors"]}
+        logger.info('inserted %s of %s ratings', len(ratings) - len(failed), len(ratings))
+        ids = [None if index in failed else str(rating["_id"]) for index, rating in enumerate(ratings)]
+        self.stats.count(ratings=genreTotals(rating for index, rating in enumerate(ratings) if index not in failed))
+        self.notify("insert", [id for id in ids if id is not None])
+        return ids
+
     def deleteRating(self, id):
         """
         Deletes a rating from the collection by its ID.
@@ -46,14 +237,67 @@ class RatingsCollection:
         Returns:
             bool: True if the rating was deleted, False otherwise.
         """
-        result = self.collection.delete_one({"_id": ObjectId(id)})
-        if result.deleted_count > 0:
-            print(f'RatingsCollection: deleted rating with ID: {id}')
+        rating = self.collection.find_one_and_delete({"_id": ObjectId(id)}, projection={"genre": 1, "count": 1, "sum": 1})
+        if rating:
+            logger.info('deleted rating with ID: %s', id)
+            self.stats.count(ratings=genreTotals([rating], -1))
+            self.notify("delete", [id])
+            self.updateTop(id)
             return True
         else:
-            print("RatingsCollection: rating not in collection")
+            logger.debug("rating not in collection")
             return False
         
+    def deleteRatings(self, ids, session=None):
+        """
+        Deletes many ratings with a single unordered bulk_write. Listeners are not
+        notified and the leaderboard is not refreshed here, see BooksCollection.deleteBooks
+        and updateTopFor.
+
+        Args:
+            ids (list): The IDs of the ratings to delete.
+            session (ClientSession): The session of the surrounding transaction, if any.
+        """
+        if ids:
+            ratings = list(self.collection.find(
+                {"_id": {"$in": [ObjectId(id) for id in ids]}}, {"genre": 1, "count": 1, "sum": 1}, session=session
+            ))
+            result = self.collection.bulk_write([DeleteOne({"_id": ObjectId(id)}) for id in ids], ordered=False, session=session)
+            self.stats.count(ratings=genreTotals(ratings, -1), session=session)
+            logger.info('deleted %s ratings', result.deleted_count)
+
+    def renameRatings(self, ids, title, session=None):
+        """
+        Sets the title of many ratings after their books were renamed, see deleteRatings.
+
+        Args:
+            ids (list): The IDs of the ratings to rename.
+            title (str): The new title.
+            session (ClientSession): The session of the surrounding transaction, if any.
+        """
+        if ids:
+            updates = [UpdateOne({"_id": ObjectId(id)}, {"$set": {"title": title}}) for id in ids]
+            self.collection.bulk_write(updates, ordered=False, session=session)
+
+    def changeGenre(self, ids, genre, session=None):
+        """
+        Sets the genre of many ratings after their books moved to another genre,
+        moving their values between the genre statistics.
+
+        Args:
+            ids (list): The IDs of the ratings.
+            genre (str): The new genre.
+            session (ClientSession): The session of the surrounding transaction, if any.
+        """
+        query = {"_id": {"$in": [ObjectId(id) for id in ids]}, "genre": {"$ne": genre}}
+        ratings = list(self.collection.find(query, {"genre": 1, "count": 1, "sum": 1}, session=session))
+        if not ratings:
+            return
+        self.collection.update_many({"_id": {"$in": [rating["_id"] for rating in ratings]}}, {"$set": {"genre": genre}}, session=session)
+        totals = genreTotals(ratings, -1)
+        totals[genre] = genreTotals([{**rating, "genre": genre} for rating in ratings])[genre]
+        self.stats.count(ratings=totals, session=session)
+
     def findRating(self, id):
         """
         Finds a rating by its ID.
@@ -66,49 +310,169 @@ class RatingsCollection:
                 - bool: True if the rating was found, False otherwise.
                 - rating (dict): The rating itself if found, None otherwise.
         """
-        rating = self.collection.find_one({"_id": ObjectId(id)})
+        rating = self.collection.find_one({"_id": ObjectId(id)}, HIDDEN_FIELDS)
         if rating:
             rating["id"] = str(rating["_id"])
             del rating["_id"]
-            print(f'RatingsCollection: found rating: {rating["title"]} with ID: {id}')
+            logger.debug('found rating: %s with ID: %s', rating["title"], id)
             return True, rating
         else:
-            print("RatingsCollection: rating not in collection")
+            logger.debug("rating not in collection")
             return False, None
         
     def updateRating(self, id, value):
         """
-        Updates a rating's value (adds a new value).
+        Updates a rating's value (adds a new value). The histogram, count and sum are
+        incremented and the average recomputed by the database in a single atomic
+        update, so concurrent updates are never lost and the cost does not depend
+        on the number of values.
 
         Args:
             id (str): The ID of the rating to update.
-            value (int): The new value to add to the rating's values list.
+            value (int): The new value to add to the rating.
 
         Returns:
             tuple: A tuple containing (bool, float).
                 - bool: True if the rating was updated, False otherwise.
                 - float: The new average rating after update, None if update failed.
         """
-        rating = self.collection.find_one({"_id": ObjectId(id)})
-        if not rating:
-            print("RatingsCollection: rating not in collection")
-            return False, None
-        
-        values = rating["values"]
-        values.append(value)
-        average = round(sum(values) / len(values), 2)
-        update_result = self.collection.update_one(
+        rating = self.collection.find_one_and_update(
             {"_id": ObjectId(id)},
-            {"$set": {"values": values, "average": average}}
+            valueUpdate(value),
+            projection={"title": 1, "average": 1, "count": 1, "genre": 1},
+            return_document=ReturnDocument.AFTER
         )
-        
-        if update_result.modified_count > 0:
-            print(f'RatingsCollection: updated rating: {rating["title"]} with ID: {id}')
-            return True, average
-        else:
-            print("RatingsCollection: failed to update rating")
+        if not rating:
+            logger.debug("rating not in collection")
             return False, None
-    
+        self.stats.count(ratings={rating.get("genre"): (1, int(value))})
+
+        logger.info('updated rating: %s with ID: %s', rating["title"], id)
+        self.notify("update", [id])
+        self.updateTop(id, rating)
+        return True, rating["average"]
+
+    def findTotals(self, id):
+        """
+        Finds the number and the sum of the values of a rating.
+
+        Args:
+            id (str): The ID of the rating.
+
+        Returns:
+            tuple: A tuple containing (bool, totals).
+                - bool: True if the rating was found, False otherwise.
+                - totals (dict): The "count" and "sum" of the rating if found, None otherwise.
+        """
+        rating = self.collection.find_one({"_id": ObjectId(id)}, {"count": 1, "sum": 1, "_id": 0})
+        if not rating:
+            return False, None
+        return True, {"count": rating.get("count", 0), "sum": rating.get("sum", 0)}
+
+    def addValues(self, increments, written=None):
+        """
+        Adds buffered values to many ratings with a single unordered bulk_write,
+        then refreshes the leaderboard once if any of the writes can change it.
+        Once the bulk_write has applied, the caches, statistics and leaderboard are
+        updated best effort: their failures are logged and never raised, so a caller
+        retrying on error never adds the same values twice.
+
+        Args:
+            increments (dict): The number of values to add per star, by rating ID.
+            written (callable): Called with the list of rating IDs whose values were stored,
+                right after the bulk_write and before the listeners are notified.
+
+        Returns:
+            int: The number of ratings updated.
+
+        Raises:
+            BulkWriteError: If some of the updates failed, the others are stored.
+                The failed ones are listed by index in the writeErrors of its details,
+                in the order of increments, see failedIds.
+            PyMongoError: If the bulk_write failed, no value is stored.
+        """
+        if not increments:
+            return 0
+        ids = list(increments.keys())
+        updates = [UpdateOne({"_id": ObjectId(id)}, incrementUpdate(counts)) for id, counts in increments.items()]
+        try:
+            result = self.collection.bulk_write(updates, ordered=False)
+        except BulkWriteError as error:
+            failed = failedIds(error, ids)
+            stored = {id: counts for id, counts in increments.items() if id not in failed}
+            logger.warning('added values to %s ratings, %s updates failed', len(stored), len(failed))
+            if written is not None:
+                written(list(stored.keys()))
+            self._valuesAdded(stored)
+            raise
+        logger.info('added values to %s ratings', result.modified_count)
+        if written is not None:
+            written(ids)
+        self._valuesAdded(increments)
+        return result.modified_count
+
+    def _valuesAdded(self, increments):
+        """
+        Notifies the listeners, counts the values in the statistics and refreshes the
+        leaderboard after values were stored. Errors are logged, not raised.
+        """
+        if not increments:
+            return
+        ids = list(increments.keys())
+        try:
+            self.notify("update", ids)
+            board = self.leaderboard.find_one({"_id": "top"}, {"ids": 1, "threshold": 1, "full": 1})
+            ratings = list(self.collection.find({"_id": {"$in": [ObjectId(id) for id in ids]}}, {"average": 1, "count": 1, "genre": 1}))
+            self.stats.count(ratings=genreTotals({
+                "genre": rating.get("genre"),
+                "count": sum(increments[str(rating["_id"])].values()),
+                "sum": sum(int(star) * number for star, number in increments[str(rating["_id"])].items())
+            } for rating in ratings))
+            if any(topChangedBy(board, str(rating["_id"]), rating) for rating in ratings):
+                self.refreshTop()
+        except Exception:
+            logger.exception('values were added to %s ratings but updating the statistics or the leaderboard failed', len(ids))
+
+    def migrateRatings(self):
+        """
+        Converts ratings still storing a "values" list to the histogram model.
+        The conversion runs on the server in a single update and only touches
+        ratings that have not been migrated yet, so it is safe to call on every startup.
+
+        Returns:
+            int: The number of migrated ratings.
+        """
+        result = self.collection.update_many({"values": {"$exists": True}}, MIGRATION_UPDATE)
+        logger.info('migrated %s ratings', result.modified_count)
+        return result.modified_count
+
+    def exportRatings(self, batch_size=1000):
+        """
+        Iterates over every rating in _id order, see CatalogDump.exportRecords.
+
+        Returns:
+            Cursor: The ratings, without the title and genre copied from their book.
+        """
+        return self.collection.find({}, {"title": 0, "genre": 0}, batch_size=batch_size).sort("_id", pymongo.ASCENDING)
+
+    def findRatings(self, limit=None, after=None, fields=None, batch_size=500):
+        """
+        Iterates over the ratings straight from the database cursor. When a limit
+        or an after cursor is given the ratings come in _id order, so passing the
+        ID of the last rating of a page as after retrieves the next page.
+
+        Args:
+            limit (int): The maximum number of ratings to retrieve, None for no limit.
+            after (str): Only retrieve ratings with an ID greater than this one.
+            fields (list): The rating fields to retrieve, None for all of them. "id" is always retrieved.
+            batch_size (int): The number of ratings fetched from the database per round trip.
+
+        Returns:
+            generator: The ratings.
+        """
+        pipeline = Database.listPipeline({}, fields or RATING_FIELDS, limit, after)
+        yield from self.collection.aggregate(pipeline, batchSize=batch_size)
+
     def retrieveAllRatings(self):
         """
         Retrieves all ratings in the collection.
@@ -116,52 +480,81 @@ class RatingsCollection:
         Returns:
             list: A list of all the ratings.
         """
-        ratings = list(self.collection.find())
-        for rating in ratings:
-            rating["id"] = str(rating["_id"])
-            del rating["_id"]
-        return ratings
+        return list(self.findRatings())
         
+    def refreshTop(self):
+        """
+        Recomputes the leaderboard document from the ratings with at least
+        TOP_MIN_COUNT values: the TOP_SIZE highest averages, including every
+        rating tied with the last of them. Both reads use the top_average index.
+        A refresh never overwrites a leaderboard computed from newer data.
+
+        Returns:
+            list: The top ratings.
+        """
+        computed_at = time.time()
+        eligible = {"count": {"$gte": TOP_MIN_COUNT}}
+        highest = list(self.collection.find(eligible, {"average": 1}).sort("average", pymongo.DESCENDING).limit(TOP_SIZE))
+        top_ratings = []
+        threshold = None
+        if highest:
+            threshold = highest[-1]["average"]
+            top_ratings = list(self.collection.find(
+                {"count": {"$gte": TOP_MIN_COUNT}, "average": {"$gte": threshold}}, HIDDEN_FIELDS
+            ).sort("average", pymongo.DESCENDING))
+            for rating in top_ratings:
+                rating["id"] = str(rating["_id"])
+                del rating["_id"]
+
+        try:
+            self.leaderboard.update_one(
+                {"_id": "top", "computedAt": {"$lt": computed_at}},
+                {"$set": {
+                    "ratings": top_ratings,
+                    "ids": [rating["id"] for rating in top_ratings],
+                    "threshold": threshold,
+                    "full": len(highest) == TOP_SIZE,
+                    "computedAt": computed_at
+                }},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            logger.debug("newer leaderboard already stored")
+        return top_ratings
+
+    def updateTop(self, id, rating=None):
+        """
+        Refreshes the leaderboard if a rating write can change it, see topChangedBy.
+
+        Args:
+            id (str): The ID of the written rating.
+            rating (dict): The rating after the write with its "count" and "average", None if it was deleted.
+        """
+        board = self.leaderboard.find_one({"_id": "top"}, {"ids": 1, "threshold": 1, "full": 1})
+        if topChangedBy(board, id, rating):
+            self.refreshTop()
+
+    def updateTopFor(self, ids):
+        """
+        Refreshes the leaderboard if it holds any of the given ratings, after they were deleted or renamed.
+
+        Args:
+            ids (list): The IDs of the written ratings.
+        """
+        if not ids:
+            return
+        board = self.leaderboard.find_one({"_id": "top"}, {"ids": 1})
+        if board is None or not set(board["ids"]).isdisjoint(ids):
+            self.refreshTop()
+
     def retrieveTop(self):
         """
-        Retrieves the top three rated ratings from the collection.
+        Retrieves the top three rated ratings from the leaderboard document.
 
         Returns:
             list: A list of ratings with the top 3 averages in descending order.
         """
-        pipeLine = [
-            {"$match": {"$expr": {"$gte": [{"$size": "$values"}, 3]}}},  
-            {"$sort": {"average": pymongo.DESCENDING}}, 
-            {"$limit": 3},  
-            {"$group": { 
-                "_id": None,
-                "thirdHighestAvg": {"$min": "$average"}
-            }},
-            {"$addFields": {  
-                "minAvg": "$thirdHighestAvg"
-            }},
-            {"$lookup": {  
-                "from": "ratings",  
-                "let": {"minAvg": "$minAvg"},
-                "pipeline": [
-                    {"$match": {
-                        "$expr": {
-                            "$and": [
-                                {"$gte": ["$average", "$$minAvg"]},
-                                {"$gte": [{"$size": "$values"}, 3]}
-                            ]
-                        }
-                    }}
-                ],
-                "as": "eligibleRatings"
-            }},
-            {"$unwind": "$eligibleRatings"},
-            {"$replaceRoot": {"newRoot": "$eligibleRatings"}}
-        ]
-                    
-        top_ratings = list(self.collection.aggregate(pipeLine))
-
-        for rating in top_ratings:
-            rating["id"] = str(rating["_id"])
-            del rating["_id"]
-        return top_ratings
+        board = self.leaderboard.find_one({"_id": "top"}, {"ratings": 1})
+        if board is None:
+            return self.refreshTop()
+        return board["ratings"]
@@ -0,0 +1,136 @@
+import hashlib
+import threading
+from urllib.parse import urlencode
+from LRUCache import LRUCache
+import JsonEncoder
+
+NAMESPACES = ["book", "books", "rating"]
+
+class ResponseCache:
+    """
+    This class represents a read-through cache of response bodies for the book
+    and rating reads, with a strong ETag per entry. Entries are kept per
+    namespace: "book" and "rating" by ID, "books" by normalized query string.
+    It listens to the collections and drops the entries a write can change.
+    """
+    def __init__(self, maxsize=10000, ttl=5):
+        """
+        Initializes a new ResponseCache object.
+
+        Args:
+            maxsize (int): The maximum number of entries kept per namespace.
+            ttl (float): Seconds an entry stays valid. Writes made by other processes
+                are only seen once the entry expires.
+        """
+        self.caches = {namespace: LRUCache(maxsize, ttl) for namespace in NAMESPACES}
+        self.generations = {namespace: 0 for namespace in NAMESPACES}
+        self.lock = threading.Lock()
+        self.not_modified = 0
+
+    @staticmethod
+    def queryKey(args):
+        """
+        Normalizes query parameters so the same query in any parameter order shares an entry.
+
+        Args:
+            args (MultiDict): The request query parameters.
+
+        Returns:
+            str: The normalized query string.
+        """
+        return urlencode(sorted(args.items(multi=True)))
+
+    @staticmethod
+    def etag(body):
+        """
+        Computes the strong ETag of a response body.
+        """
+        return hashlib.sha1(JsonEncoder.dumps(body, sort_keys=True)).hexdigest()
+
+    def generation(self, namespace):
+        """
+        Retrieves the invalidation counter of a namespace, to pass to set.
+        """
+        return self.generations[namespace]
+
+    def get(self, namespace, key):
+        """
+        Finds a cached response.
+
+        Returns:
+            tuple: A tuple containing (bool, entry).
+                - bool: True if the response is cached, False otherwise.
+                - entry (tuple): The (etag, body, headers) of the response if cached, None otherwise.
+        """
+        return self.caches[namespace].get(key)
+
+    def set(self, namespace, key, body, headers, generation):
+        """
+        Caches a response, unless the namespace was invalidated since the response was read.
+
+        Args:
+            namespace (str): The namespace of the entry.
+            key (str): The ID or normalized query of the entry.
+            body: The response body.
+            headers (dict): Extra response headers.
+            generation (int): The namespace generation read before the response was read.
+
+        Returns:
+            str: The ETag of the response.
+        """
+        etag = self.etag(body)
+        with self.lock:
+            if self.generations[namespace] == generation:
+                self.caches[namespace].set(key, (etag, body, headers))
+        return etag
+
+    def invalidate(self, namespace, key=None):
+        """
+        Drops one entry of a namespace, or all of them when no key is given.
+        """
+        with self.lock:
+            self.generations[namespace] += 1
+            if key is None:
+                self.caches[namespace].clear()
+            else:
+                self.caches[namespace].delete(key)
+
+    def invalidateAll(self):
+        """
+        Drops every entry of every namespace.
+        """
+        for namespace in NAMESPACES:
+            self.invalidate(namespace)
+
+    def onBookChange(self, event, ids):
+        """
+        Listener for BooksCollection writes. Any book write can change any query,
+        so every query entry is dropped along with the entries of the written books.
+        """
+        self.invalidate("books")
+        if event != "insert":
+            for id in ids:
+                self.invalidate("book", id)
+
+    def onRatingChange(self, event, ids):
+        """
+        Listener for RatingsCollection writes.
+        """
+        if event != "insert":
+            for id in ids:
+                self.invalidate("rating", id)
+
+    def countNotModified(self):
+        with self.lock:
+            self.not_modified += 1
+
+    def info(self):
+        """
+        Retrieves the cache counters.
+
+        Returns:
+            dict: The counters of every namespace and the number of 304 responses.
+        """
+        info = {namespace: cache.info() for namespace, cache in self.caches.items()}
+        info["notModified"] = self.not_modified
+        return info
@@ -0,0 +1,66 @@
+import JsonEncoder
+import Encoding
+from flask import Response, request, stream_with_context
+
+def jsonArray(documents, batch_size=500):
+    """
+    Encodes documents as a single JSON array, yielding one chunk per batch of documents.
+
+    Args:
+        documents (iterable): The documents to encode.
+        batch_size (int): The number of documents encoded per chunk.
+
+    Returns:
+        generator: The encoded chunks.
+    """
+    yield b"["
+    batch = []
+    first = True
+    for document in documents:
+        batch.append(JsonEncoder.dumps(document))
+        if len(batch) == batch_size:
+            yield (b"" if first else b",") + b",".join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield (b"" if first else b",") + b",".join(batch)
+    yield b"]"
+
+def jsonLines(documents, batch_size=500):
+    """
+    Encodes documents as newline delimited JSON, yielding one chunk per batch of documents.
+
+    Args:
+        documents (iterable): The documents to encode.
+        batch_size (int): The number of documents encoded per chunk.
+
+    Returns:
+        generator: The encoded chunks.
+    """
+    batch = []
+    for document in documents:
+        batch.append(JsonEncoder.dumps(document) + b"\n")
+        if len(batch) == batch_size:
+            yield b"".join(batch)
+            batch = []
+    if batch:
+        yield b"".join(batch)
+
+def streamResponse(documents, mode):
+    """
+    Builds a response that streams documents to the client while they are read
+    from the database cursor, so memory use does not depend on the number of documents.
+
+    Args:
+        documents (iterable): The documents to stream.
+        mode (str): "json" for a JSON array, "ndjson" for newline delimited JSON.
+            A client preferring MessagePack gets a sequence of MessagePack documents in either mode.
+
+    Returns:
+        Response: The streamed response.
+    """
+    if Encoding.prefersMsgpack(request.accept_mimetypes):
+        return Response(stream_with_context(Encoding.packStream(documents)), status=200, mimetype=Encoding.MSGPACK_MIMETYPE)
+    if mode == "ndjson":
+        return Response(stream_with_context(jsonLines(documents)), status=200, mimetype="application/x-ndjson")
+    return Response(stream_with_context(jsonArray(documents)), status=200, mimetype="application/json")
@@ -0,0 +1,210 @@
+from bson.objectid import ObjectId
+
+supported_genre_list = ["Fiction", "Children", "Biography", "Science", "Science Fiction", "Fantasy", "Other"]
+book_fields = ["title", "ISBN", "genre", "authors", "publisher", "publishedDate", "id"]
+rating_fields = ["title", "counts", "count", "sum", "average", "id"]
+valid_ratings = [1,2,3,4,5]
+paging_params = ["limit", "after", "fields", "stream"]
+bulk_update_fields = ["title", "genre", "authors", "publisher", "publishedDate"]
+stream_modes = ["json", "ndjson"]
+
+def isValidISBN(isbn):
+    """
+    Checks that an ISBN is a string of exactly 13 ASCII digits.
+    """
+    return isinstance(isbn, str) and len(isbn) == 13 and isbn.isascii() and isbn.isdigit()
+
+def parseNewBook(args):
+    """
+    Builds a new book from the body of a POST /books request.
+
+    Args:
+        args (dict): The request body. Expected keys: "title", "ISBN", "genre".
+
+    Returns:
+        tuple: A tuple containing (bool, book).
+            - bool: True if the body describes a valid book, False otherwise.
+            - book (dict): The book with its title, ISBN and genre if valid, None otherwise.
+
+    Raises:
+        TypeError: If the body is not a JSON object.
+    """
+    try:
+        book = {"title" : args["title"], "ISBN" : args["ISBN"], "genre" : args["genre"]}
+    except KeyError:
+        return False, None
+    if book["genre"] not in supported_genre_list or not isValidISBN(book["ISBN"]):
+        return False, None
+    return True, book
+
+def validateBookFilters(filters):
+    """
+    Checks the filters of a GET /books request.
+
+    Args:
+        filters (dict): The requested book fields and their values.
+
+    Returns:
+        bool: True if every field can be filtered on and has a valid value, False otherwise.
+    """
+    fields = list(filters.keys())
+    if [field for field in fields if field not in book_fields] != []:
+        return False
+    if "genre" in fields:
+        if filters["genre"] not in supported_genre_list:
+            return False
+    if "ISBN" in fields:
+        if not isValidISBN(filters["ISBN"]):
+            return False
+    return True
+
+def validateBookQueries(queries, max_queries):
+    """
+    Checks the body of a POST /books/query request.
+
+    Args:
+        queries (list): The filter objects, each validated like the filters of GET /books.
+        max_queries (int): The maximum number of filter objects.
+
+    Returns:
+        bool: True if every filter object is valid, False otherwise.
+    """
+    if len(queries) > max_queries:
+        return False
+    for filters in queries:
+        if not isinstance(filters, dict):
+            return False
+        if [value for value in filters.values() if not isinstance(value, str)] != []:
+            return False
+        if not validateBookFilters(filters):
+            return False
+    return True
+
+def parseSearch(args, max_limit):
+    """
+    Parses the query parameters of a GET /books/search request.
+
+    Args:
+        args (dict): The query parameters. Expected keys: "q", and optionally "limit".
+        max_limit (int): The largest accepted limit.
+
+    Returns:
+        tuple: A tuple containing (bool, search).
+            - bool: True if the parameters are valid, False otherwise.
+            - search (dict): The "text" and "limit" of the search if valid, None otherwise.
+    """
+    if [key for key in args.keys() if key not in ["q", "limit"]] != []:
+        return False, None
+    text = args.get("q", "")
+    if not any(character.isalnum() for character in text):
+        return False, None
+    limit = args.get("limit", "20")
+    if not limit.isdigit() or not 0 < int(limit) <= max_limit:
+        return False, None
+    return True, {"text": text, "limit": int(limit)}
+
+def parseBulkSelection(body, max_books):
+    """
+    Reads which books a DELETE or PATCH /books request applies to.
+
+    Args:
+        body (dict): The request body, with either "ids", a list of book IDs, or
+            "filter", book fields and values validated like the filters of GET /books.
+        max_books (int): The maximum number of IDs.
+
+    Returns:
+        tuple: A tuple containing (bool, selection).
+            - bool: True if the body selects books, False otherwise.
+            - selection (dict): The "ids" or the "filter" if valid, None otherwise.
+
+    Raises:
+        TypeError: If the body is not a JSON object.
+    """
+    if not isinstance(body, dict):
+        raise TypeError("Unsupported media type")
+    if ("ids" in body) == ("filter" in body):
+        return False, None
+    if "ids" in body:
+        ids = body["ids"]
+        if not isinstance(ids, list) or not 0 < len(ids) <= max_books:
+            return False, None
+        if [id for id in ids if not isinstance(id, str)] != []:
+            return False, None
+        return True, {"ids": ids}
+    filters = body["filter"]
+    if not isinstance(filters, dict) or not filters or not validateBookQueries([filters], 1):
+        return False, None
+    return True, {"filter": filters}
+
+def validateBulkUpdate(fields):
+    """
+    Checks the "set" object of a PATCH /books request.
+
+    Args:
+        fields (dict): The book fields to set and their values. The ISBN and the ID cannot be set in bulk.
+
+    Returns:
+        bool: True if every field can be set to its value, False otherwise.
+    """
+    if not isinstance(fields, dict) or not fields:
+        return False
+    if [field for field in fields if field not in bulk_update_fields] != []:
+        return False
+    if [value for value in fields.values() if not isinstance(value, str)] != []:
+        return False
+    if "genre" in fields and fields["genre"] not in supported_genre_list:
+        return False
+    return True
+
+def validateBookUpdate(book):
+    """
+    Checks the body of a PUT /books/{id} request.
+
+    Args:
+        book (dict): The request body, it must contain every book field.
+
+    Returns:
+        bool: True if the body describes a valid book, False otherwise.
+
+    Raises:
+        AttributeError: If the body is not a JSON object.
+    """
+    keys = list(book.keys())
+    missing_fields = [field for field in book_fields if field not in keys]
+    if missing_fields != []:
+        return False
+    if book["genre"] not in supported_genre_list or not isValidISBN(book["ISBN"]):
+        return False
+    return True
+
+def parsePaging(args, fields):
+    """
+    Reads the pagination, projection and streaming parameters of a list request.
+
+    Args:
+        args (dict): The request query parameters.
+        fields (list): The fields that may be requested with the "fields" parameter.
+
+    Returns:
+        tuple: A tuple containing (bool, paging).
+            - bool: True if the parameters are valid, False otherwise.
+            - paging (dict): The "limit", "after", "fields" and "stream" values, None where not given.
+    """
+    paging = {param: None for param in paging_params}
+    if "limit" in args:
+        if not args["limit"].isdigit() or int(args["limit"]) == 0:
+            return False, None
+        paging["limit"] = int(args["limit"])
+    if "after" in args:
+        if not ObjectId.is_valid(args["after"]):
+            return False, None
+        paging["after"] = args["after"]
+    if "fields" in args:
+        paging["fields"] = args["fields"].split(",")
+        if [field for field in paging["fields"] if field not in fields] != []:
+            return False, None
+    if "stream" in args:
+        if args["stream"] not in stream_modes:
+            return False, None
+        paging["stream"] = args["stream"]
+    return True, paging
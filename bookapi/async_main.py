@@ -0,0 +1,624 @@
+import logging
+import os
+import asyncio
+import aiohttp
+from aiohttp import web
+import AsyncBooksCollection
+import AsyncRatingsCollection
+import AsyncCatalogStats
+import CatalogStats
+import CatalogDump
+import AsyncGoogleBooksClient
+import IsbnIndex
+import Database
+import Validation
+import JsonEncoder
+import Metrics
+import Admission
+import Profiling
+import Encoding
+import LogConfig
+import ResponseCache
+import time
+import zlib
+from Validation import book_fields, rating_fields, valid_ratings, paging_params
+from Helpers import apply_metadata, new_rating, next_page_headers, bulk_outcomes
+from RatingsCollection import anyEligible
+from bson.objectid import ObjectId
+
+logger = logging.getLogger(__name__)
+
+batch_max_books = int(os.environ.get("BATCH_MAX_BOOKS", 10000))
+enrichment_workers = int(os.environ.get("ENRICHMENT_WORKERS", 16))
+query_max_filters = int(os.environ.get("QUERY_MAX_FILTERS", 100))
+search_max_limit = int(os.environ.get("SEARCH_MAX_LIMIT", 100))
+search_candidates = int(os.environ.get("SEARCH_CANDIDATES", 1000))
+import_batch_size = int(os.environ.get("IMPORT_BATCH_SIZE", 1000))
+
+bookCol = AsyncBooksCollection.AsyncBooksCollection()
+ratingsCol = AsyncRatingsCollection.AsyncRatingsCollection()
+catalogStats = AsyncCatalogStats.AsyncCatalogStats()
+googleBooks = AsyncGoogleBooksClient.AsyncGoogleBooksClient.fromEnvironment()
+google_books_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+isbnIndex = IsbnIndex.IsbnIndex.fromEnvironment()
+admission = Admission.Admission.fromEnvironment({"POST /books", "POST /books/batch"})
+compression = Encoding.Compression.fromEnvironment()
+
+async def lookup_metadata(isbn):
+    """
+    Retrieves the volume information of a book from the offline ISBN index,
+    falling back to Google Books, see main.lookup_metadata.
+    """
+    if isbnIndex.path is not None:
+        # Mapping the index file and reading its pages can block on disk, so it runs in the executor.
+        found, volume = await asyncio.get_running_loop().run_in_executor(None, isbnIndex.lookup, isbn)
+        if found:
+            return volume
+    return await googleBooks.lookup(isbn)
+
+def reply(body, status, headers=None):
+    """
+    Builds a JSON response the same way flask_restful does for the threaded service.
+    """
+    return web.Response(body=JsonEncoder.dumps(body), status=status, headers=headers, content_type="application/json")
+
+def conditional_reply(request, body, headers=None):
+    """
+    Answers a read with a strong ETag, and a client whose If-None-Match holds it
+    with a 304 and no body, see main.cached_read. There is no response cache in
+    the asyncio service, so the body is still read from the database.
+    """
+    etag = ResponseCache.ResponseCache.etag(body)
+    # Compressed bodies carry the ETag as a weak one, which still matches.
+    if any(tag.value in (etag, "*") for tag in request.if_none_match or ()):
+        return web.Response(status=304, headers={"ETag": f'"{etag}"'})
+    return reply(body, 200, {**(headers or {}), "ETag": f'"{etag}"'})
+
+async def read_json(request):
+    """
+    Reads a JSON request body.
+
+    Raises:
+        ValueError: If the body is not JSON.
+    """
+    if request.content_type != "application/json":
+        raise ValueError("Unsupported media type")
+    return await request.json()
+
+async def select_books(selection):
+    """
+    Resolves the books a DELETE or PATCH /books request applies to, see main.select_books.
+    """
+    if "filter" in selection:
+        ids = await bookCol.findIds(selection["filter"], batch_max_books + 1)
+        if len(ids) > batch_max_books:
+            return None
+        return ids, set()
+    ids = list(dict.fromkeys(id for id in selection["ids"] if ObjectId.is_valid(id)))
+    return ids, {id for id in selection["ids"] if not ObjectId.is_valid(id)}
+
+async def import_batch(batch):
+    """
+    Writes a batch of imported books and their ratings, see main.import_batch.
+    """
+    ids = await bookCol.insertBooks([book for book, rating in batch])
+    ratings = [rating for (book, rating), id in zip(batch, ids) if id is not None]
+    inserted = await ratingsCol.insertRatings(ratings)
+    if anyEligible(rating for rating, id in zip(ratings, inserted) if id is not None):
+        await ratingsCol.refreshTop()
+    return len([id for id in ids if id is not None])
+
+async def stream(request, documents, mode, batch_size=500):
+    """
+    Streams documents from an async database cursor as a JSON array or as newline
+    delimited JSON, see Streaming.streamResponse.
+    """
+    response = web.StreamResponse(status=200)
+    response.content_type = "application/x-ndjson" if mode == "ndjson" else "application/json"
+    if compression.enabled:
+        response.headers.add("Vary", "Accept-Encoding")
+        response.enable_compression()
+    await response.prepare(request)
+    separator = b"\n" if mode == "ndjson" else b","
+    batch = []
+    first = True
+    if mode == "json":
+        await response.write(b"[")
+    async for document in documents:
+        batch.append(JsonEncoder.dumps(document))
+        if len(batch) == batch_size:
+            await response.write((separator if not first else b"") + separator.join(batch))
+            first = False
+            batch = []
+    if batch:
+        await response.write((separator if not first else b"") + separator.join(batch))
+        first = False
+    await response.write(b"]" if mode == "json" else (b"" if first else b"\n"))
+    await response.write_eof()
+    return response
+
+class Books(web.View):
+    """
+    Books class that handles /books
+    """
+    async def post(self):
+        try:
+            args = await read_json(self.request)
+            valid, book = Validation.parseNewBook(args)
+            if not valid:
+                return reply({"error" : "Unprocessable Content"}, 422)
+        except:
+            return reply({"error" : "Unsupported media type"}, 415)
+
+        if await bookCol.isbnExists(book["ISBN"]):
+            return reply({"error" : "Unprocessable Content"}, 422)
+
+        try:
+            google_books_data = await lookup_metadata(book["ISBN"])
+        except google_books_errors:
+            return reply({"error": "Internal Server Error: Unable to connect to Google Books"}, 500)
+        if google_books_data is None:
+            return reply({"error": "Internal Server Error: Book not found in Google Books"}, 500)
+
+        apply_metadata(book, google_books_data)
+
+        id = await bookCol.insertBook(book)
+        if id is None:
+            return reply({"error" : "Unprocessable Content"}, 422)
+
+        await ratingsCol.insertRating(new_rating(book, id))
+
+        return reply({"ID": id}, 201)
+
+    async def get(self):
+        args = self.request.query
+        valid, paging = Validation.parsePaging(args, book_fields)
+        if not valid:
+            return reply({"error" : "Unprocessable Content"}, 422)
+        filters = {key: value for key, value in args.items() if key not in paging_params}
+        if not Validation.validateBookFilters(filters):
+            return reply({"error" : "Unprocessable Content"}, 422)
+        books = bookCol.findBooks(filters, paging["limit"], paging["after"], paging["fields"])
+        if paging["stream"]:
+            return await stream(self.request, books, paging["stream"])
+        books = [book async for book in books]
+        return conditional_reply(self.request, books, next_page_headers(books, paging["limit"]))
+
+    async def delete(self):
+        try:
+            valid, selection = Validation.parseBulkSelection(await read_json(self.request), batch_max_books)
+        except:
+            return reply({"error" : "Unsupported media type"}, 415)
+        if not valid:
+            return reply({"error" : "Unprocessable Content"}, 422)
+        selected = await select_books(selection)
+        if selected is None:
+            return reply({"error" : f"Unprocessable Content: the filter matches more than {batch_max_books} books"}, 422)
+        ids, invalid = selected
+
+        async def delete_all(session):
+            deleted = await bookCol.deleteBooks(ids, session)
+            await ratingsCol.deleteRatings(deleted, session)
+            return deleted
+
+        deleted = await Database.database.asyncWithTransaction(delete_all) if ids else []
+        await ratingsCol.updateTopFor(deleted)
+        return reply(bulk_outcomes(selection, invalid, deleted), 200)
+
+    async def patch(self):
+        try:
+            body = await read_json(self.request)
+            valid, selection = Validation.parseBulkSelection(body, batch_max_books)
+            if not valid or not Validation.validateBulkUpdate(body.get("set")):
+                return reply({"error" : "Unprocessable Content"}, 422)
+        except:
+            return reply({"error" : "Unsupported media type"}, 415)
+        fields = body["set"]
+        selected = await select_books(selection)
+        if selected is None:
+            return reply({"error" : f"Unprocessable Content: the filter matches more than {batch_max_books} books"}, 422)
+        ids, invalid = selected
+
+        async def update_all(session):
+            updated = await bookCol.updateBooks(ids, fields, session)
+            if "title" in fields:
+                await ratingsCol.renameRatings(updated, fields["title"], session)
+            if "genre" in fields:
+                await ratingsCol.changeGenre(updated, fields["genre"], session)
+            return updated
+
+        updated = await Database.database.asyncWithTransaction(update_all) if ids else []
+        if "title" in fields:
+            await ratingsCol.updateTopFor(updated)
+        return reply(bulk_outcomes(selection, invalid, updated), 200)
+
+class BooksBatch(web.View):
+    """
+    BooksBatch class that handles /books/batch
+    """
+    async def post(self):
+        try:
+            items = await read_json(self.request)
+            if not isinstance(items, list):
+                raise TypeError
+        except:
+            return reply({"error" : "Unsupported media type"}, 415)
+        if len(items) > batch_max_books:
+            return reply({"error" : f"Unprocessable Content: at most {batch_max_books} books per batch"}, 422)
+
+        results = [None] * len(items)
+        books = {}
+        for index, item in enumerate(items):
+            valid, book = Validation.parseNewBook(item) if isinstance(item, dict) else (False, None)
+            if not valid:
+                results[index] = {"error" : "Unprocessable Content"}
+            elif book["ISBN"] in books:
+                results[index] = {"error" : "Duplicate ISBN in batch"}
+            else:
+                books[book["ISBN"]] = (index, book)
+
+        for isbn in await bookCol.findExistingISBNs(books.keys()):
+            index, book = books.pop(isbn)
+            results[index] = {"error" : "Unprocessable Content: book already exists"}
+
+        workers = asyncio.Semaphore(enrichment_workers)
+        async def lookup(isbn):
+            async with workers:
+                return await lookup_metadata(isbn)
+
+        pending = list(books.values())
+        lookups = await asyncio.gather(*[lookup(book["ISBN"]) for index, book in pending], return_exceptions=True)
+        enriched = []
+        for (index, book), google_books_data in zip(pending, lookups):
+            if isinstance(google_books_data, google_books_errors):
+                results[index] = {"error": "Internal Server Error: Unable to connect to Google Books"}
+                continue
+            if isinstance(google_books_data, BaseException):
+                raise google_books_data
+            if google_books_data is None:
+                results[index] = {"error": "Internal Server Error: Book not found in Google Books"}
+                continue
+            enriched.append((index, apply_metadata(book, google_books_data)))
+
+        ids = await bookCol.insertBooks([book for index, book in enriched])
+        ratings = []
+        for (index, book), id in zip(enriched, ids):
+            if id is None:
+                results[index] = {"error" : "Unprocessable Content: book already exists"}
+                continue
+            results[index] = {"ID": id}
+            ratings.append(new_rating(book, id))
+        await ratingsCol.insertRatings(ratings)
+
+        return reply(results, 200)
+
+class BooksQuery(web.View):
+    """
+    BooksQuery class that handles /books/query
+    """
+    async def post(self):
+        try:
+            queries = await read_json(self.request)
+            if not isinstance(queries, list):
+                raise TypeError
+        except:
+            return reply({"error" : "Unsupported media type"}, 415)
+        if not Validation.validateBookQueries(queries, query_max_filters):
+            return reply({"error" : "Unprocessable Content"}, 422)
+        return conditional_reply(self.request, await bookCol.findBooksByQueries(queries))
+
+class BooksSearch(web.View):
+    """
+    BooksSearch class that handles /books/search
+    """
+    async def get(self):
+        valid, search = Validation.parseSearch(self.request.query, search_max_limit)
+        if not valid:
+            return reply({"error" : "Unprocessable Content"}, 422)
+        return conditional_reply(self.request, await bookCol.searchBooks(search["text"], search["limit"], search_candidates))
+
+class BookId(web.View):
+    """
+    BookId class that handles /books/{id}
+    """
+    async def delete(self):
+        book_id = self.request.match_info["book_id"]
+        success = await bookCol.deleteBook(book_id)
+        if success:
+            if await ratingsCol.deleteRating(book_id):
+                return reply({"ID": book_id}, 200)
+            else:
+                return reply({"error": "Rating deletion failed"}, 500)
+        else:
+            return reply(0, 404)
+
+    async def get(self):
+        success, book = await bookCol.findBook(self.request.match_info["book_id"])
+        if success:
+            return conditional_reply(self.request, book)
+        else:
+            return reply(0, 404)
+
+    async def put(self):
+        book_id = self.request.match_info["book_id"]
+        try:
+            book = await read_json(self.request)
+            if not Validation.validateBookUpdate(book):
+                return reply({"error" : "Unprocessable Content"}, 422)
+        except KeyError:
+            return reply({"error" : "Unprocessable Content"}, 422)
+        except:
+            return reply({"error" : "Unsupported media type"}, 415)
+        success = await bookCol.updateBook(book_id, book)
+        if success is None:
+            return reply({"error" : "Unprocessable Content"}, 422)
+        if success:
+            if "genre" in book:
+                await ratingsCol.changeGenre([book_id], book["genre"])
+            return reply({"ID": book_id}, 200)
+        else:
+            return reply(0, 404)
+
+class Ratings(web.View):
+    """
+    Ratings class that handles /ratings
+    """
+    async def get(self):
+        args = self.request.query
+        if "id" in args.keys():
+            success, rating = await ratingsCol.findRating(args["id"])
+            if success:
+                return conditional_reply(self.request, rating)
+            return reply(0, 404)
+        if [field for field in args.keys() if field not in paging_params] != []:
+            return reply({"error" : "Unprocessable Content"}, 422)
+        valid, paging = Validation.parsePaging(args, rating_fields)
+        if not valid:
+            return reply({"error" : "Unprocessable Content"}, 422)
+        ratings = ratingsCol.findRatings(paging["limit"], paging["after"], paging["fields"])
+        if paging["stream"]:
+            return await stream(self.request, ratings, paging["stream"])
+        ratings = [rating async for rating in ratings]
+        return reply(ratings, 200, next_page_headers(ratings, paging["limit"]))
+
+class RatingId(web.View):
+    """
+    RatingsId class that handles /ratings/{id}
+    """
+    async def get(self):
+        success, rating = await ratingsCol.findRating(self.request.match_info["rating_id"])
+        if success:
+            return conditional_reply(self.request, rating)
+        else:
+            return reply(0, 404)
+
+class Value(web.View):
+    """
+    Value class that handles /ratings/{id}/value
+    """
+    async def post(self):
+        try:
+            args = await read_json(self.request)
+            if len(args.keys()) != 1:
+                return reply({"error" : "Unprocessable Content"}, 422)
+            if "value" not in args.keys():
+                return reply({"error" : "Unprocessable Content"}, 422)
+            if args["value"] not in valid_ratings:
+                return reply({"error" : "Unprocessable Content"}, 422)
+        except:
+            return reply({"error" : "Unsupported media type"}, 415)
+
+        success, average = await ratingsCol.updateRating(self.request.match_info["rating_id"], args["value"])
+
+        if success:
+            return reply(average, 200)
+        else:
+            return reply(0, 404)
+
+class Top(web.View):
+    """
+    Top class that handles /top
+    """
+    async def get(self):
+        return reply(await ratingsCol.retrieveTop(), 200)
+
+class CacheStats(web.View):
+    """
+    CacheStats class that handles /cache
+    """
+    async def get(self):
+        return reply({
+            "enrichment": googleBooks.cacheInfo(),
+            "isbnIndex": await asyncio.get_running_loop().run_in_executor(None, isbnIndex.info),
+            "admission": admission.info() if admission.enabled() else None
+        }, 200)
+
+class MetricsExposition(web.View):
+    """
+    MetricsExposition class that handles /metrics
+    """
+    async def get(self):
+        return web.Response(text=Metrics.registry.render(), headers={"Content-Type": "text/plain; version=0.0.4"})
+
+class Stats(web.View):
+    """
+    Stats class that handles /stats and /stats/{genres|years|publishers}
+    """
+    async def get(self):
+        kind = self.request.match_info.get("kind")
+        if kind is not None and kind not in CatalogStats.STAT_KINDS:
+            return reply(0, 404)
+        stats = await catalogStats.retrieve([kind] if kind else None)
+        return reply(stats[kind] if kind else stats, 200)
+
+class Export(web.View):
+    """
+    Export class that handles /export
+    """
+    async def get(self):
+        response = web.StreamResponse(status=200, headers={"Content-Disposition": 'attachment; filename="catalog.ndjson.gz"'})
+        response.content_type = "application/gzip"
+        await response.prepare(self.request)
+        encoder = CatalogDump.GzipEncoder()
+        batch = []
+        async for record in CatalogDump.exportRecordsAsync(bookCol.exportBooks(), ratingsCol.exportRatings()):
+            batch.append(JsonEncoder.dumps(record) + b"\n")
+            if len(batch) == 1000:
+                await response.write(encoder.feed(b"".join(batch)))
+                batch = []
+        await response.write(encoder.feed(b"".join(batch)) + encoder.finish())
+        await response.write_eof()
+        return response
+
+class Import(web.View):
+    """
+    Import class that handles /import
+    """
+    async def post(self):
+        importer = CatalogDump.Importer(import_batch_size)
+        decoder = CatalogDump.LineDecoder()
+        try:
+            while True:
+                chunk = await self.request.content.read(65536)
+                lines = decoder.feed(chunk) if chunk else decoder.finish()
+                for line in lines:
+                    batch = importer.add(line)
+                    if batch:
+                        importer.count(batch, await import_batch(batch))
+                if not chunk:
+                    break
+        except zlib.error:
+            return reply({"error" : "Unsupported media type", **importer.report()}, 415)
+        batch = importer.finish()
+        if batch:
+            importer.count(batch, await import_batch(batch))
+        return reply(importer.report(), 200)
+
+class Health(web.View):
+    """
+    Health class that handles /healthz
+    """
+    async def get(self):
+        return reply({"status": "ok"}, 200)
+
+class Ready(web.View):
+    """
+    Ready class that handles /readyz
+    """
+    async def get(self):
+        if self.request.app["ready"]:
+            try:
+                await Database.database.asyncClient.admin.command("ping")
+                return reply({"status": "ready"}, 200)
+            except Exception:
+                pass
+        return reply({"status": "not ready"}, 503)
+
+@web.middleware
+async def internal_errors(request, handler):
+    """
+    Answers unexpected errors, such as malformed IDs, with the JSON body flask_restful uses.
+    """
+    try:
+        return await handler(request)
+    except web.HTTPException:
+        raise
+    except Exception as error:
+        logger.warning('%s %s failed: %r', request.method, request.path, error)
+        return reply({"message": "Internal Server Error"}, 500)
+
+@web.middleware
+async def record_metrics(request, handler):
+    """
+    Records the latency and status of every request by route, see Metrics.instrumentApp.
+    """
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as error:
+        status = error.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else "unmatched"
+        Metrics.http_request_duration.observe(time.perf_counter() - started, method=request.method, route=route)
+        Metrics.http_requests.inc(method=request.method, route=route, status=str(status))
+
+async def warmup(app):
+    """
+    Opens the database connections and prepares the collections before serving traffic.
+    Retries in the background while the database is unreachable, but not when the
+    catalog prevents building the indexes, see BooksCollection.ensureIndexes.
+    """
+    connections = max(int(os.environ.get("MONGO_WARMUP_CONNECTIONS", 4)), 1)
+    while True:
+        try:
+            client = Database.database.asyncClient
+            await asyncio.gather(*[client.admin.command("ping") for _ in range(connections)])
+            await bookCol.ensureIndexes()
+            await bookCol.indexSearchTokens()
+            await ratingsCol.ensureIndexes()
+            await ratingsCol.migrateRatings()
+            await ratingsCol.refreshTop()
+            await catalogStats.buildIfMissing()
+            app["ready"] = True
+            logger.info('warmed up with %s connections', connections)
+            return
+        except ValueError as error:
+            logger.error('warmup failed, not retrying: %s', error)
+            return
+        except Exception as error:
+            logger.warning('warmup failed, retrying: %s', error)
+            await asyncio.sleep(2)
+
+async def start(app):
+    app["warmup"] = asyncio.create_task(warmup(app))
+
+async def stop(app):
+    app["warmup"].cancel()
+    await googleBooks.close()
+    await Database.database.asyncClient.close()
+
+def create_app():
+    """
+    Creates the asyncio application, serving the same routes as main.create_app.
+    """
+    LogConfig.configure()
+    Metrics.instrumentMongo()
+    Profiling.instrumentMongo()
+    # Outermost first: profiling, metrics, admission, errors, then compression next to the views.
+    middlewares = [
+        Profiling.middleware() if Profiling.slow_operations.enabled() else None,
+        record_metrics,
+        Admission.middleware(admission) if admission.enabled() else None,
+        internal_errors,
+        Encoding.middleware(compression) if compression.enabled else None,
+    ]
+    app = web.Application(middlewares=[middleware for middleware in middlewares if middleware is not None])
+    app["ready"] = False
+    app.router.add_view('/books', Books)
+    app.router.add_view('/books/batch', BooksBatch)
+    app.router.add_view('/books/query', BooksQuery)
+    app.router.add_view('/books/search', BooksSearch)
+    app.router.add_view('/books/{book_id}', BookId)
+    app.router.add_view('/ratings', Ratings)
+    app.router.add_view('/ratings/{rating_id}', RatingId)
+    app.router.add_view('/ratings/{rating_id}/values', Value)
+    app.router.add_view('/top', Top)
+    app.router.add_view('/cache', CacheStats)
+    app.router.add_view('/stats', Stats)
+    app.router.add_view('/stats/{kind}', Stats)
+    app.router.add_view('/export', Export)
+    app.router.add_view('/import', Import)
+    app.router.add_view('/healthz', Health)
+    app.router.add_view('/readyz', Ready)
+    app.router.add_view('/metrics', MetricsExposition)
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    return app
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host='0.0.0.0', port=int(os.environ.get("PORT", 5001)))
@@ -0,0 +1,44 @@
+# Production serving configuration, see "Running the service" in the README.
+# Every setting can be overridden from the environment.
+import os
+import multiprocessing
+
+bind = f'0.0.0.0:{os.environ.get("PORT", 5001)}'
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+threads = int(os.environ.get("WEB_THREADS", 8))
+worker_class = "gthread"
+timeout = int(os.environ.get("WEB_TIMEOUT", 60))
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("WEB_KEEPALIVE", 5))
+max_requests = int(os.environ.get("WEB_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.environ.get("WEB_MAX_REQUESTS_JITTER", 0))
+# The application is imported once in the master and shared copy-on-write by the
+# workers. It opens no connections on import, so nothing leaks across the fork.
+preload_app = True
+accesslog = os.environ.get("WEB_ACCESS_LOG") or None
+errorlog = "-"
+
+def post_fork(server, worker):
+    # Drop anything the master may have opened so each worker builds its own pool.
+    import Database
+    import LogConfig
+    Database.database.reset()
+    # The log listener thread does not survive the fork, start one per worker.
+    LogConfig.configure()
+
+def post_worker_init(worker):
+    import main
+    main.warmup_until_ready()
+
+def worker_exit(server, worker):
+    import Database
+    import LogConfig
+    import main
+    # Stores the change stream resume token before the connections close.
+    main.changeWatcher.stop()
+    # Writes the buffered rating values, see RATING_WRITE_BEHIND.
+    main.ratingBuffer.stop()
+    # Books still queued stay pending and are picked up by another worker's sweep.
+    main.enricher.stop()
+    Database.database.reset()
+    LogConfig.shutdown()
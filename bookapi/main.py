@@ -1,16 +1,238 @@
-from flask import Flask, request
+import logging
+from flask import Flask, request, Response, make_response, stream_with_context, send_file
 from flask_restful import Resource, Api
 import BooksCollection
 import RatingsCollection
+import CatalogStats
+import CatalogDump
+import GoogleBooksClient
+import IsbnIndex
+import Database
+import Validation
+from Validation import book_fields, rating_fields, valid_ratings, paging_params
+from Helpers import apply_metadata, new_rating, next_page_headers, bulk_outcomes
+import Streaming
+import Records
+import JsonEncoder
+import ResponseCache
+import ChangeWatcher
+import RatingBuffer
+import Enricher
+import Admission
+import Profiling
+import Encoding
+import Metrics
+import LogConfig
+import os
+import json
+import time
+import zlib
+import contextvars
+import threading
 import requests
+from pymongo.errors import PyMongoError
+from concurrent.futures import ThreadPoolExecutor
 from bson.objectid import ObjectId
 
-supported_genre_list = ["Fiction", "Children", "Biography", "Science", "Science Fiction", "Fantasy", "Other"]
-book_fields = ["title", "ISBN", "genre", "authors", "publisher", "publishedDate", "id"]
-valid_ratings = [1,2,3,4,5]
+logger = logging.getLogger(__name__)
+
+batch_max_books = int(os.environ.get("BATCH_MAX_BOOKS", 10000))
+enrichment_workers = int(os.environ.get("ENRICHMENT_WORKERS", 16))
+query_max_filters = int(os.environ.get("QUERY_MAX_FILTERS", 100))
+search_max_limit = int(os.environ.get("SEARCH_MAX_LIMIT", 100))
+search_candidates = int(os.environ.get("SEARCH_CANDIDATES", 1000))
+import_batch_size = int(os.environ.get("IMPORT_BATCH_SIZE", 1000))
 
 bookCol = BooksCollection.BooksCollection()
 ratingsCol = RatingsCollection.RatingsCollection()
+catalogStats = CatalogStats.CatalogStats()
+googleBooks = GoogleBooksClient.GoogleBooksClient.fromEnvironment()
+isbnIndex = IsbnIndex.IsbnIndex.fromEnvironment()
+# With change streams, writes made by other replicas invalidate cached responses
+# within moments, so entries can live much longer.
+watch_changes = os.environ.get("CHANGE_STREAM") == "1"
+responseCache = ResponseCache.ResponseCache(
+    int(os.environ.get("RESPONSE_CACHE_SIZE", 10000)),
+    float(os.environ.get("RESPONSE_CACHE_TTL", 300 if watch_changes else 5))
+)
+bookCol.addListener(responseCache.onBookChange)
+ratingsCol.addListener(responseCache.onRatingChange)
+changeWatcher = ChangeWatcher.ChangeWatcher.fromEnvironment(
+    {"books": responseCache.onBookChange, "ratings": responseCache.onRatingChange},
+    responseCache.invalidateAll
+)
+# Write-behind rating values, see RatingBuffer for the durability trade-off.
+write_behind = os.environ.get("RATING_WRITE_BEHIND") == "1"
+ratingBuffer = RatingBuffer.RatingBuffer.fromEnvironment(ratingsCol)
+# Books Google Books has to describe are inserted as pending and enriched in the background, see Enricher.
+background_enrichment = os.environ.get("ENRICHMENT_BACKGROUND") == "1"
+enricher = Enricher.Enricher.fromEnvironment(
+    bookCol, lambda isbn: lookup_metadata(isbn), lambda book, volume: apply_metadata(book, volume)
+)
+# Rate limits and concurrency caps in front of the routes, see Admission.
+# POST /books only calls Google Books in the request when books are not enriched in the background.
+admission = Admission.Admission.fromEnvironment(
+    {"POST /books/batch"} if background_enrichment else {"POST /books", "POST /books/batch"}
+)
+# Per-request CPU profiles on X-Profile and the slow operation log, see Profiling.
+profiler = Profiling.RequestProfiler.fromEnvironment()
+# gzip or deflate bodies and MessagePack for the clients asking for them, see Encoding.
+compression = Encoding.Compression.fromEnvironment()
+Metrics.instrumentMongo()
+Profiling.instrumentMongo()
+
+def cache_metrics():
+    """
+    Exposes the enrichment and response cache counters on /metrics.
+    """
+    lines = []
+    caches = {"enrichment": googleBooks.cacheInfo()}
+    caches.update({f"responses_{namespace}": info for namespace, info in responseCache.info().items()
+                   if isinstance(info, dict)})
+    for counter in ["hits", "misses", "evictions"]:
+        lines.append(f"# TYPE cache_{counter}_total counter")
+        for cache, info in caches.items():
+            lines.append(f'cache_{counter}_total{{cache="{cache}"}} {info[counter]}')
+    lines.append("# TYPE cache_size gauge")
+    for cache, info in caches.items():
+        lines.append(f'cache_size{{cache="{cache}"}} {info["size"]}')
+    lines.append("# TYPE http_not_modified_total counter")
+    lines.append(f'http_not_modified_total {responseCache.info()["notModified"]}')
+    return lines
+
+Metrics.registry.addCollector(cache_metrics)
+if background_enrichment:
+    Metrics.registry.addCollector(enricher.metrics)
+
+def warmup():
+    """
+    Opens the database connections and prepares the collections before serving traffic.
+    """
+    Database.database.warmup(
+        int(os.environ.get("MONGO_WARMUP_CONNECTIONS", 4)),
+        [bookCol.ensureIndexes, bookCol.indexSearchTokens, ratingsCol.ensureIndexes, ratingsCol.migrateRatings,
+         ratingsCol.refreshTop, catalogStats.buildIfMissing]
+    )
+
+def warmup_until_ready(retry_interval=2):
+    """
+    Runs warmup, and keeps retrying it in a background thread while the database
+    is unreachable so the process can start and report itself as not ready.
+    Starts the change watcher of the process when CHANGE_STREAM=1, the rating
+    flush thread when RATING_WRITE_BEHIND=1 and the enrichment workers when
+    ENRICHMENT_BACKGROUND=1. A catalog the indexes cannot be built on, see
+    BooksCollection.ensureIndexes, is not retried: the process refuses to start,
+    or stays not ready when the database only became reachable later.
+    """
+    if watch_changes:
+        changeWatcher.start()
+    if write_behind:
+        ratingBuffer.start()
+    if background_enrichment:
+        enricher.start()
+    try:
+        warmup()
+        return
+    except PyMongoError as error:
+        logger.warning('warmup failed, retrying in the background: %s', error)
+
+    def retry():
+        while True:
+            time.sleep(retry_interval)
+            try:
+                warmup()
+                return
+            except PyMongoError as error:
+                logger.warning('warmup failed: %s', error)
+            except ValueError as error:
+                logger.error('warmup failed, not retrying: %s', error)
+                return
+
+    threading.Thread(target=retry, daemon=True).start()
+
+def lookup_metadata(isbn):
+    """
+    Retrieves the volume information of a book from the offline ISBN index,
+    falling back to Google Books for ISBNs the index does not hold.
+
+    Raises:
+        requests.exceptions.RequestException: If Google Books could not be reached.
+    """
+    found, volume = isbnIndex.lookup(isbn)
+    if found:
+        return volume
+    return googleBooks.lookup(isbn)
+
+def select_books(selection):
+    """
+    Resolves the books a DELETE or PATCH /books request applies to.
+
+    Args:
+        selection (dict): The "ids" or the "filter" read by Validation.parseBulkSelection.
+
+    Returns:
+        tuple: A tuple containing (ids, invalid).
+            - ids (list): The distinct valid IDs, or the IDs of the books matching the filter.
+            - invalid (set): The requested IDs which are not valid book IDs.
+        None is returned instead if the filter matches more than batch_max_books books.
+    """
+    if "filter" in selection:
+        ids = bookCol.findIds(selection["filter"], batch_max_books + 1)
+        if len(ids) > batch_max_books:
+            return None
+        return ids, set()
+    ids = list(dict.fromkeys(id for id in selection["ids"] if ObjectId.is_valid(id)))
+    return ids, {id for id in selection["ids"] if not ObjectId.is_valid(id)}
+
+def import_batch(batch):
+    """
+    Writes a batch of imported books and their ratings with unordered bulk inserts.
+    A book whose ID or ISBN is already in the catalog is skipped along with its rating.
+
+    Args:
+        batch (list): The (book, rating) tuples read by CatalogDump.Importer.
+
+    Returns:
+        int: The number of books imported.
+    """
+    ids = bookCol.insertBooks([book for book, rating in batch])
+    ratings = [rating for (book, rating), id in zip(batch, ids) if id is not None]
+    inserted = ratingsCol.insertRatings(ratings)
+    # Inserted ratings skip the leaderboard check of rating writes, the leaderboard is refreshed once per batch.
+    if RatingsCollection.anyEligible(rating for rating, id in zip(ratings, inserted) if id is not None):
+        ratingsCol.refreshTop()
+    return len([id for id in ids if id is not None])
+
+def cached_read(namespace, key, load):
+    """
+    Serves a read through the response cache. A client whose If-None-Match holds
+    the current ETag gets a 304 with no body, without a database hit when the
+    response is cached.
+
+    Args:
+        namespace (str): The response cache namespace.
+        key (str): The ID or normalized query of the response.
+        load (callable): Reads the response from the database, returning a tuple
+            (bool, body, headers) where the bool is False if nothing was found.
+
+    Returns:
+        The flask_restful response, or None if nothing was found.
+    """
+    found, entry = responseCache.get(namespace, key)
+    if found:
+        etag, body, headers = entry
+    else:
+        generation = responseCache.generation(namespace)
+        found, body, headers = load()
+        if not found:
+            return None
+        body = Records.compact(body)
+        etag = responseCache.set(namespace, key, body, headers, generation)
+    # Compressed and MessagePack bodies carry the ETag as a weak one, which still matches.
+    if request.if_none_match.contains_weak(etag):
+        responseCache.countNotModified()
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    return body, 200, {**headers, "ETag": f'"{etag}"'}
 
 class Books(Resource):
     """
@@ -19,60 +241,210 @@ class Books(Resource):
     def post(self):
         try:
             args = request.get_json()
-            book = {"title" : args["title"], "ISBN" : args["ISBN"], "genre" : args["genre"]}
-            if book["genre"] not in supported_genre_list:
+            valid, book = Validation.parseNewBook(args)
+            if not valid:
                 return {"error" : "Unprocessable Content"}, 422
-            if book["ISBN"] in bookCol.retrieveISBNList() or len(book["ISBN"]) != 13 or not book["ISBN"].isdigit():
-                return {"error" : "Unprocessable Content"}, 422
-        except KeyError:
-            return {"error" : "Unprocessable Content"}, 422
         except:
             return {"error" : "Unsupported media type"}, 415
 
-        try:
-            google_books_url = f'https://www.googleapis.com/books/v1/volumes?q=isbn:{book["ISBN"]}' 
-            response = requests.get(google_books_url)
-        except requests.exceptions.RequestException:
-            return {"error": "Internal Server Error: Unable to connect to Google Books"}, 500
-
-        google_books_data = response.json()['items'][0]['volumeInfo']
+        # A duplicate is refused before Google Books is called; insertBook still catches racing inserts.
+        if bookCol.isbnExists(book["ISBN"]):
+            return {"error" : "Unprocessable Content"}, 422
 
-        book["authors"] = 'and '.join(google_books_data.get("authors"))
-        book["publisher"] = google_books_data.get("publisher")
-        book["publishedDate"] = google_books_data.get("publishedDate")
+        pending = False
+        if background_enrichment:
+            # Only the local index is consulted, Google Books is left to the enrichment workers.
+            found, google_books_data = isbnIndex.lookup(book["ISBN"])
+            pending = not found
+        else:
+            try:
+                google_books_data = lookup_metadata(book["ISBN"])
+            except requests.exceptions.RequestException:
+                return {"error": "Internal Server Error: Unable to connect to Google Books"}, 500
+            if google_books_data is None:
+                return {"error": "Internal Server Error: Book not found in Google Books"}, 500
 
-        if book["authors"] == "": book["authors"] = "missing"
-        if book["publisher"] == "": book["publisher"] = "missing"
-        if book["publishedDate"] == "": book["publishedDate"] = "missing"
+        apply_metadata(book, {} if pending else google_books_data)
+        if pending:
+            book["enrichment"] = "pending"
 
         id = bookCol.insertBook(book)
+        if id is None:
+            return {"error" : "Unprocessable Content"}, 422
 
-        rating = {
-            "values": [],
-            "average": 0,
-            "title": book["title"],
-            "_id": ObjectId(id)
-        }
-
-        ratingsCol.insertRating(rating)
+        ratingsCol.insertRating(new_rating(book, id))
+        if pending:
+            enricher.enqueue(id, book["ISBN"])
 
         return {"ID": id}, 201
     
     def get(self):
         args = request.args
-        if args == {}:
-            return bookCol.retrieveAllBooks(), 200
-        else:
-            fields = list(args.keys())
-            if [field for field in fields if field not in book_fields] != []:
+        valid, paging = Validation.parsePaging(args, book_fields)
+        if not valid:
+            return {"error" : "Unprocessable Content"}, 422
+        filters = {key: value for key, value in args.items() if key not in paging_params}
+        if not Validation.validateBookFilters(filters):
+            return {"error" : "Unprocessable Content"}, 422
+        books = bookCol.findBooks(filters, paging["limit"], paging["after"], paging["fields"])
+        if paging["stream"]:
+            return Streaming.streamResponse(books, paging["stream"])
+        if filters or paging["limit"] is not None:
+            def load():
+                page = list(books)
+                return True, page, next_page_headers(page, paging["limit"])
+            return cached_read("books", ResponseCache.ResponseCache.queryKey(args), load)
+        books = list(books)
+        return books, 200, next_page_headers(books, paging["limit"])
+
+    def delete(self):
+        try:
+            valid, selection = Validation.parseBulkSelection(request.get_json(), batch_max_books)
+        except:
+            return {"error" : "Unsupported media type"}, 415
+        if not valid:
+            return {"error" : "Unprocessable Content"}, 422
+        selected = select_books(selection)
+        if selected is None:
+            return {"error" : f"Unprocessable Content: the filter matches more than {batch_max_books} books"}, 422
+        ids, invalid = selected
+
+        def delete_all(session):
+            deleted = bookCol.deleteBooks(ids, session)
+            ratingsCol.deleteRatings(deleted, session)
+            return deleted
+
+        deleted = Database.database.withTransaction(delete_all) if ids else []
+        if deleted:
+            bookCol.notify("delete", deleted)
+            ratingsCol.notify("delete", deleted)
+            ratingsCol.updateTopFor(deleted)
+        return bulk_outcomes(selection, invalid, deleted), 200
+
+    def patch(self):
+        try:
+            body = request.get_json()
+            valid, selection = Validation.parseBulkSelection(body, batch_max_books)
+            if not valid or not Validation.validateBulkUpdate(body.get("set")):
                 return {"error" : "Unprocessable Content"}, 422
+        except:
+            return {"error" : "Unsupported media type"}, 415
+        fields = body["set"]
+        selected = select_books(selection)
+        if selected is None:
+            return {"error" : f"Unprocessable Content: the filter matches more than {batch_max_books} books"}, 422
+        ids, invalid = selected
+
+        def update_all(session):
+            updated = bookCol.updateBooks(ids, fields, session)
+            if "title" in fields:
+                ratingsCol.renameRatings(updated, fields["title"], session)
             if "genre" in fields:
-                if args["genre"] not in supported_genre_list:
-                    return {"error" : "Unprocessable Content"}, 422
-            if "ISBN" in fields:
-                if len(args["ISBN"]) != 13 or not args["ISBN"].isdigit():
-                    return {"error" : "Unprocessable Content"}, 422
-            return bookCol.retrieveBooksByParameter(args), 200
+                ratingsCol.changeGenre(updated, fields["genre"], session)
+            return updated
+
+        updated = Database.database.withTransaction(update_all) if ids else []
+        if updated:
+            bookCol.notify("update", updated)
+            if "title" in fields:
+                ratingsCol.notify("update", updated)
+                ratingsCol.updateTopFor(updated)
+        return bulk_outcomes(selection, invalid, updated), 200
+
+class BooksBatch(Resource):
+    """
+    BooksBatch class that handles /books/batch
+    """
+    def post(self):
+        try:
+            items = request.get_json()
+            if not isinstance(items, list):
+                raise TypeError
+        except:
+            return {"error" : "Unsupported media type"}, 415
+        if len(items) > batch_max_books:
+            return {"error" : f"Unprocessable Content: at most {batch_max_books} books per batch"}, 422
+
+        results = [None] * len(items)
+        books = {}
+        for index, item in enumerate(items):
+            valid, book = Validation.parseNewBook(item) if isinstance(item, dict) else (False, None)
+            if not valid:
+                results[index] = {"error" : "Unprocessable Content"}
+            elif book["ISBN"] in books:
+                results[index] = {"error" : "Duplicate ISBN in batch"}
+            else:
+                books[book["ISBN"]] = (index, book)
+
+        for isbn in bookCol.findExistingISBNs(books.keys()):
+            index, book = books.pop(isbn)
+            results[index] = {"error" : "Unprocessable Content: book already exists"}
+
+        pending = []
+        enriched = []
+        for index, book in books.values():
+            found, volume = isbnIndex.lookup(book["ISBN"])
+            if found:
+                enriched.append((index, apply_metadata(book, volume)))
+            else:
+                pending.append((index, book))
+        with ThreadPoolExecutor(max_workers=enrichment_workers) as executor:
+            # Lookups run in the context of the request so slow ones are logged with its route.
+            futures = [executor.submit(contextvars.copy_context().run, googleBooks.lookup, book["ISBN"])
+                       for index, book in pending]
+        for (index, book), future in zip(pending, futures):
+            try:
+                google_books_data = future.result()
+            except requests.exceptions.RequestException:
+                results[index] = {"error": "Internal Server Error: Unable to connect to Google Books"}
+                continue
+            if google_books_data is None:
+                results[index] = {"error": "Internal Server Error: Book not found in Google Books"}
+                continue
+            enriched.append((index, apply_metadata(book, google_books_data)))
+
+        ids = bookCol.insertBooks([book for index, book in enriched])
+        ratings = []
+        for (index, book), id in zip(enriched, ids):
+            if id is None:
+                results[index] = {"error" : "Unprocessable Content: book already exists"}
+                continue
+            results[index] = {"ID": id}
+            ratings.append(new_rating(book, id))
+        ratingsCol.insertRatings(ratings)
+
+        return results, 200
+
+class BooksQuery(Resource):
+    """
+    BooksQuery class that handles /books/query
+    """
+    def post(self):
+        try:
+            queries = request.get_json()
+            if not isinstance(queries, list):
+                raise TypeError
+        except:
+            return {"error" : "Unsupported media type"}, 415
+        if not Validation.validateBookQueries(queries, query_max_filters):
+            return {"error" : "Unprocessable Content"}, 422
+
+        def load():
+            return True, bookCol.findBooksByQueries(queries), {}
+        return cached_read("books", "query:" + json.dumps(queries, sort_keys=True), load)
+
+class BooksSearch(Resource):
+    """
+    BooksSearch class that handles /books/search
+    """
+    def get(self):
+        valid, search = Validation.parseSearch(request.args, search_max_limit)
+        if not valid:
+            return {"error" : "Unprocessable Content"}, 422
+
+        def load():
+            return True, bookCol.searchBooks(search["text"], search["limit"], search_candidates), {}
+        return cached_read("books", "search:" + ResponseCache.ResponseCache.queryKey(request.args), load)
 
 class BookId(Resource):
     """
@@ -90,54 +462,71 @@ class BookId(Resource):
             return 0, 404
     
     def get(self,book_id):
-        success, book = bookCol.findBook(book_id)
-        if success:
-            return book, 200
+        response = cached_read("book", book_id, lambda: (*bookCol.findBook(book_id), {}))
+        if response is not None:
+            return response
         else:
             return 0, 404
     
     def put(self, book_id):
         try:
             book = request.get_json()
-            keys = list(book.keys())
-            missing_fields = [field for field in book_fields if field not in keys]
-            if missing_fields != []:
-                return {"error" : "Unprocessable Content"}, 422
-            if book["genre"] not in supported_genre_list or len(book["ISBN"]) != 13 or not book["ISBN"].isdigit():
+            if not Validation.validateBookUpdate(book):
                 return {"error" : "Unprocessable Content"}, 422
         except KeyError:
             return {"error" : "Unprocessable Content"}, 422
         except:
             return {"error" : "Unsupported media type"}, 415
         success = bookCol.updateBook(book_id, book)
+        if success is None:
+            return {"error" : "Unprocessable Content"}, 422
         if success:
+            if "genre" in book:
+                ratingsCol.changeGenre([book_id], book["genre"])
             return {"ID": book_id}, 200
         else:
             return 0, 404
 
+def load_rating(rating_id):
+    """
+    Reads a rating for the "rating" namespace of the response cache, with the values
+    still in the write-behind buffer, so /ratings?id= and /ratings/{id} cache the same response.
+    """
+    found, rating = ratingsCol.findRating(rating_id)
+    if found and write_behind:
+        rating = ratingBuffer.overlay(rating_id, rating)
+    return found, rating, {}
+
 class Ratings(Resource):
     """
     Ratings class that handles /ratings
     """
     def get(self):
         args = request.args
-        if args == {}:
-            return ratingsCol.retrieveAllRatings(), 200
-        elif "id" in args.keys():
-            success, rating = ratingsCol.findRating(args["id"])
-            if success:
-                return rating, 200
-        else:
+        if "id" in args.keys():
+            response = cached_read("rating", args["id"], lambda: load_rating(args["id"]))
+            if response is not None:
+                return response
+            return 0, 404
+        if [field for field in args.keys() if field not in paging_params] != []:
             return {"error" : "Unprocessable Content"}, 422
+        valid, paging = Validation.parsePaging(args, rating_fields)
+        if not valid:
+            return {"error" : "Unprocessable Content"}, 422
+        ratings = ratingsCol.findRatings(paging["limit"], paging["after"], paging["fields"])
+        if paging["stream"]:
+            return Streaming.streamResponse(ratings, paging["stream"])
+        ratings = list(ratings)
+        return ratings, 200, next_page_headers(ratings, paging["limit"])
 
 class RatingId(Resource):
     """
     RatingsId class that handles /ratings/{id}
     """
     def get(self, rating_id):
-        success, rating = ratingsCol.findRating((rating_id))
-        if success:
-            return rating, 200
+        response = cached_read("rating", rating_id, lambda: load_rating(rating_id))
+        if response is not None:
+            return response
         else:
             return 0, 404
         
@@ -157,13 +546,108 @@ class Value(Resource):
         except:
             return {"error" : "Unsupported media type"}, 415
         
-        success, average = ratingsCol.updateRating(rating_id, args["value"])
+        if write_behind:
+            success, average = ratingBuffer.addValue(rating_id, args["value"])
+        else:
+            success, average = ratingsCol.updateRating(rating_id, args["value"])
         
         if success:
             return average, 200
         else:
             return 0, 404
 
+class CacheStats(Resource):
+    """
+    CacheStats class that handles /cache
+    """
+    def get(self):
+        return {
+            "enrichment": googleBooks.cacheInfo(),
+            "isbnIndex": isbnIndex.info(),
+            "responses": responseCache.info(),
+            "changeStream": changeWatcher.info() if watch_changes else None,
+            "ratingBuffer": ratingBuffer.info() if write_behind else None,
+            "backgroundEnrichment": enricher.info() if background_enrichment else None,
+            "admission": admission.info() if admission.enabled() else None
+        }, 200
+
+class Stats(Resource):
+    """
+    Stats class that handles /stats and /stats/{genres|years|publishers}
+    """
+    def get(self, kind=None):
+        if kind is not None and kind not in CatalogStats.STAT_KINDS:
+            return 0, 404
+        stats = catalogStats.retrieve([kind] if kind else None)
+        return stats[kind] if kind else stats, 200
+
+class Export(Resource):
+    """
+    Export class that handles /export
+    """
+    def get(self):
+        records = CatalogDump.exportRecords(bookCol.exportBooks(), ratingsCol.exportRatings())
+        chunks = CatalogDump.gzipChunks(Streaming.jsonLines(records, 1000))
+        return Response(stream_with_context(chunks), status=200, mimetype="application/gzip",
+                        headers={"Content-Disposition": 'attachment; filename="catalog.ndjson.gz"'})
+
+class Import(Resource):
+    """
+    Import class that handles /import
+    """
+    def post(self):
+        importer = CatalogDump.Importer(import_batch_size)
+        decoder = CatalogDump.LineDecoder()
+        try:
+            while True:
+                chunk = request.stream.read(65536)
+                lines = decoder.feed(chunk) if chunk else decoder.finish()
+                for line in lines:
+                    batch = importer.add(line)
+                    if batch:
+                        importer.count(batch, import_batch(batch))
+                if not chunk:
+                    break
+        except zlib.error:
+            return {"error" : "Unsupported media type", **importer.report()}, 415
+        batch = importer.finish()
+        if batch:
+            importer.count(batch, import_batch(batch))
+        return importer.report(), 200
+
+class Profiles(Resource):
+    """
+    Profiles class that handles /profiles/{name}, registered when PROFILING is 1
+    """
+    def get(self, name):
+        path = profiler.path(name)
+        if path is None:
+            return 0, 404
+        return send_file(path, mimetype="application/octet-stream", as_attachment=True)
+
+class Health(Resource):
+    """
+    Health class that handles /healthz
+    """
+    def get(self):
+        return {"status": "ok"}, 200
+
+class Ready(Resource):
+    """
+    Ready class that handles /readyz
+    """
+    def get(self):
+        if Database.database.isReady():
+            return {"status": "ready"}, 200
+        return {"status": "not ready"}, 503
+
+class MetricsExposition(Resource):
+    """
+    MetricsExposition class that handles /metrics
+    """
+    def get(self):
+        return Response(Metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
 class Top(Resource):
     """
     Top class that handles /top
@@ -172,14 +656,67 @@ class Top(Resource):
         return ratingsCol.retrieveTop(), 200
 
 
-app = Flask(__name__)
-api = Api(app)
+def output_json(data, code, headers=None):
+    """
+    Encodes flask_restful responses with the encoder selected in JsonEncoder.
+    """
+    response = make_response(JsonEncoder.dumps(data) + b"\n", code)
+    response.headers.extend(headers or {})
+    response.mimetype = "application/json"
+    return response
 
-if __name__ == "__main__":
+def output_msgpack(data, code, headers=None):
+    """
+    Encodes flask_restful responses as MessagePack for clients preferring it in Accept.
+    """
+    response = make_response(Encoding.packb(data), code)
+    response.headers.extend(headers or {})
+    response.mimetype = Encoding.MSGPACK_MIMETYPE
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def create_app():
+    """
+    Creates the Flask application with every resource registered.
+    Database connections are not opened here, see warmup.
+    """
+    LogConfig.configure()
+    app = Flask(__name__)
+    Metrics.instrumentApp(app)
+    if admission.enabled():
+        Admission.instrumentApp(app, admission)
+    if profiler is not None or Profiling.slow_operations.enabled():
+        Profiling.instrumentApp(app, profiler)
+    if compression.enabled:
+        Encoding.instrumentApp(app, compression)
+    api = Api(app)
+    api.representations["application/json"] = output_json
+    if Encoding.msgpack is not None:
+        api.representations[Encoding.MSGPACK_MIMETYPE] = output_msgpack
     api.add_resource(Books, '/books')
+    api.add_resource(BooksBatch, '/books/batch')
+    api.add_resource(BooksQuery, '/books/query')
+    api.add_resource(BooksSearch, '/books/search')
     api.add_resource(BookId, '/books/<string:book_id>')
     api.add_resource(Ratings, '/ratings')
     api.add_resource(RatingId, '/ratings/<string:rating_id>')
     api.add_resource(Value, '/ratings/<string:rating_id>/values')
     api.add_resource(Top, '/top')
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    api.add_resource(CacheStats, '/cache')
+    api.add_resource(Stats, '/stats', '/stats/<string:kind>')
+    api.add_resource(Export, '/export')
+    api.add_resource(Import, '/import')
+    if profiler is not None:
+        api.add_resource(Profiles, '/profiles/<string:name>')
+    api.add_resource(Health, '/healthz')
+    api.add_resource(Ready, '/readyz')
+    api.add_resource(MetricsExposition, '/metrics')
+    return app
+
+app = create_app()
+
+if __name__ == "__main__":
+    warmup_until_ready()
+    app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 5001)), debug=os.environ.get("FLASK_DEBUG") == "1")
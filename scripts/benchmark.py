@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# Replays a weighted mix of the service's routes and reports throughput and
+# latency percentiles per route as JSON. See "Benchmarking" in the README.
+
+DEFAULT_MIX = "books_query=40,book=25,rate=20,top=10,add_book=5"
+ROUTES = {
+    "books_query": "GET /books",
+    "book": "GET /books/{id}",
+    "rate": "POST /ratings/{id}/values",
+    "top": "GET /top",
+    "add_book": "POST /books",
+}
+GENRES = ["Fiction", "Children", "Biography", "Science", "Science Fiction", "Fantasy", "Other"]
+
+def parse_mix(mix):
+    """
+    Parses a route mix such as "book=3,top=1" into route names and weights.
+    """
+    routes, weights = [], []
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in ROUTES:
+            raise ValueError(f"unknown route {name!r}, expected one of {', '.join(ROUTES)}")
+        routes.append(name)
+        weights.append(float(weight or 1))
+    return routes, weights
+
+def load_queries(path):
+    """
+    Reads the GET /books query strings, one per line, such as "?genre=Fiction".
+    """
+    with open(path, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+class IsbnSequence:
+    """
+    Generates ISBNs no earlier run has used, so POST /books never hits a duplicate.
+    """
+    def __init__(self):
+        self.prefix = f"9{int(time.time()) % 100000:05d}"
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            self.next += 1
+            return f"{self.prefix}{self.next:07d}"
+
+def new_book(isbns, rng):
+    isbn = isbns.take()
+    return {"title": f"Benchmark {isbn}", "ISBN": isbn, "genre": rng.choice(GENRES)}
+
+def new_session():
+    """
+    Creates a session keeping one connection alive, one session per worker thread.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def seed(base_url, count, isbns, batch_size=500):
+    """
+    Inserts books through POST /books/batch so the ID routes have targets.
+
+    Returns:
+        list: The IDs of the inserted books.
+    """
+    rng = random.Random(0)
+    session = new_session()
+    ids = []
+    while len(ids) < count:
+        books = [new_book(isbns, rng) for _ in range(min(batch_size, count - len(ids)))]
+        response = session.post(f"{base_url}/books/batch", json=books, timeout=120)
+        response.raise_for_status()
+        inserted = [result["ID"] for result in response.json() if "ID" in result]
+        if not inserted:
+            raise RuntimeError(f"seeding inserted no books: {response.json()[:3]}")
+        ids.extend(inserted)
+    return ids
+
+def existing_ids(base_url, count):
+    """
+    Reads the IDs of up to count books already in the service.
+    """
+    response = requests.get(f"{base_url}/books", params={"limit": count, "fields": "id"}, timeout=60)
+    response.raise_for_status()
+    return [book["id"] for book in response.json()]
+
+def percentile(samples, fraction):
+    """
+    Computes a nearest-rank percentile of sorted samples.
+    """
+    if not samples:
+        return None
+    index = min(len(samples) - 1, max(0, int(round(fraction * len(samples) + 0.5)) - 1))
+    return samples[index]
+
+def summarize(latencies, statuses, errors, elapsed):
+    latencies = sorted(latencies)
+    milliseconds = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "statuses": dict(sorted(statuses.items())),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0,
+        "latencyMs": {
+            "mean": milliseconds(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": milliseconds(percentile(latencies, 0.50)),
+            "p95": milliseconds(percentile(latencies, 0.95)),
+            "p99": milliseconds(percentile(latencies, 0.99)),
+            "max": milliseconds(latencies[-1] if latencies else None),
+        }
+    }
+
+class Benchmark:
+    """
+    This class represents one benchmark run. Without a rate every worker sends its
+    next request as soon as the previous one is answered (closed loop). With a rate,
+    requests are scheduled at fixed intervals and latency is measured from the
+    scheduled time, so a slow server is not hidden by fewer requests being sent.
+    """
+    def __init__(self, base_url, routes, weights, queries, ids, isbns, concurrency, duration, rate=None, seed=1):
+        self.base_url = base_url
+        self.routes = routes
+        self.weights = weights
+        self.queries = queries
+        self.ids = ids
+        self.concurrency = concurrency
+        self.duration = duration
+        self.rate = rate
+        self.seed = seed
+        self.isbns = isbns
+        self.lock = threading.Lock()
+        self.latencies = {route: [] for route in routes}
+        self.statuses = {route: {} for route in routes}
+        self.errors = {route: 0 for route in routes}
+
+    def send(self, session, route, rng):
+        """
+        Sends one request of a route.
+
+        Returns:
+            int: The HTTP status of the response.
+        """
+        url = self.base_url
+        if route == "books_query":
+            response = session.get(f"{url}/books{rng.choice(self.queries)}", timeout=30)
+        elif route == "book":
+            response = session.get(f"{url}/books/{rng.choice(self.ids)}", timeout=30)
+        elif route == "rate":
+            response = session.post(f"{url}/ratings/{rng.choice(self.ids)}/values",
+                                    json={"value": rng.randint(1, 5)}, timeout=30)
+        elif route == "top":
+            response = session.get(f"{url}/top", timeout=30)
+        else:
+            response = session.post(f"{url}/books", json=new_book(self.isbns, rng), timeout=30)
+        response.content  # read the whole body, as a client would
+        return response.status_code
+
+    def record(self, route, started, status):
+        latency = time.perf_counter() - started
+        with self.lock:
+            self.latencies[route].append(latency)
+            key = str(status)
+            self.statuses[route][key] = self.statuses[route].get(key, 0) + 1
+            if status == "error" or status >= 400:
+                self.errors[route] += 1
+
+    def call(self, session, route, rng, started):
+        try:
+            status = self.send(session, route, rng)
+        except requests.exceptions.RequestException:
+            status = "error"
+        self.record(route, started, status)
+
+    def closedLoop(self, worker, deadline):
+        rng = random.Random(self.seed * 1000 + worker)
+        session = new_session()
+        while time.perf_counter() < deadline:
+            route = rng.choices(self.routes, self.weights)[0]
+            self.call(session, route, rng, time.perf_counter())
+
+    def openLoop(self, worker, schedule):
+        rng = random.Random(self.seed * 1000 + worker)
+        session = new_session()
+        while True:
+            scheduled = schedule.get()
+            if scheduled is None:
+                return
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            route = rng.choices(self.routes, self.weights)[0]
+            self.call(session, route, rng, scheduled)
+
+    def run(self):
+        """
+        Runs the benchmark for its duration.
+
+        Returns:
+            dict: The throughput and latency percentiles of every route and of the whole run.
+        """
+        started = time.perf_counter()
+        deadline = started + self.duration
+        if self.rate:
+            schedule = queue.Queue()
+            workers = [threading.Thread(target=self.openLoop, args=(index, schedule), daemon=True)
+                       for index in range(self.concurrency)]
+            for thread in workers:
+                thread.start()
+            interval = 1 / self.rate
+            scheduled = started
+            while scheduled < deadline:
+                schedule.put(scheduled)
+                scheduled += interval
+            for _ in workers:
+                schedule.put(None)
+        else:
+            workers = [threading.Thread(target=self.closedLoop, args=(index, deadline), daemon=True)
+                       for index in range(self.concurrency)]
+            for thread in workers:
+                thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        routes = {}
+        for route in self.routes:
+            routes[ROUTES[route]] = summarize(self.latencies[route], self.statuses[route], self.errors[route], elapsed)
+        total_statuses = {}
+        for route in self.routes:
+            for status, count in self.statuses[route].items():
+                total_statuses[status] = total_statuses.get(status, 0) + count
+        total = summarize(
+            [latency for route in self.routes for latency in self.latencies[route]],
+            total_statuses, sum(self.errors.values()), elapsed
+        )
+        return {"elapsed": round(elapsed, 3), "total": total, "routes": routes}
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Load benchmark for the books service.")
+    parser.add_argument("--url", default="http://localhost:5001", help="base URL of the service")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="weighted routes, e.g. book=3,top=1. "
+                        f"Routes: {', '.join(f'{name} ({path})' for name, path in ROUTES.items())}")
+    parser.add_argument("--concurrency", type=int, default=16, help="worker threads, one connection each")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--rate", type=float, default=None, help="target requests per second, "
+                        "default: as fast as the workers go")
+    parser.add_argument("--queries", default=os.path.join(here, "..", "query.txt"),
+                        help="GET /books query strings, one per line")
+    parser.add_argument("--seed-books", type=int, default=1000,
+                        help="books inserted before the run, 0 to use the books already stored")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of unrecorded load before the run")
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the route mix")
+    parser.add_argument("--label", default=None, help="name of the run, e.g. a version, stored in the report")
+    parser.add_argument("--output", default=None, help="file to write the report to, default stdout")
+    args = parser.parse_args(argv)
+
+    base_url = args.url.rstrip("/")
+    routes, weights = parse_mix(args.mix)
+    queries = load_queries(args.queries)
+    isbns = IsbnSequence()
+    ids = seed(base_url, args.seed_books, isbns) if args.seed_books else existing_ids(base_url, 10000)
+    if not ids and ({"book", "rate"} & set(routes)):
+        parser.error("the service has no books, use --seed-books")
+
+    if args.warmup:
+        Benchmark(base_url, routes, weights, queries, ids, isbns, args.concurrency, args.warmup, None, args.seed + 1).run()
+    benchmark = Benchmark(base_url, routes, weights, queries, ids, isbns, args.concurrency, args.duration,
+                          args.rate, args.seed)
+    report = {
+        "label": args.label,
+        "config": {
+            "url": base_url, "mix": dict(zip(routes, weights)), "concurrency": args.concurrency,
+            "duration": args.duration, "rate": args.rate, "books": len(ids), "seed": args.seed
+        },
+    }
+    report.update(benchmark.run())
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+import sys
+import json
+import time
+import argparse
+import requests
+
+# Exports the catalog of a running Books Service to a gzip compressed NDJSON dump,
+# or imports a dump into it, through GET /export and POST /import. Both directions
+# stream, so dumps of any size are copied with constant memory.
+
+CHUNK_SIZE = 1 << 20
+
+def export_catalog(base_url, output):
+    """
+    Downloads the catalog dump to a file, "-" for stdout.
+
+    Returns:
+        int: The number of bytes written.
+    """
+    written = 0
+    with requests.get(f"{base_url}/export", stream=True, timeout=(10, None)) as response:
+        response.raise_for_status()
+        file = sys.stdout.buffer if output == "-" else open(output, "wb")
+        try:
+            # The dump is kept compressed: raw reads skip the transfer decoding of requests.
+            for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+                file.write(chunk)
+                written += len(chunk)
+        finally:
+            if file is not sys.stdout.buffer:
+                file.close()
+    return written
+
+def read_chunks(file):
+    while True:
+        chunk = file.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+def import_catalog(base_url, input):
+    """
+    Uploads a dump, gzip compressed or plain NDJSON, from a file, "-" for stdin.
+
+    Returns:
+        dict: The import report of the service.
+    """
+    file = sys.stdin.buffer if input == "-" else open(input, "rb")
+    try:
+        response = requests.post(f"{base_url}/import", data=read_chunks(file), timeout=(10, None),
+                                 headers={"Content-Type": "application/x-ndjson"})
+    finally:
+        if file is not sys.stdin.buffer:
+            file.close()
+    if response.status_code != 200:
+        raise SystemExit(f"import failed with {response.status_code}: {response.text}")
+    return response.json()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exports or imports the catalog of the books service.")
+    parser.add_argument("--url", default="http://localhost:5001", help="base URL of the service")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write the catalog to a gzip compressed NDJSON dump")
+    export_parser.add_argument("--output", default="catalog.ndjson.gz", help="dump file, - for stdout")
+    import_parser = commands.add_parser("import", help="load a dump, books already in the catalog are skipped")
+    import_parser.add_argument("--input", default="catalog.ndjson.gz", help="dump file, - for stdin")
+    args = parser.parse_args(argv)
+
+    base_url = args.url.rstrip("/")
+    started = time.perf_counter()
+    if args.command == "export":
+        written = export_catalog(base_url, args.output)
+        report = {"bytes": written}
+    else:
+        report = import_catalog(base_url, args.input)
+    report["seconds"] = round(time.perf_counter() - started, 2)
+    # A dump written to stdout must not be mixed with the report.
+    to_stdout = args.command == "export" and args.output == "-"
+    print(json.dumps(report, indent=2), file=sys.stderr if to_stdout else sys.stdout)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+import json
+import time
+import argparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# A local stand-in for the Google Books volumes API, for benchmarks and offline runs.
+# Point the service at it with GOOGLE_BOOKS_URL=http://localhost:8081/books/v1/volumes
+
+def volume_for(isbn):
+    """
+    Builds a deterministic volumes API response for an ISBN. ISBNs starting
+    with 0 have no volume, like ISBNs unknown to Google Books.
+    """
+    if not isbn or isbn.startswith("0"):
+        return {"kind": "books#volumes", "totalItems": 0}
+    return {
+        "kind": "books#volumes",
+        "totalItems": 1,
+        "items": [{"volumeInfo": {
+            "authors": [f"Author {isbn[-3:]}"],
+            "publisher": f"Publisher {isbn[-2:]}",
+            "publishedDate": f"19{isbn[-2:]}"
+        }}]
+    }
+
+def make_handler(latency):
+    class VolumesHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+            isbn = query[len("isbn:"):] if query.startswith("isbn:") else ""
+            if latency:
+                time.sleep(latency)
+            body = json.dumps(volume_for(isbn)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return VolumesHandler
+
+def serve(host="127.0.0.1", port=8081, latency=0.0):
+    """
+    Serves the stub until interrupted.
+
+    Args:
+        host (str): The interface to listen on.
+        port (int): The port to listen on.
+        latency (float): Seconds added to every response, to mimic the real API.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(latency))
+    server.daemon_threads = True
+    print(f"Google Books stub listening on http://{host}:{server.server_port}/books/v1/volumes")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stub of the Google Books volumes API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.latency)
@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bookapi"))
+import Records
+import JsonEncoder
+import Encoding
+
+# Measures the cost of turning a page of books into a response body, per 10k documents.
+# "before" is the original path: rename _id to id in Python, then the standard json module.
+# "after" is the current path: id computed by the database projection, then JsonEncoder.
+# "encodings" compares the body size and encode time of each representation a
+# client can negotiate, JSON or MessagePack, compressed or not, for books and ratings.
+
+def raw_books(count):
+    """
+    Builds books as the database returns them to a plain find.
+    """
+    return [{
+        "_id": ObjectId(),
+        "title": f"Book number {index}",
+        "ISBN": f"978{index:010d}",
+        "genre": "Science Fiction",
+        "authors": f"Author {index % 500}",
+        "publisher": f"Publisher {index % 50}",
+        "publishedDate": f"{1900 + index % 120}"
+    } for index in range(count)]
+
+def projected_books(count):
+    """
+    Builds books as the database returns them to Database.listPipeline.
+    """
+    books = raw_books(count)
+    for book in books:
+        book["id"] = str(book.pop("_id"))
+    return books
+
+def projected_ratings(count):
+    """
+    Builds ratings as the database returns them to Database.listPipeline.
+    """
+    return [{
+        "id": str(ObjectId()),
+        "title": f"Book number {index}",
+        "counts": {str(star): (index * star) % 40 for star in range(1, 6)},
+        "count": sum((index * star) % 40 for star in range(1, 6)),
+        "sum": sum(star * ((index * star) % 40) for star in range(1, 6)),
+        "average": 3.67
+    } for index in range(count)]
+
+def representations():
+    """
+    Lists the representations to compare, as encode functions of a response body.
+    """
+    encodings = {"json": JsonEncoder.dumps}
+    for level in (1, 6, 9):
+        encodings[f"json+gzip-{level}"] = lambda body, level=level: Encoding.compress(JsonEncoder.dumps(body), "gzip", level)
+    encodings["json+deflate-6"] = lambda body: Encoding.compress(JsonEncoder.dumps(body), "deflate", 6)
+    if Encoding.msgpack is not None:
+        encodings["msgpack"] = Encoding.packb
+        encodings["msgpack+gzip-6"] = lambda body: Encoding.compress(Encoding.packb(body), "gzip", 6)
+    return encodings
+
+def compare_encodings(documents, repeat, scale):
+    """
+    Measures the size and encode time of every representation of a response body,
+    per 10k documents, for a page read straight from the database as dicts.
+    """
+    results = {}
+    for name, encode in representations().items():
+        body = documents
+        results[name] = {
+            "bytesPer10k": round(len(encode(body)) * scale / 1000),
+            "millisecondsPer10k": round(timed(lambda: body, encode, repeat) * scale, 3)
+        }
+    return results
+
+def before(books):
+    for book in books:
+        book["id"] = str(book.pop("_id"))
+    return json.dumps(books).encode()
+
+def after(books):
+    return JsonEncoder.dumps(books)
+
+def timed(prepare, run, repeat):
+    """
+    Runs a step on freshly prepared input, returning the best time of several runs.
+    """
+    best = None
+    for _ in range(repeat):
+        data = prepare()
+        started = time.perf_counter()
+        run(data)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def allocated(build):
+    tracemalloc.start()
+    value = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del value
+    return size
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serialization microbenchmark for list responses.")
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+    count = args.documents
+    scale = 10000 / count * 1000
+
+    results = {"documents": count, "encoder": JsonEncoder.encoder, "millisecondsPer10k": {}}
+    timings = results["millisecondsPer10k"]
+    timings["before"] = timed(lambda: raw_books(count), before, args.repeat) * scale
+    JsonEncoder.selectEncoder("json")
+    timings["after (json)"] = timed(lambda: projected_books(count), after, args.repeat) * scale
+    if JsonEncoder.orjson is not None:
+        JsonEncoder.selectEncoder("orjson")
+        timings["after (orjson)"] = timed(lambda: projected_books(count), after, args.repeat) * scale
+        timings["after (orjson, records)"] = timed(
+            lambda: Records.compact(projected_books(count)), after, args.repeat
+        ) * scale
+    JsonEncoder.selectEncoder()
+    results["millisecondsPer10k"] = {name: round(value, 3) for name, value in timings.items()}
+
+    dicts = projected_books(count)
+    results["bytesPer10k"] = {
+        "dicts": round(allocated(lambda: [dict(book) for book in dicts]) * 10000 / count),
+        "records": round(allocated(lambda: Records.compact(dicts)) * 10000 / count)
+    }
+    results["encodings"] = {
+        "books": compare_encodings(projected_books(count), args.repeat, scale),
+        "ratings": compare_encodings(projected_ratings(count), args.repeat, scale)
+    }
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
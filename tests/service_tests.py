@@ -0,0 +1,1364 @@
+import os
+import sys
+import gzip
+import json
+import zlib
+import asyncio
+import pstats
+import logging
+import threading
+import time
+import pytest
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from bson.objectid import ObjectId
+from pymongo.errors import PyMongoError, BulkWriteError
+import connectionController
+from assertions import assert_status_code
+
+# The unit tests below import the service modules and use the MongoDB instance exposed on localhost.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bookapi"))
+import Database
+import RatingsCollection
+import RatingBuffer
+import IsbnIndex
+import LRUCache
+import GoogleBooksClient
+import BooksCollection
+import Enricher
+import Admission
+import Metrics
+import Profiling
+import Encoding
+import Records
+import JsonEncoder
+import Validation
+from Helpers import apply_metadata
+from Helpers import new_rating
+
+batch = [
+    {"title": "Adventures of Huckleberry Finn", "ISBN": "9780520343641", "genre": "Fiction"},
+    {"title": "Fear No Evil", "ISBN": "9780394558783", "genre": "Biography"},
+    {"title": "Fear No Evil", "ISBN": "9780394558783", "genre": "Biography"},
+    {"title": "The Greatest Joke Book Ever", "ISBN": "9780380798490", "genre": "Jokes"}
+]
+
+batch_ids = []
+
+# A book no other test reads before its ratings change, so no worker holds a cached copy of its rating.
+rated_book = {"title": "Foundation", "ISBN": "9780553293357", "genre": "Science Fiction"}
+rated_ids = []
+
+
+def test_post_books_batch():
+    response = connectionController.http_post("books/batch", batch)
+    assert_status_code(response, 200)
+    results = response.json()
+    assert len(results) == 4
+    assert "ID" in results[0] and "ID" in results[1]
+    assert "error" in results[2], "Duplicate ISBN in batch was inserted"
+    assert "error" in results[3], "Unsupported genre was inserted"
+    batch_ids.extend([results[0]["ID"], results[1]["ID"]])
+
+
+def test_post_books_batch_creates_ratings():
+    for book_id in batch_ids:
+        response = connectionController.http_get(f"ratings/{book_id}")
+        assert_status_code(response, 200)
+
+
+def test_post_books_batch_not_a_list():
+    response = connectionController.http_post("books/batch", batch[0])
+    assert_status_code(response, 415)
+
+
+def test_post_rating_values_histogram():
+    response = connectionController.http_post("books", rated_book)
+    assert_status_code(response, 201)
+    rated_ids.append(response.json()["ID"])
+    for value, average in ((5, 5.0), (4, 4.5), (4, 4.33)):
+        response = connectionController.http_post(f"ratings/{rated_ids[0]}/values", {"value": value})
+        assert_status_code(response, 200)
+        assert response.json() == average
+
+
+def test_post_rating_values_concurrently():
+    def post_value(value):
+        return connectionController.http_post(f"ratings/{rated_ids[0]}/values", {"value": value}).status_code
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        statuses = list(executor.map(post_value, [5] * 20))
+    assert statuses == [200] * 20
+    response = connectionController.http_get(f"ratings/{rated_ids[0]}")
+    assert_status_code(response, 200)
+    rating = response.json()
+    assert rating["counts"] == {"1": 0, "2": 0, "3": 0, "4": 2, "5": 21}
+    assert rating["count"] == 23
+    assert rating["sum"] == 113
+    assert rating["average"] == 4.91
+
+
+def test_post_rating_value_invalid():
+    response = connectionController.http_post(f"ratings/{rated_ids[0]}/values", {"value": 6})
+    assert_status_code(response, 422)
+    response = connectionController.http_post("ratings/000000000000000000000000/values", {"value": 3})
+    assert_status_code(response, 404)
+
+
+def test_get_top():
+    response = connectionController.http_get("top")
+    assert_status_code(response, 200)
+    top = response.json()
+    # Ratings tied with the third highest average are all listed.
+    assert len(top) >= 1
+    averages = [rating["average"] for rating in top]
+    assert averages == sorted(averages, reverse=True)
+    assert all(rating["count"] >= 3 for rating in top)
+    assert len([average for average in averages if average > averages[-1]]) < 3
+    # The rated book averages 4.91, so it is on the leaderboard unless three books rate higher.
+    assert rated_ids[0] in [rating["id"] for rating in top] or averages[-1] >= 4.91
+
+
+def test_get_top_after_new_value():
+    before = connectionController.http_get("top").json()
+    if rated_ids[0] not in [rating["id"] for rating in before]:
+        pytest.skip("the rated book is not on the leaderboard")
+    assert_status_code(connectionController.http_post(f"ratings/{rated_ids[0]}/values", {"value": 1}), 200)
+    top = connectionController.http_get("top").json()
+    entry = [rating for rating in top if rating["id"] == rated_ids[0]]
+    assert entry == [] or entry[0]["count"] == 24
+
+
+def test_get_rating_by_query_matches_rating_by_id():
+    by_query = connectionController.http_get(f"ratings?id={rated_ids[0]}")
+    by_id = connectionController.http_get(f"ratings/{rated_ids[0]}")
+    assert_status_code(by_query, 200)
+    assert_status_code(by_id, 200)
+    assert by_query.json() == by_id.json()
+
+
+def test_post_book_duplicate_isbn():
+    response = connectionController.http_post("books", batch[0])
+    assert_status_code(response, 422)
+
+
+def test_put_book_duplicate_isbn():
+    book = connectionController.http_get(f"books/{batch_ids[1]}").json()
+    book["ISBN"] = batch[0]["ISBN"]
+    response = requests.put(f"{connectionController.URL}/books/{batch_ids[1]}", json=book)
+    assert_status_code(response, 422)
+    assert connectionController.http_get(f"books/{batch_ids[1]}").json()["ISBN"] == batch[1]["ISBN"]
+
+
+def test_get_books_pages():
+    response = connectionController.http_get("books?limit=1&fields=title")
+    assert_status_code(response, 200)
+    first_page = response.json()
+    assert len(first_page) == 1
+    assert set(first_page[0].keys()) == {"title", "id"}
+    next_after = response.headers["X-Next-After"]
+    response = connectionController.http_get(f"books?limit=1&after={next_after}")
+    assert_status_code(response, 200)
+    assert response.json()[0]["id"] > first_page[0]["id"]
+
+
+def test_get_books_stream():
+    response = connectionController.http_get("books?stream=ndjson")
+    assert_status_code(response, 200)
+    lines = response.text.splitlines()
+    assert len(lines) == len(connectionController.http_get("books").json())
+
+
+def test_get_book_not_modified():
+    response = connectionController.http_get(f"books/{batch_ids[0]}")
+    assert_status_code(response, 200)
+    etag = response.headers["ETag"]
+    response = requests.get(f"{connectionController.URL}/books/{batch_ids[0]}", headers={"If-None-Match": etag})
+    assert_status_code(response, 304)
+    assert response.content == b""
+
+
+def test_post_books_query():
+    queries = [{"genre": "Fiction"}, {"ISBN": "9780394558783"}, {"genre": "Fantasy"}]
+    response = connectionController.http_post("books/query", queries)
+    assert_status_code(response, 200)
+    results = response.json()
+    assert len(results) == 3
+    assert batch_ids[0] in [book["id"] for book in results[0]]
+    assert [book["id"] for book in results[1]] == [batch_ids[1]]
+    assert all(book["genre"] == "Fantasy" for book in results[2])
+
+
+def test_post_books_query_invalid_filter():
+    response = connectionController.http_post("books/query", [{"genre": "Jokes"}])
+    assert_status_code(response, 422)
+
+
+def test_search_books():
+    response = connectionController.http_get("books/search?q=huckleberry fi&limit=5")
+    assert_status_code(response, 200)
+    results = response.json()
+    assert results[0]["id"] == batch_ids[0]
+    assert "searchTokens" not in results[0]
+
+
+def test_search_books_without_text():
+    response = connectionController.http_get("books/search?q=")
+    assert_status_code(response, 422)
+
+
+def test_external_write_invalidates_cached_book():
+    # Needs MongoDB as a replica set with CHANGE_STREAM=1, see docker-compose.replicaset.yml.
+    pymongo = pytest.importorskip("pymongo")
+    from bson.objectid import ObjectId
+    client = pymongo.MongoClient("mongodb://localhost:27017/?directConnection=true", serverSelectionTimeoutMS=2000)
+    try:
+        if "setName" not in client.admin.command("hello"):
+            pytest.skip("MongoDB is not running as a replica set")
+    except pymongo.errors.PyMongoError:
+        pytest.skip("MongoDB is not reachable")
+    book_id = batch_ids[1]
+    assert_status_code(connectionController.http_get(f"books/{book_id}"), 200)
+    client.library.books.update_one({"_id": ObjectId(book_id)}, {"$set": {"publisher": "Changed elsewhere"}})
+    for _ in range(50):
+        if connectionController.http_get(f"books/{book_id}").json()["publisher"] == "Changed elsewhere":
+            break
+        time.sleep(0.1)
+    assert connectionController.http_get(f"books/{book_id}").json()["publisher"] == "Changed elsewhere"
+
+
+def test_patch_books():
+    body = {"ids": [batch_ids[1]], "set": {"publisher": "Bulk Publisher"}}
+    response = requests.patch(f"{connectionController.URL}/books", json=body)
+    assert_status_code(response, 200)
+    assert response.json() == [{"ID": batch_ids[1]}]
+    assert connectionController.http_get(f"books/{batch_ids[1]}").json()["publisher"] == "Bulk Publisher"
+
+
+def test_delete_books_outcomes():
+    body = {"ids": ["000000000000000000000000", "not-an-id"]}
+    response = requests.delete(f"{connectionController.URL}/books", json=body)
+    assert_status_code(response, 200)
+    assert [result["error"] for result in response.json()] == ["Not Found", "Unprocessable Content"]
+
+
+def test_get_stats():
+    response = connectionController.http_get("stats")
+    assert_status_code(response, 200)
+    stats = response.json()
+    assert set(stats.keys()) == {"genres", "years", "publishers"}
+    assert stats["genres"]["Biography"]["books"] >= 1
+    response = connectionController.http_get("stats/genres")
+    assert_status_code(response, 200)
+    assert "Biography" in response.json()
+
+def test_export_import():
+    response = connectionController.http_get("export")
+    assert_status_code(response, 200)
+    assert response.content[:2] == b"\x1f\x8b"
+    response = requests.post(f"{connectionController.URL}/import", data=response.content)
+    assert_status_code(response, 200)
+    report = response.json()
+    assert report["imported"] == 0
+    assert report["duplicates"] >= 1
+
+
+def test_import_updates_top():
+    id = str(ObjectId())
+    record = {"id": id, "title": "The Caves of Steel", "ISBN": "9780553293401", "genre": "Science Fiction",
+              "authors": "Isaac Asimov", "publisher": "Bantam", "publishedDate": "1954", "rating": {"counts": {"5": 50}}}
+    response = requests.post(f"{connectionController.URL}/import", data=json.dumps(record) + "\n")
+    assert_status_code(response, 200)
+    assert response.json()["imported"] == 1
+    top = connectionController.http_get("top").json()
+    assert id in [rating["id"] for rating in top]
+    assert [rating for rating in top if rating["id"] == id][0]["average"] == 5.0
+
+
+TEST_MONGO_URI = os.environ.get("TEST_MONGO_URI", "mongodb://localhost:27017/")
+
+
+@pytest.fixture
+def database():
+    database = Database.Database(uri=TEST_MONGO_URI, name="service_tests")
+    yield database
+    database.client.drop_database("service_tests")
+
+
+@pytest.fixture
+def ratings(database):
+    return RatingsCollection.RatingsCollection(database)
+
+
+@pytest.fixture
+def books(database):
+    return BooksCollection.BooksCollection(database)
+
+
+@pytest.fixture
+def mongo_clients(monkeypatch):
+    """
+    Replaces pymongo.MongoClient with a stub, and gives the list of the stub clients created.
+    """
+    created = []
+
+    class StubMongoClient:
+        def __init__(self, uri, **options):
+            self.uri = uri
+            self.options = options
+            self.admin = self
+            self.pings = 0
+            self.down = False
+            self.closed = False
+            created.append(self)
+
+        def command(self, name):
+            if self.down:
+                raise PyMongoError("injected failure")
+            self.pings += 1
+            return {"ok": 1}
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(Database.pymongo, "MongoClient", StubMongoClient)
+    return created
+
+
+def test_database_client_created_once_per_process(mongo_clients, monkeypatch):
+    database = Database.Database(uri="mongodb://stub:27017/", max_pool_size=7)
+    assert mongo_clients == []
+    client = database.client
+    assert database.client is client
+    assert mongo_clients == [client]
+    assert (client.uri, client.options["maxPoolSize"]) == ("mongodb://stub:27017/", 7)
+    database.ready = True
+    # A forked child gets its own client and warms it up again, the parent's client is left open.
+    parent = os.getpid()
+    monkeypatch.setattr(os, "getpid", lambda: parent + 1)
+    child = database.client
+    assert child is not client and mongo_clients == [client, child]
+    assert not database.ready and not client.closed
+
+
+def test_database_reset(mongo_clients, monkeypatch):
+    database = Database.Database(uri="mongodb://stub:27017/")
+    client = database.client
+    database.ready = True
+    database.reset()
+    assert client.closed and not database.ready
+    assert database.client is not client
+    # After a fork the child never closes the client of its parent.
+    parent_client = database.client
+    parent = os.getpid()
+    monkeypatch.setattr(os, "getpid", lambda: parent + 1)
+    database.reset()
+    assert not parent_client.closed
+    assert database.client is mongo_clients[-1] and len(mongo_clients) == 3
+
+
+def test_database_warmup_and_readiness(mongo_clients, monkeypatch):
+    database = Database.Database(uri="mongodb://stub:27017/")
+    steps = []
+    assert not database.isReady()
+    database.warmup(3, [lambda: steps.append("indexes"), lambda: steps.append("top")])
+    assert steps == ["indexes", "top"]
+    assert database.client.pings == 3
+    assert database.isReady()
+    database.client.down = True
+    assert not database.isReady()
+    database.client.down = False
+    parent = os.getpid()
+    monkeypatch.setattr(os, "getpid", lambda: parent + 1)
+    assert not database.isReady()
+
+
+def test_database_warmup_failure_leaves_not_ready(mongo_clients):
+    database = Database.Database(uri="mongodb://stub:27017/")
+    database.client.down = True
+    with pytest.raises(PyMongoError):
+        database.warmup(2, [lambda: pytest.fail("a step ran without a database")])
+    database.client.down = False
+    assert not database.isReady()
+
+
+def test_health_and_readiness_routes(mongo_clients, monkeypatch):
+    import main
+    database = Database.Database(uri="mongodb://stub:27017/")
+    monkeypatch.setattr(Database, "database", database)
+    client = main.app.test_client()
+    assert client.get("/healthz").get_json() == {"status": "ok"}
+    response = client.get("/readyz")
+    assert_status_code(response, 503)
+    assert response.get_json() == {"status": "not ready"}
+    database.warmup(1)
+    response = client.get("/readyz")
+    assert_status_code(response, 200)
+    assert response.get_json() == {"status": "ready"}
+    database.client.down = True
+    assert_status_code(client.get("/readyz"), 503)
+    assert_status_code(client.get("/healthz"), 200)
+
+
+def stored_rating(ratings):
+    id = str(ObjectId())
+    ratings.collection.insert_one(new_rating({"title": "Foundation", "genre": "Science Fiction"}, id))
+    return id
+
+
+def fail(*args, **kwargs):
+    raise PyMongoError("injected failure")
+
+
+class FailingCollection:
+    """
+    A collection whose given method fails, every other method is the real one.
+    """
+    def __init__(self, collection, method):
+        self.collection = collection
+        self.method = method
+
+    def __getattr__(self, name):
+        return fail if name == self.method else getattr(self.collection, name)
+
+
+def failing_collection(monkeypatch, name, method):
+    real = getattr(RatingsCollection.RatingsCollection, name)
+    monkeypatch.setattr(RatingsCollection.RatingsCollection, name,
+                        property(lambda self: FailingCollection(real.fget(self), method)))
+
+
+# Each step run after the bulk_write of a flush, made to fail in turn.
+after_write_failures = {
+    "leaderboard": lambda ratings, monkeypatch: failing_collection(monkeypatch, "leaderboard", "find_one"),
+    "find": lambda ratings, monkeypatch: failing_collection(monkeypatch, "collection", "find"),
+    "stats": lambda ratings, monkeypatch: monkeypatch.setattr(ratings.stats, "count", fail),
+    "refreshTop": lambda ratings, monkeypatch: monkeypatch.setattr(ratings, "refreshTop", fail)
+}
+
+
+@pytest.mark.parametrize("step", after_write_failures.keys())
+def test_rating_buffer_flush_after_write_failure_adds_once(ratings, monkeypatch, step):
+    id = stored_rating(ratings)
+    buffer = RatingBuffer.RatingBuffer(ratings)
+    for value in (5, 4, 4):
+        assert buffer.addValue(id, value)[0]
+    after_write_failures[step](ratings, monkeypatch)
+    assert buffer.flush() == 3
+    assert buffer.flush() == 0
+    monkeypatch.undo()
+    found, rating = ratings.findRating(id)
+    assert found
+    assert (rating["count"], rating["sum"], rating["counts"]["4"]) == (3, 13, 2)
+
+
+def test_rating_buffer_flush_write_failure_retries(ratings, monkeypatch):
+    id = stored_rating(ratings)
+    buffer = RatingBuffer.RatingBuffer(ratings)
+    for value in (5, 4, 4):
+        buffer.addValue(id, value)
+    failing_collection(monkeypatch, "collection", "bulk_write")
+    with pytest.raises(PyMongoError):
+        buffer.flush()
+    assert buffer.info()["pendingValues"] == 3
+    monkeypatch.undo()
+    assert buffer.flush() == 3
+    assert ratings.findRating(id)[1]["count"] == 3
+
+
+def test_rating_buffer_flush_partial_failure_retries_failed_ratings_only(ratings):
+    good, bad = stored_rating(ratings), stored_rating(ratings)
+    buffer = RatingBuffer.RatingBuffer(ratings)
+    buffer.addValue(good, 5)
+    buffer.addValue(bad, 3)
+    # A sum which is not a number makes the update of the bad rating fail on the server.
+    ratings.collection.update_one({"_id": ObjectId(bad)}, {"$set": {"sum": "corrupt"}})
+    with pytest.raises(BulkWriteError):
+        buffer.flush()
+    assert buffer.info()["pendingValues"] == 1
+    assert buffer.info()["pendingRatings"] == 1
+    ratings.collection.update_one({"_id": ObjectId(bad)}, {"$set": {"sum": 0}})
+    assert buffer.flush() == 1
+    assert ratings.findRating(good)[1]["count"] == 1
+    assert ratings.findRating(bad)[1]["count"] == 1
+    assert ratings.findRating(bad)[1]["counts"]["3"] == 1
+
+
+def test_rating_buffer_add_value_returns_buffered_average(ratings):
+    id = stored_rating(ratings)
+    buffer = RatingBuffer.RatingBuffer(ratings)
+    assert buffer.addValue(id, 5) == (True, 5.0)
+    assert buffer.addValue(id, 4) == (True, 4.5)
+    assert buffer.addValue(str(ObjectId()), 4) == (False, None)
+    assert buffer.info()["pendingValues"] == 2
+
+
+def test_rating_buffer_overlay_counts_values_being_flushed(ratings, monkeypatch):
+    id = stored_rating(ratings)
+    buffer = RatingBuffer.RatingBuffer(ratings)
+    buffer.addValue(id, 5)
+    add_values = ratings.addValues
+    overlays = []
+
+    def addValues(increments, written=None):
+        # A value posted and a rating read while the first value is being written.
+        buffer.addValue(id, 3)
+        overlays.append(buffer.overlay(id, ratings.findRating(id)[1]))
+        return add_values(increments, written)
+
+    monkeypatch.setattr(ratings, "addValues", addValues)
+    assert buffer.flush() == 1
+    assert (overlays[0]["count"], overlays[0]["average"]) == (2, 4.0)
+    assert overlays[0]["counts"]["5"] == 1 and overlays[0]["counts"]["3"] == 1
+    rating = buffer.overlay(id, ratings.findRating(id)[1])
+    assert (rating["count"], rating["sum"]) == (2, 8)
+
+
+def test_records_compact_round_trip(books, ratings):
+    book = apply_metadata({"title": "Dune", "ISBN": "9780441013593", "genre": "Science Fiction"},
+                          {"authors": ["Frank Herbert"], "publisher": "Ace", "publishedDate": "1965"})
+    id = books.insertBook(book)
+    ratings.insertRating(new_rating(book, id))
+    ratings.updateRating(id, 5)
+    found, book = books.findBook(id)
+    assert found and isinstance(Records.compact(book), Records.Book)
+    buffer = RatingBuffer.RatingBuffer(ratings)
+    buffer.addValue(id, 3)
+    found, rating = ratings.findRating(id)
+    # The write-behind overlay replaces counts, count, sum and average with new objects.
+    rating = buffer.overlay(id, rating)
+    assert (rating["counts"]["3"], rating["count"], rating["sum"], rating["average"]) == (1, 2, 8, 4.0)
+    page = list(books.findBooks())
+    body = [book, rating, *page]
+    compacted = Records.compact(body)
+    assert [type(document) for document in compacted] == [Records.Book, Records.Rating, Records.Book]
+    assert [Records.asDict(document) for document in compacted] == body
+    assert Records.compact(rating) == compacted[1]
+    # Documents with other fields, such as a field selection or a pending enrichment, are kept as they are.
+    partial = {"title": "Dune", "id": id}
+    pending = {**book, "enrichment": "pending"}
+    assert Records.compact([partial, pending]) == [partial, pending]
+    assert Records.compact(partial) is partial
+
+
+@pytest.mark.parametrize("encoder", JsonEncoder.ENCODERS)
+def test_json_encoder_matches_previous_json(monkeypatch, encoder):
+    if encoder == "orjson":
+        pytest.importorskip("orjson")
+    monkeypatch.setattr(JsonEncoder, "encoder", encoder)
+    body = [
+        {"title": "Dune", "ISBN": "9780441013593", "genre": "Science Fiction", "authors": "Frank Herbert",
+         "publisher": "Ace", "publishedDate": "1965", "id": "1"},
+        {"title": "Dune \u00e9dition \u2013 \"1\"", "counts": {"1": 0, "5": 2}, "count": 2, "sum": 10, "average": 5.0, "id": "1"},
+        {"id": "2", "average": 4.33, "missing": None}
+    ]
+    encoded = JsonEncoder.dumps(Records.compact(body))
+    assert json.loads(encoded) == json.loads(json.dumps(body))
+    # Records keep the field order of the documents, so cached and uncached responses are the same bytes.
+    assert encoded == JsonEncoder.dumps(body)
+    assert [list(document) for document in json.loads(encoded)] == [list(document) for document in body]
+    # The ETag of a response does not depend on whether its body was compacted.
+    assert JsonEncoder.dumps(Records.compact(body), sort_keys=True) == JsonEncoder.dumps(body, sort_keys=True)
+    assert JsonEncoder.loads(encoded) == body
+
+
+def test_rating_buffer_overlay_without_buffered_values(ratings):
+    id = stored_rating(ratings)
+    buffer = RatingBuffer.RatingBuffer(ratings)
+    rating = ratings.findRating(id)[1]
+    assert buffer.overlay(id, rating) is rating
+
+
+@pytest.mark.parametrize("length", [0, 10, 40, -5])
+def test_isbn_index_truncated_file_falls_back_to_no_index(tmp_path, length):
+    dump, path = tmp_path / "dump.ndjson", tmp_path / "isbn.idx"
+    dump.write_text('{"isbn": "9780553293357", "authors": "Isaac Asimov", "publisher": "Bantam"}\n')
+    IsbnIndex.build(str(dump), str(path))
+    index = IsbnIndex.IsbnIndex(str(path), check_interval=0)
+    assert index.lookup("9780553293357") == (True, {"authors": ["Isaac Asimov"], "publisher": "Bantam"})
+    data = path.read_bytes()
+    path.write_bytes(data[:length])
+    assert index.lookup("9780553293357") == (False, None)
+    assert index.info()["path"] == str(path)
+
+
+def test_isbn_index_build_and_lookup(tmp_path):
+    dump, path = tmp_path / "dump.csv.gz", tmp_path / "isbn.idx"
+    with gzip.open(dump, "wt", newline="") as file:
+        file.write("isbn,author,publisher,date\n"
+                   "978-0-441-01359-3,Frank Herbert,Ace,1965\n"
+                   "0-306-40615-2,Ann Author; Bob Author,Plenum,1975\n"
+                   "080442957X,,Ungar,\n"
+                   "9780000000000,,,\n"
+                   "not an isbn,Nobody,Nowhere,2000\n"
+                   "9780441013593,Frank Herbert,Chilton,1965\n")
+    assert IsbnIndex.build(str(dump), str(path)) == {"records": 3, "skipped": 2}
+    index = IsbnIndex.IsbnIndex(str(path), check_interval=0)
+    # The last record of a repeated ISBN wins.
+    assert index.lookup("9780441013593") == (True, {"authors": ["Frank Herbert"], "publisher": "Chilton", "publishedDate": "1965"})
+    assert index.lookup("9780306406157") == (True, {"authors": ["Ann Author", "Bob Author"], "publisher": "Plenum", "publishedDate": "1975"})
+    assert index.lookup("9780804429573") == (True, {"publisher": "Ungar"})
+    assert index.lookup("9780000000000") == (False, None)
+    assert sorted(index.keys()) == ["9780306406157", "9780441013593", "9780804429573"]
+    assert (index.info()["records"], index.info()["hits"], index.info()["misses"]) == (3, 3, 1)
+
+
+def test_isbn_index_lookup_non_ascii_digits(tmp_path):
+    dump, path = tmp_path / "dump.ndjson", tmp_path / "isbn.idx"
+    dump.write_text('{"isbn": "9780553293357", "publisher": "Bantam"}\n{"isbn": "978055329335\u00b2", "publisher": "Bantam"}\n')
+    assert IsbnIndex.build(str(dump), str(path)) == {"records": 1, "skipped": 1}
+    index = IsbnIndex.IsbnIndex(str(path), check_interval=0)
+    for isbn in ["978055329335\u00b2", "\uff19\uff17\uff18\uff10\uff15\uff15\uff13\uff12\uff19\uff13\uff13\uff15\uff17"]:
+        assert index.lookup(isbn) == (False, None)
+        assert not Validation.isValidISBN(isbn)
+    assert Validation.isValidISBN("9780553293357")
+
+
+def test_isbn_index_lookup_ends_on_a_full_table(tmp_path):
+    path = tmp_path / "isbn.idx"
+    slots = 8
+    header = IsbnIndex.HEADER.pack(IsbnIndex.MAGIC, slots, slots, IsbnIndex.HEADER.size + IsbnIndex.SLOT.size * slots)
+    path.write_bytes(header + b"".join(IsbnIndex.SLOT.pack(key, 0) for key in range(1, slots + 1)))
+    index = IsbnIndex.IsbnIndex(str(path), check_interval=0)
+    assert index.lookup("9780553293357") == (False, None)
+    assert index.info()["misses"] == 1
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache.LRUCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", None)
+    assert cache.get("a") == (True, 1)
+    cache.set("c", 3)
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("c") == (True, 3)
+    assert cache.info() == {"size": 2, "maxsize": 2, "hits": 3, "misses": 1, "evictions": 1, "hitRatio": 0.75}
+
+
+def test_lru_cache_expires_entries():
+    cache = LRUCache.LRUCache(maxsize=10, ttl=60)
+    cache.set("stale", 1, ttl=-1)
+    cache.set("fresh", None)
+    assert cache.get("stale") == (False, None)
+    assert cache.get("fresh") == (True, None)
+    assert cache.info()["size"] == 1
+
+
+class StubResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class StubSession:
+    """
+    A requests session answering volumes API requests from a dict of ISBN to volumeInfo,
+    or failing every request when error is given.
+    """
+    def __init__(self, volumes, error=None):
+        self.volumes = volumes
+        self.error = error
+        self.isbns = []
+
+    def get(self, url, params, timeout):
+        isbn = params["q"].removeprefix("isbn:")
+        self.isbns.append(isbn)
+        if self.error is not None:
+            raise self.error
+        volume = self.volumes.get(isbn)
+        return StubResponse({"totalItems": 1, "items": [{"volumeInfo": volume}]} if volume else {"totalItems": 0})
+
+
+def stubbed_client(session, **options):
+    client = GoogleBooksClient.GoogleBooksClient(**options)
+    client._connect()
+    client.session = session
+    return client
+
+
+def test_google_books_client_caches_volumes_and_misses():
+    session = StubSession({"9780441013593": {"authors": ["Frank Herbert"]}})
+    client = stubbed_client(session)
+    assert client.lookup("9780441013593") == {"authors": ["Frank Herbert"]}
+    assert client.lookup("9780000000000") is None
+    assert client.lookup("9780441013593") == {"authors": ["Frank Herbert"]}
+    assert client.lookup("9780000000000") is None
+    assert session.isbns == ["9780441013593", "9780000000000"]
+    info = client.cacheInfo()
+    assert (info["hits"], info["requests"], info["diskHits"], info["persistent"]) == (2, 2, 0, False)
+
+
+def test_google_books_client_misses_expire_sooner():
+    session = StubSession({"9780441013593": {"authors": ["Frank Herbert"]}})
+    client = stubbed_client(session, negative_ttl=-1)
+    for _ in range(2):
+        client.lookup("9780441013593")
+        client.lookup("9780000000000")
+    assert session.isbns == ["9780441013593", "9780000000000", "9780000000000"]
+
+
+def test_google_books_client_does_not_cache_errors():
+    session = StubSession({}, error=requests.exceptions.ConnectionError("unreachable"))
+    client = stubbed_client(session)
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.lookup("9780441013593")
+    assert session.isbns == ["9780441013593", "9780441013593"]
+    assert client.cacheInfo()["size"] == 0
+
+
+def test_google_books_client_store_shared_by_clients(tmp_path):
+    path = str(tmp_path / "volumes.sqlite")
+    first = stubbed_client(StubSession({"9780441013593": {"authors": ["Frank Herbert"]}}), cache_path=path)
+    assert first.lookup("9780441013593") == {"authors": ["Frank Herbert"]}
+    assert first.lookup("9780000000000") is None
+    # A restarted process reads the store instead of Google Books.
+    session = StubSession({}, error=requests.exceptions.ConnectionError("unreachable"))
+    second = stubbed_client(session, cache_path=path)
+    assert second.lookup("9780441013593") == {"authors": ["Frank Herbert"]}
+    assert second.lookup("9780000000000") is None
+    assert second.lookup("9780441013593") == {"authors": ["Frank Herbert"]}
+    assert session.isbns == []
+    info = second.cacheInfo()
+    assert (info["diskHits"], info["hits"], info["persistent"]) == (2, 1, True)
+    # Expired entries of the store are fetched again.
+    third = stubbed_client(StubSession({}), cache_path=path, negative_ttl=-1)
+    third._writeStore("9780000000000", None, -1)
+    assert third.lookup("9780000000000") is None
+    assert third.session.isbns == ["9780000000000"]
+
+
+def test_ensure_indexes_refuses_duplicate_isbns(books):
+    books.collection.insert_many([{"title": "Foundation", "ISBN": "9780553293357"} for _ in range(2)])
+    with pytest.raises(ValueError, match="9780553293357 \\(2 books\\)"):
+        books.ensureIndexes()
+    books.collection.delete_one({"ISBN": "9780553293357"})
+    books.ensureIndexes()
+    assert "ISBN_unique" in books.collection.index_information()
+
+
+def test_update_book_duplicate_isbn(books):
+    books.ensureIndexes()
+    first = books.insertBook({"title": "Foundation", "ISBN": "9780553293357"})
+    second = books.insertBook({"title": "Foundation and Empire", "ISBN": "9780553293371"})
+    assert books.updateBook(second, {"ISBN": "9780553293357"}) is None
+    assert books.updateBook(first, {"title": "Foundation"}) is False
+    assert books.updateBook(second, {"title": "Second Foundation"}) is True
+
+
+def pending_book(books, isbn="9780553293357"):
+    book = apply_metadata({"title": "Foundation", "ISBN": isbn, "genre": "Science Fiction"}, {})
+    book["enrichment"] = "pending"
+    return books.insertBook(book)
+
+
+def test_circuit_breaker_trial_ends_on_unexpected_error():
+    def lookup(isbn):
+        raise ValueError("unexpected volume")
+    breaker = Enricher.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.failure()
+    enricher = Enricher.Enricher(None, lookup, apply_metadata, breaker=breaker)
+    with pytest.raises(ValueError):
+        enricher.process(str(ObjectId()), "9780553293357", 0)
+    assert breaker.allow() == 0, "the circuit stayed half-open after the trial call"
+
+
+def test_enricher_worker_survives_unexpected_error(books):
+    calls = []
+
+    def lookup(isbn):
+        calls.append(isbn)
+        if len(calls) == 1:
+            raise KeyError("items")
+        return {"authors": ["Isaac Asimov"], "publisher": "Bantam", "publishedDate": "1951"}
+    id = pending_book(books)
+    enricher = Enricher.Enricher(books, lookup, apply_metadata, workers=1, backoff=0.01)
+    enricher.start()
+    try:
+        enricher.enqueue(id, "9780553293357")
+        deadline = time.monotonic() + 5
+        while enricher.info()["enriched"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        enricher.stop()
+    assert enricher.info()["enriched"] == 1
+    assert enricher.info()["retries"] == 1
+    book = books.findBook(id)[1]
+    assert book["authors"] == "Isaac Asimov" and "enrichment" not in book
+
+
+def test_enricher_sweeps_claim_each_book_once(books):
+    ids = {pending_book(books, isbn) for isbn in ("9780553293357", "9780553293364")}
+    sweepers = [Enricher.Enricher(books, None, apply_metadata, sweep_interval=-1) for _ in range(3)]
+    assert [sweeper.sweep() for sweeper in sweepers] == [2, 0, 0]
+    assert sweepers[0].queued == ids
+    for id in ids:
+        assert books.finishEnrichment(id, None, "notFound")
+    assert "enrichmentLease" not in books.collection.find_one({"_id": ObjectId(min(ids))})
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = Admission.TokenBucket(rate=2, burst=3, now=0)
+    assert [bucket.take(0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(0) == 0.5
+    assert bucket.take(0.5) == 0
+    assert bucket.take(10) == 0
+    assert bucket.tokens == 2
+
+
+def test_parse_route_rates():
+    assert Admission.parseRouteRates(None) == {}
+    assert Admission.parseRouteRates("GET /books=20:40, POST /ratings/{rating_id}/values=5,GET /top=0") == {
+        "GET /books": (20.0, 40.0),
+        "POST /ratings/{rating_id}/values": (5.0, 5.0),
+        "GET /top": (0.0, 1)
+    }
+
+
+@pytest.mark.parametrize("entry", ["GET /books", "GET /books=fast", "=5", "GET /books=-1", "GET /books=5:0", "GET /books=5:x"])
+def test_parse_route_rates_names_invalid_entry(entry):
+    with pytest.raises(ValueError, match=f"'{entry}'"):
+        Admission.parseRouteRates(f"GET /top=5,{entry}")
+
+
+def test_route_key():
+    assert Admission.routeKey("POST", "/ratings/<string:rating_id>/values") == "POST /ratings/{rating_id}/values"
+    assert Admission.routeKey("GET", "/stats/<kind>") == "GET /stats/{kind}"
+    assert Admission.routeKey("GET", "/books/{book_id}") == "GET /books/{book_id}"
+
+
+def test_admission_rate_limit_per_client():
+    admission = Admission.Admission(rate=1, burst=1)
+    assert admission.admit("1.1.1.1", "GET /books") == (True, None, None)
+    assert admission.admit("1.1.1.1", "GET /books") == (False, 429, 1)
+    assert admission.admit("2.2.2.2", "GET /books") == (True, None, None)
+    assert admission.admit("1.1.1.1", "GET /top") == (True, None, None)
+    assert admission.info()["rateLimited"] == 1
+
+
+def test_admission_concurrency_caps_until_release():
+    admission = Admission.Admission(max_inflight=2, google_books_max_inflight=1,
+                                    google_books_routes={"POST /books"}, retry_after=3)
+    assert admission.admit("a", "POST /books")[0]
+    assert admission.admit("b", "POST /books") == (False, 503, 3)
+    assert admission.admit("b", "GET /books")[0]
+    assert admission.admit("c", "GET /books")[0]
+    assert admission.admit("d", "GET /books") == (False, 503, 3)
+    admission.release("POST /books")
+    admission.release("GET /books")
+    assert admission.admit("b", "POST /books")[0]
+    assert admission.admit("d", "GET /books")[0]
+    assert admission.info()["inflight"] == {"POST /books": 1, "GET /books": 2}
+    assert admission.info()["shed"] == 2
+
+
+def admission_app(admission, release=None):
+    from flask import Flask
+    app = Flask(__name__)
+    Admission.instrumentApp(app, admission)
+
+    @app.route("/items/<string:item_id>")
+    def item(item_id):
+        if release is not None:
+            release.wait(5)
+        return {"id": item_id}
+
+    @app.route("/healthz")
+    def healthz():
+        return {"status": "ok"}
+
+    return app
+
+
+def test_admission_answers_429_with_retry_after():
+    admission = Admission.Admission(route_rates={"GET /items/{item_id}": (0.5, 2)}, client_header="X-Forwarded-For")
+    client = admission_app(admission).test_client()
+    statuses = [client.get(f"/items/{index}", headers={"X-Forwarded-For": "1.1.1.1, 10.0.0.1"}).status_code
+                for index in range(2)]
+    assert statuses == [200, 200]
+    response = client.get("/items/3", headers={"X-Forwarded-For": "1.1.1.1"})
+    assert_status_code(response, 429)
+    assert response.headers["Retry-After"] == "2"
+    assert response.get_json() == {"error": "Too Many Requests"}
+    assert client.get("/items/3", headers={"X-Forwarded-For": "2.2.2.2"}).status_code == 200
+    assert all(client.get("/healthz").status_code == 200 for _ in range(5))
+
+
+def test_admission_answers_503_with_retry_after_and_releases():
+    admission = Admission.Admission(max_inflight=1, retry_after=7)
+    release = threading.Event()
+    client = admission_app(admission, release).test_client()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        first = executor.submit(client.get, "/items/1")
+        deadline = time.monotonic() + 5
+        while not admission.info()["inflight"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        response = client.get("/items/2")
+        release.set()
+        assert first.result().status_code == 200
+    assert_status_code(response, 503)
+    assert response.headers["Retry-After"] == "7"
+    assert response.get_json() == {"error": "Service Unavailable"}
+    assert admission.info()["inflight"] == {}
+    assert client.get("/items/3").status_code == 200
+
+
+def exposition_samples(text):
+    """
+    Reads the samples of a Prometheus text exposition, by metric name and label set.
+    """
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_metrics_exposition():
+    from flask import Flask
+    app = Flask(__name__)
+    # In the order of main.create_app, so rejected requests are counted by route.
+    Metrics.instrumentApp(app)
+    Admission.instrumentApp(app, Admission.Admission(route_rates={"GET /metered/{item_id}": (0.5, 1)}))
+
+    @app.route("/metered/<string:item_id>")
+    def metered(item_id):
+        return {"id": item_id}
+
+    @app.route("/metrics")
+    def metrics():
+        return Metrics.registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+    client = app.test_client()
+    before = exposition_samples(client.get("/metrics").get_data(as_text=True))
+    assert [client.get(f"/metered/{index}").status_code for index in range(2)] == [200, 429]
+    assert_status_code(client.get("/missing"), 404)
+    response = client.get("/metrics")
+    assert response.content_type == "text/plain; version=0.0.4"
+    text = response.get_data(as_text=True)
+    assert "# TYPE http_requests_total counter" in text
+    assert "# TYPE http_request_duration_seconds histogram" in text
+    after = exposition_samples(text)
+    change = lambda name: after.get(name, 0) - before.get(name, 0)
+
+    route = 'method="GET",route="/metered/<string:item_id>"'
+    assert change(f'http_requests_total{{{route},status="200"}}') == 1
+    assert change(f'http_requests_total{{{route},status="429"}}') == 1
+    assert change('http_requests_total{method="GET",route="unmatched",status="404"}') == 1
+    assert change('admission_rejections_total{route="GET /metered/{item_id}",reason="rate"}') == 1
+    assert change(f"http_request_duration_seconds_count{{{route}}}") == 2
+    assert change(f'http_request_duration_seconds_bucket{{{route},le="+Inf"}}') == 2
+    assert after[f"http_request_duration_seconds_sum{{{route}}}"] > 0
+    buckets = [value for name, value in after.items() if name.startswith(f"http_request_duration_seconds_bucket{{{route},")]
+    assert len(buckets) == len(Metrics.DEFAULT_BUCKETS) + 1 and buckets == sorted(buckets)
+
+
+def test_async_metrics_count_rejected_requests_by_route(monkeypatch):
+    admission = Admission.Admission(route_rates={"GET /books/{book_id}": (0.5, 1)})
+
+    async def test(client):
+        before = exposition_samples(await (await client.get("/metrics")).text())
+        book_id = str(ObjectId())
+        assert [(await client.get(f"/books/{book_id}")).status for _ in range(2)] == [404, 429]
+        after = exposition_samples(await (await client.get("/metrics")).text())
+        change = lambda name: after.get(name, 0) - before.get(name, 0)
+        assert change('http_requests_total{method="GET",route="/books/{book_id}",status="404"}') == 1
+        assert change('http_requests_total{method="GET",route="/books/{book_id}",status="429"}') == 1
+        assert change('http_request_duration_seconds_count{method="GET",route="/books/{book_id}"}') == 2
+        assert change('admission_rejections_total{route="GET /books/{book_id}",reason="rate"}') == 1
+
+    run_async_app(monkeypatch, test, admission)
+
+
+def test_shape_keeps_fields_and_operators_only():
+    query = {"genre": "Fiction", "$or": [{"title": "Dune"}, {"count": {"$gte": 3}}], "_id": {"$in": ["a", "b"]}}
+    assert Profiling.shape(query) == {"genre": "?", "$or": [{"title": "?"}, {"count": {"$gte": "?"}}], "_id": {"$in": "?"}}
+    assert Profiling.shape([{"$match": {"genre": "Fiction"}}, {"$limit": 5}]) == [{"$match": {"genre": "?"}}, {"$limit": "?"}]
+
+
+def test_command_shape_drops_values():
+    command = {"find": "books", "filter": {"ISBN": "9780553293357"}, "limit": 1, "lsid": {"id": "session"}, "$db": "library"}
+    assert json.loads(Profiling.commandShape("find", command)) == {"filter": {"ISBN": "?"}, "limit": "?"}
+    insert = {"insert": "books", "documents": [{"title": "Dune"}], "ordered": True}
+    assert json.loads(Profiling.commandShape("insert", insert)) == {"ordered": "?"}
+    long = Profiling.commandShape("find", {"find": "books", "filter": {f"field{index}": index for index in range(200)}})
+    assert len(long) == Profiling.SHAPE_MAX_LENGTH + 3 and long.endswith("...")
+
+
+def test_slow_operation_log_threshold(caplog):
+    details = []
+
+    def shape():
+        details.append(True)
+        return '{"filter": {"ISBN": "?"}}'
+    disabled = Profiling.SlowOperationLog(None)
+    disabled.record("mongo", "find books", 10, shape)
+    log = Profiling.SlowOperationLog(0.1)
+    log.record("mongo", "find books", 0.05, shape)
+    assert details == [] and not disabled.enabled() and log.enabled()
+    token = Profiling.current_route.set("GET /books")
+    try:
+        with caplog.at_level(logging.WARNING, logger="Profiling"):
+            log.record("mongo", "find books", 0.25, shape)
+    finally:
+        Profiling.current_route.reset(token)
+    assert details == [True]
+    assert "slow mongo find books took 250.0 ms from GET /books" in caplog.text
+
+
+def profiled_app(profiler, release=None):
+    from flask import Flask
+    app = Flask(__name__)
+    Profiling.instrumentApp(app, profiler)
+
+    @app.route("/work")
+    def work():
+        return {"total": sum(range(1000))}
+
+    @app.route("/slow")
+    def slow():
+        release.wait(5)
+        return {}
+
+    return app
+
+
+def test_profile_header_names_the_profile(tmp_path):
+    profiler = Profiling.RequestProfiler(str(tmp_path), keep=2)
+    client = profiled_app(profiler).test_client()
+    assert "X-Profile" not in client.get("/work").headers
+    names = [client.get("/work", headers={"X-Profile": "1"}).headers["X-Profile"] for _ in range(3)]
+    assert all(name.endswith("-GET-work.prof") for name in names)
+    assert profiler.path(names[-1]) == str(tmp_path / names[-1])
+    assert len(list(tmp_path.glob("*.prof"))) == 2
+    assert profiler.path("../" + names[-1]) is None
+
+
+def concurrent_work(stop):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_profile_records_the_request_thread_only(tmp_path):
+    profiler = Profiling.RequestProfiler(str(tmp_path))
+    client = profiled_app(profiler).test_client()
+    stop = threading.Event()
+    thread = threading.Thread(target=concurrent_work, args=(stop,))
+    thread.start()
+    try:
+        name = client.get("/work", headers={"X-Profile": "1"}).headers["X-Profile"]
+    finally:
+        stop.set()
+        thread.join()
+    calls = {function: stat[1] for (_, _, function), stat in pstats.Stats(profiler.path(name)).stats.items()}
+    assert calls["work"] == 1
+    # The sum of the request, not the ones of the concurrent thread.
+    assert calls["<built-in method builtins.sum>"] == 1
+    assert "concurrent_work" not in calls
+
+
+def test_profile_header_busy_while_another_request_is_profiled(tmp_path):
+    profiler = Profiling.RequestProfiler(str(tmp_path))
+    release = threading.Event()
+    client = profiled_app(profiler, release).test_client()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        first = executor.submit(client.get, "/slow", headers={"X-Profile": "1"})
+        deadline = time.monotonic() + 5
+        while not profiler.lock.locked() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        response = client.get("/work", headers={"X-Profile": "1"})
+        release.set()
+        assert first.result().headers["X-Profile"].endswith("-GET-slow.prof")
+    assert response.headers["X-Profile"] == "busy"
+
+
+def test_profile_header_ignored_without_profiler():
+    client = profiled_app(None).test_client()
+    response = client.get("/work", headers={"X-Profile": "1"})
+    assert_status_code(response, 200)
+    assert "X-Profile" not in response.headers
+
+
+def test_profile_write_failure_is_logged(tmp_path, caplog):
+    (tmp_path / "file").write_text("")
+    profiler = Profiling.RequestProfiler(str(tmp_path / "file" / "profiles"))
+    client = profiled_app(profiler).test_client()
+    with caplog.at_level(logging.WARNING, logger="Profiling"):
+        response = client.get("/work", headers={"X-Profile": "1"})
+    assert_status_code(response, 200)
+    assert "could not write profile" in caplog.text
+    # The profiler is free again for the next request.
+    assert client.get("/work", headers={"X-Profile": "1"}).headers["X-Profile"] != "busy"
+
+
+@pytest.mark.parametrize("enabled", [True, False])
+def test_async_middleware_order(monkeypatch, enabled):
+    import async_main
+    monkeypatch.setattr(Profiling, "instrumentMongo", lambda: None)
+    monkeypatch.setattr(Profiling.slow_operations, "threshold", 0.5 if enabled else None)
+    monkeypatch.setattr(async_main.admission, "max_inflight", 10 if enabled else 0)
+    monkeypatch.setattr(async_main.compression, "enabled", enabled)
+    app = async_main.create_app()
+    expected = ["Profiling", "async_main", "Admission", "async_main", "Encoding"] if enabled else ["async_main", "async_main"]
+    assert [middleware.__module__ for middleware in app.middlewares] == expected
+    assert app.middlewares[1 if enabled else 0] is async_main.record_metrics
+
+
+def test_get_books_gzip_body():
+    plain = connectionController.http_get("books")
+    response = requests.get(f"{connectionController.URL}/books", headers={"Accept-Encoding": "gzip"}, stream=True)
+    assert_status_code(response, 200)
+    assert "Accept-Encoding" in response.headers["Vary"]
+    body = response.raw.read()
+    if len(plain.content) >= 1024:
+        assert response.headers["Content-Encoding"] == "gzip"
+        body = gzip.decompress(body)
+    assert json.loads(body) == plain.json()
+
+
+def test_get_metrics_deflate_body():
+    response = requests.get(f"{connectionController.URL}/metrics",
+                            headers={"Accept-Encoding": "gzip;q=0.5, deflate"}, stream=True)
+    assert_status_code(response, 200)
+    assert response.headers["Content-Encoding"] == "deflate"
+    assert b"# TYPE" in zlib.decompress(response.raw.read())
+
+
+def test_get_books_msgpack_body():
+    msgpack = pytest.importorskip("msgpack")
+    plain = connectionController.http_get("books")
+    response = requests.get(f"{connectionController.URL}/books", headers={"Accept": "application/msgpack"})
+    assert_status_code(response, 200)
+    assert response.headers["Content-Type"] == "application/msgpack"
+    assert "Accept" in response.headers["Vary"]
+    assert msgpack.unpackb(response.content) == plain.json()
+
+
+def encoded_app(compression):
+    from flask import Flask, Response
+    app = Flask(__name__)
+    Encoding.instrumentApp(app, compression)
+    document = {"books": [{"title": f"Book {index}", "genre": "Fiction"} for index in range(100)]}
+
+    @app.route("/large")
+    def large():
+        response = app.json.response(document)
+        response.set_etag("catalog")
+        return response
+
+    @app.route("/small")
+    def small():
+        return {"title": "Dune"}
+
+    @app.route("/stream")
+    def stream():
+        return Response((json.dumps(book).encode() + b"\n" for book in document["books"]), mimetype="application/x-ndjson")
+
+    @app.route("/export")
+    def export():
+        return Response(gzip.compress(b"{}"), mimetype="application/gzip")
+
+    return app, document
+
+
+@pytest.mark.parametrize("accept, coding", [
+    ("gzip", "gzip"),
+    ("deflate", "deflate"),
+    ("gzip;q=0.5, deflate;q=0.8", "deflate"),
+    ("deflate;q=0.1, gzip", "gzip"),
+    ("gzip, identity;q=0", "gzip"),
+    ("gzip;q=0, *;q=0.5", "deflate"),
+    ("identity;q=0", None),
+    ("br", None),
+    (None, None)
+])
+def test_compression_negotiation(accept, coding):
+    app, document = encoded_app(Encoding.Compression())
+    response = app.test_client().get("/large", headers={"Accept-Encoding": accept} if accept else {})
+    assert_status_code(response, 200)
+    assert response.headers.get("Content-Encoding") == coding
+    assert "Accept-Encoding" in response.vary
+    body = response.get_data()
+    if coding == "gzip":
+        body = gzip.decompress(body)
+    elif coding == "deflate":
+        body = zlib.decompress(body)
+    assert json.loads(body) == document
+    # The compressed body is another representation, so its ETag is weak.
+    assert response.get_etag() == ("catalog", coding is not None)
+
+
+def test_compression_minimum_size():
+    app, document = encoded_app(Encoding.Compression(min_size=1024))
+    client = app.test_client()
+    small = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+    assert "Accept-Encoding" in small.vary
+    assert small.get_json() == {"title": "Dune"}
+    large = client.get("/large", headers={"Accept-Encoding": "gzip"})
+    assert large.headers["Content-Encoding"] == "gzip"
+    app, document = encoded_app(Encoding.Compression(min_size=10 ** 6))
+    assert "Content-Encoding" not in app.test_client().get("/large", headers={"Accept-Encoding": "gzip"}).headers
+
+
+def test_compression_of_streamed_and_compressed_responses():
+    app, document = encoded_app(Encoding.Compression())
+    client = app.test_client()
+    stream = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+    assert stream.headers["Content-Encoding"] == "gzip" and "Content-Length" not in stream.headers
+    lines = gzip.decompress(stream.get_data()).splitlines()
+    assert [json.loads(line) for line in lines] == document["books"]
+    export = client.get("/export", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in export.headers
+    assert gzip.decompress(export.get_data()) == b"{}"
+
+
+def test_msgpack_round_trip():
+    msgpack = pytest.importorskip("msgpack")
+    book = Records.Book("Dune", "9780441013593", "Science Fiction", "Frank Herbert", "Ace", "1965", "1")
+    rating = Records.Rating("Dune", {"1": 0, "5": 2}, 2, 10, 5.0, "1")
+    body = [book, rating, {"id": "2", "average": 4.33}]
+    assert msgpack.unpackb(Encoding.packb(body)) == [
+        {"title": "Dune", "ISBN": "9780441013593", "genre": "Science Fiction", "authors": "Frank Herbert",
+         "publisher": "Ace", "publishedDate": "1965", "id": "1"},
+        {"title": "Dune", "counts": {"1": 0, "5": 2}, "count": 2, "sum": 10, "average": 5.0, "id": "1"},
+        {"id": "2", "average": 4.33}
+    ]
+    documents = [{"id": str(index), "count": index} for index in range(1200)]
+    chunks = list(Encoding.packStream(iter(documents), batch_size=500))
+    assert len(chunks) == 3
+    unpacker = msgpack.Unpacker()
+    for chunk in chunks:
+        unpacker.feed(chunk)
+    assert list(unpacker) == documents
+    with pytest.raises(TypeError):
+        Encoding.packb({"when": object()})
+
+
+def test_prefers_msgpack():
+    pytest.importorskip("msgpack")
+    from werkzeug.datastructures import MIMEAccept
+    from werkzeug.http import parse_accept_header
+    prefers = lambda accept: Encoding.prefersMsgpack(parse_accept_header(accept, MIMEAccept))
+    assert prefers("application/msgpack")
+    assert prefers("application/json;q=0.5, application/msgpack")
+    assert not prefers("application/json, application/msgpack;q=0.5")
+    assert not prefers("*/*")
+    assert not prefers("")
+
+
+async def volume(isbn):
+    return {"authors": ["Frank Herbert"], "publisher": "Ace", "publishedDate": "1965"}
+
+
+def run_async_app(monkeypatch, test, admission=None):
+    """
+    Runs a coroutine with an aiohttp test client of the asyncio service, on the
+    database of the unit tests and with a stub in place of Google Books.
+    """
+    import async_main
+    import AsyncBooksCollection
+    import AsyncRatingsCollection
+    import AsyncCatalogStats
+    from aiohttp.test_utils import TestClient, TestServer
+    database = Database.Database(uri=TEST_MONGO_URI, name="service_tests")
+    monkeypatch.setattr(Database, "database", database)
+    monkeypatch.setattr(async_main, "bookCol", AsyncBooksCollection.AsyncBooksCollection(database))
+    monkeypatch.setattr(async_main, "ratingsCol", AsyncRatingsCollection.AsyncRatingsCollection(database))
+    monkeypatch.setattr(async_main, "catalogStats", AsyncCatalogStats.AsyncCatalogStats(database))
+    monkeypatch.setattr(async_main, "lookup_metadata", volume)
+    if admission is not None:
+        monkeypatch.setattr(async_main, "admission", admission)
+
+    async def run():
+        async with TestClient(TestServer(async_main.create_app())) as client:
+            try:
+                deadline = time.monotonic() + 10
+                while (await client.get("/readyz")).status != 200:
+                    assert time.monotonic() < deadline, "the asyncio service did not become ready"
+                    await asyncio.sleep(0.05)
+                await test(client)
+            finally:
+                await database.asyncClient.drop_database("service_tests")
+
+    asyncio.run(run())
+
+
+def test_async_book_crud(monkeypatch):
+    async def test(client):
+        response = await client.post("/books", json={"title": "Dune", "ISBN": "9780441013593", "genre": "Science Fiction"})
+        assert response.status == 201
+        book_id = (await response.json())["ID"]
+        response = await client.post("/books", json={"title": "Dune", "ISBN": "9780441013593", "genre": "Science Fiction"})
+        assert response.status == 422
+        book = await (await client.get(f"/books/{book_id}")).json()
+        assert book == {"title": "Dune", "ISBN": "9780441013593", "genre": "Science Fiction", "authors": "Frank Herbert",
+                        "publisher": "Ace", "publishedDate": "1965", "id": book_id}
+        assert [book["id"] for book in await (await client.get("/books?genre=Science Fiction")).json()] == [book_id]
+
+        book["publisher"] = "Chilton"
+        assert (await client.put(f"/books/{book_id}", json=book)).status == 200
+        assert (await (await client.get(f"/books/{book_id}")).json())["publisher"] == "Chilton"
+        other = await (await client.post("/books", json={"title": "Emma", "ISBN": "9780141439587", "genre": "Fiction"})).json()
+        assert (await client.put(f"/books/{other['ID']}", json={**book, "id": other["ID"]})).status == 422
+
+        assert (await client.delete(f"/books/{book_id}")).status == 200
+        assert (await client.get(f"/books/{book_id}")).status == 404
+        assert (await client.get(f"/ratings/{book_id}")).status == 404
+
+    run_async_app(monkeypatch, test)
+
+
+def test_async_top(monkeypatch):
+    async def test(client):
+        ids = []
+        for title, isbn, values in [("Dune", "9780441013593", [5, 5, 4]), ("Emma", "9780141439587", [3, 3]),
+                                    ("Ulysses", "9780199535675", [2, 3, 4])]:
+            response = await client.post("/books", json={"title": title, "ISBN": isbn, "genre": "Fiction"})
+            ids.append((await response.json())["ID"])
+            for value in values:
+                assert (await client.post(f"/ratings/{ids[-1]}/values", json={"value": value})).status == 200
+        top = await (await client.get("/top")).json()
+        # Emma has fewer than TOP_MIN_COUNT values.
+        assert [(rating["id"], rating["average"]) for rating in top] == [(ids[0], 4.67), (ids[2], 3.0)]
+
+    run_async_app(monkeypatch, test)
+
+
+def test_async_book_not_modified(monkeypatch):
+    async def test(client):
+        response = await client.post("/books", json={"title": "Dune", "ISBN": "9780441013593", "genre": "Science Fiction"})
+        book_id = (await response.json())["ID"]
+        for path in (f"/books/{book_id}", f"/ratings/{book_id}", f"/ratings?id={book_id}"):
+            response = await client.get(path)
+            etag = response.headers["ETag"]
+            response = await client.get(path, headers={"If-None-Match": etag})
+            assert response.status == 304
+            assert await response.read() == b""
+        assert (await client.post(f"/ratings/{book_id}/values", json={"value": 5})).status == 200
+        response = await client.get(f"/ratings/{book_id}", headers={"If-None-Match": etag})
+        assert response.status == 200
+        assert response.headers["ETag"] != etag
+
+    run_async_app(monkeypatch, test)
+
+
+def test_async_admission(monkeypatch):
+    admission = Admission.Admission(route_rates={"GET /books/{book_id}": (0.5, 2)})
+
+    async def test(client):
+        book_id = str(ObjectId())
+        assert [(await client.get(f"/books/{book_id}")).status for _ in range(2)] == [404, 404]
+        response = await client.get(f"/books/{book_id}")
+        assert response.status == 429
+        assert response.headers["Retry-After"] == "2"
+        assert await response.json() == {"error": "Too Many Requests"}
+        assert (await client.get("/top")).status == 200
+
+    run_async_app(monkeypatch, test, admission)